@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Pick a compression setting for a tree from a sample of it.
+
+A few tens of megabytes are sampled evenly (by bytes) from the tree's
+regular files and compressed with every candidate setting; output size, pack
+time and decompression time are scaled up from the sample to the whole tree
+and the candidate that best meets the target wins.  Targets:
+
+	time=SECONDS		smallest output that packs within SECONDS
+	size=BYTES		fastest pack with output no bigger than BYTES (k/M/G suffixes)
+	decompress=SECONDS	smallest output a client unpacks within SECONDS
+	balanced		smallest output packing within 1.5x the fastest (the default)
+
+Only gzip settings are candidates: the init script, the chunk store and the
+kernel's initramfs unpacker of the kernels we boot all expect gzip.
+"""
+
+import os
+import stat
+import time
+import functools
+import subprocess
+
+from treewalk import TreeWalker
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+SAMPLE_BYTES = 32 * 1024 * 1024
+SAMPLE_FILE_MAX = 1024 * 1024	# per file, so one huge file can't make up the sample
+HEADER_BYTES = 128		# newc header and name, roughly, per entry
+LEVELS = (1, 3, 6, 9)
+BALANCED_SLACK = 1.5
+SIZE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def which(progname):
+	for path in os.environ['PATH'].split(os.pathsep):
+		if os.access(os.path.join(path, progname), os.X_OK):
+			return os.path.join(path, progname)
+	return None
+
+def parseTarget(spec):
+	"""
+	Returns (kind, limit) for a target spec.
+	>>> parseTarget('size=800M')
+	('size', 838860800.0)
+	>>> parseTarget('balanced')
+	('balanced', None)
+	"""
+	if spec in (None, '', 'balanced'):
+		return ('balanced', None)
+	if '=' not in spec:
+		raise Exception('bad autotune target \'%s\', expected time=SECONDS, size=BYTES, decompress=SECONDS or balanced' % spec)
+	kind, value = spec.split('=', 1)
+	if kind not in ('time', 'size', 'decompress'):
+		raise Exception('unknown autotune target \'%s\'' % kind)
+	scale = 1
+	if kind == 'size' and value[-1:].lower() in SIZE_SUFFIXES:
+		scale = SIZE_SUFFIXES[value[-1].lower()]
+		value = value[:-1]
+	return (kind, float(value) * scale)
+
+def candidates():
+	"""[(name, argv)] for the gzip compressors installed here."""
+	out = []
+	for prog in ('pigz', 'gzip'):
+		path = which(prog)
+		if path is None:
+			continue
+		for level in LEVELS:
+			out.append(('%s-%d' % (prog, level), [prog, '-%d' % level, '-c']))
+		if prog == 'pigz':
+			# zopfli, pigz 2.3 and newer
+			p = subprocess.Popen([path, '-11', '-c'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+			p.communicate('')
+			if p.returncode == 0:
+				out.append(('pigz-11', [prog, '-11', '-c']))
+	if not out:
+		raise Exception('no gzip compressor (pigz or gzip) found in PATH')
+	return out
+
+def decompressor():
+	return ['gzip' if which('gzip') else 'pigz', '-d', '-c']
+
+def samplePieces(files, target):
+	"""
+	About target bytes sampled from files, [(size, read)] as TreeSample takes
+	them.  Every file owes its share of the sample, and a file is read
+	whenever the debt covers it, so big and small files are sampled in
+	proportion.  Returns [(size, piece)] for the files read.
+	"""
+	share = min(1.0, float(target) / max(1, sum(size for size, read in files)))
+	pieces = []
+	debt = 0.0
+	for size, read in files:
+		debt += size * share
+		n = min(size, SAMPLE_FILE_MAX)
+		if n == 0 or debt < n:
+			continue
+		debt -= n
+		piece = read(n)
+		if piece:
+			pieces.append((size, piece))
+	return pieces
+
+
+class TreeSample(object):
+	"""
+	Bytes drawn evenly from the regular files of a tree, and what they stand
+	for.  entries yields (size, read) per tree entry, where size is None for
+	anything but regular files and read(n) returns the first n bytes.
+	"""
+
+	def __init__(self, entries, target=SAMPLE_BYTES):
+		self.entries = 0
+		self.filebytes = 0
+		files = []
+		for size, read in entries:
+			self.entries += 1
+			if size is not None:
+				files.append((size, read))
+				self.filebytes += size
+
+		self.data = ''.join(piece for size, piece in samplePieces(files, target))
+
+	@property
+	def totalbytes(self):
+		"""Uncompressed archive size, about."""
+		return self.filebytes + self.entries * HEADER_BYTES
+
+	@property
+	def scale(self):
+		return float(self.totalbytes) / max(1, len(self.data))
+
+
+class Estimate(object):
+	def __init__(self, name, argv, size, packtime, decompresstime):
+		self.name = name
+		self.argv = argv
+		self.size = size
+		self.packtime = packtime
+		self.decompresstime = decompresstime
+
+	def todict(self):
+		return {'setting': self.name, 'argv': self.argv, 'size': int(self.size), 'pack_seconds': round(self.packtime, 3),
+			'decompress_seconds': round(self.decompresstime, 3)}
+
+	def __repr__(self):
+		return 'Estimate(%s: %d bytes, pack %.2fs, decompress %.2fs)' % (self.name, self.size, self.packtime, self.decompresstime)
+
+
+def readHead(path, n):
+	try:
+		with open(path, 'rb') as fh:
+			return fh.read(n)
+	except IOError, e:
+		log.debug('could not sample \'%s\': %s' % (path, str(e)))
+		return ''
+
+def dirEntries(top):
+	"""TreeSample entries for a directory tree."""
+	for relpath, st in TreeWalker(top):
+		if stat.S_ISREG(st.st_mode):
+			yield st.st_size, functools.partial(readHead, os.path.join(top, relpath))
+		else:
+			yield None, None
+
+def pathEntries(top, relpaths):
+	"""TreeSample entries for some of the paths under top."""
+	for relpath in relpaths:
+		path = os.path.join(top, relpath)
+		st = os.lstat(path)
+		if stat.S_ISREG(st.st_mode):
+			yield st.st_size, functools.partial(readHead, path)
+		else:
+			yield None, None
+
+def timeRun(argv, data):
+	start = time.time()
+	p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+	out, err = p.communicate(data)
+	if p.returncode != 0:
+		raise Exception('%s failed [rc=%d]' % (' '.join(argv), p.returncode))
+	return time.time() - start, out
+
+def estimate(sample, settings=None):
+	"""Compress the sample with every setting, returns [Estimate] for the whole tree."""
+	unzip = decompressor()
+	out = []
+	for name, argv in settings or candidates():
+		packtime, compressed = timeRun(argv, sample.data)
+		unpacktime, plain = timeRun(unzip, compressed)
+		e = Estimate(name, argv, len(compressed) * sample.scale, packtime * sample.scale, unpacktime * sample.scale)
+		log.debug('autotune %r' % e)
+		out.append(e)
+	return out
+
+def choose(estimates, target):
+	"""The estimate that best meets the target, and whether it meets it at all."""
+	kind, limit = target
+	bysize = sorted(estimates, key=lambda e: (e.size, e.packtime))
+	bytime = sorted(estimates, key=lambda e: (e.packtime, e.size))
+
+	if kind == 'balanced':
+		limit = bytime[0].packtime * BALANCED_SLACK
+		return [e for e in bysize if e.packtime <= limit][0], True
+	if kind == 'time':
+		fits = [e for e in bysize if e.packtime <= limit]
+		return (fits[0], True) if fits else (bytime[0], False)
+	if kind == 'size':
+		fits = [e for e in bytime if e.size <= limit]
+		return (fits[0], True) if fits else (bysize[0], False)
+	if kind == 'decompress':
+		fits = [e for e in bysize if e.decompresstime <= limit]
+		return (fits[0], True) if fits else (sorted(estimates, key=lambda e: e.decompresstime)[0], False)
+	raise Exception('unknown autotune target \'%s\'' % kind)
+
+def tune(name, entries, spec, samplebytes=SAMPLE_BYTES):
+	"""
+	Sample a tree (TreeSample entries, see dirEntries) and choose a
+	compressor for it.  Returns (Estimate, metadata dict) where the metadata
+	records the target, the sample and every candidate's prediction.
+	"""
+	target = parseTarget(spec)
+	start = time.time()
+	sample = TreeSample(entries, samplebytes)
+	estimates = estimate(sample)
+	chosen, met = choose(estimates, target)
+
+	if met:
+		log.info('autotune chose %s for %s: predicted %d bytes, %.1fs to pack' % (chosen.name, name, chosen.size, chosen.packtime))
+	else:
+		log.warn('no compression setting meets %s=%s for %s, using %s (predicted %d bytes, %.1fs to pack)' % (target[0], target[1], name, chosen.name, chosen.size, chosen.packtime))
+
+	metadata = {
+		'target': {'kind': target[0], 'limit': target[1], 'met': met},
+		'sample': {'bytes': len(sample.data), 'tree_bytes': sample.totalbytes, 'entries': sample.entries, 'seconds': round(time.time() - start, 3)},
+		'candidates': [e.todict() for e in estimates],
+		'chosen': chosen.todict(),
+	}
+	return chosen, metadata
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
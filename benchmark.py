@@ -0,0 +1,351 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+Benchmark the conversion stages on synthetic trees (see synthtree.py).
+
+Each stage runs on freshly generated trees of the chosen shapes and is timed
+for wall clock, our own CPU and the CPU of the processes it spawned.
+Results go to a JSON file tagged with the git commit, so two runs can be
+compared with --compare.  No root, VDI or network is needed; stages whose
+tools (cpio, pigz, file) are missing are recorded as skipped.
+"""
+
+import os
+import sys
+import json
+import stat
+import time
+import zlib
+import shutil
+import socket
+import argparse
+import platform
+import subprocess
+import multiprocessing
+
+from tempfile import mkdtemp
+
+import logging
+log = logging.getLogger('benchmark')
+
+import doit
+import synthtree
+import chunkstore
+
+from newc import NewcWriter, archiveName
+from treecopy import copyTree, syncTree
+from treewalk import TreeWalker
+
+### constants
+DEFAULT_SHAPES = ['tiny', 'large', 'deep', 'sparse', 'hardlinks', 'rootfs']
+READ_CHUNK = 1024 * 1024
+COMPRESS_LEVELS = [1, 6, 9]
+
+
+class Stage(object):
+	"""A timed run: wall clock, our CPU and our children's CPU, from os.times()."""
+
+	def __init__(self, shape, stage):
+		self.shape = shape
+		self.stage = stage
+
+	def __enter__(self):
+		self.start = os.times()
+		self.wall = time.time()
+		return self
+
+	def __exit__(self, *exc_details):
+		end = os.times()
+		self.result = {
+			'shape': self.shape,
+			'stage': self.stage,
+			'wall': time.time() - self.wall,
+			'cpu': (end[0] - self.start[0]) + (end[1] - self.start[1]),
+			'children_cpu': (end[2] - self.start[2]) + (end[3] - self.start[3]),
+		}
+
+
+def have(*progs):
+	return all(doit.which(p) is not None for p in progs)
+
+def treeStats(top):
+	files = 0
+	size = 0
+	for relpath, st in TreeWalker(top):
+		files += 1
+		size += st.st_size
+	return files, size
+
+def treeShape(top):
+	"""{relpath: (type, size, symlink target, hardlink group)}, to check a copy against its source."""
+	groups = {}
+	shape = {}
+	for relpath, st in TreeWalker(top):
+		path = os.path.join(top, relpath)
+		group = groups.setdefault((st.st_dev, st.st_ino), relpath) if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode) else None
+		shape[relpath] = (stat.S_IFMT(st.st_mode), st.st_size if stat.S_ISREG(st.st_mode) else 0,
+			os.readlink(path) if stat.S_ISLNK(st.st_mode) else None, group)
+	return shape
+
+def checkCopy(src, dst):
+	srcshape, dstshape = treeShape(src), treeShape(dst)
+	differ = sorted(relpath for relpath in set(srcshape) | set(dstshape) if srcshape.get(relpath) != dstshape.get(relpath))
+	if differ:
+		raise Exception('\'%s\' differs from \'%s\' at %d paths, first \'%s\'' % (dst, src, len(differ), differ[0]))
+
+def packNewc(src, fh):
+	"""The uncompressed archive cpioZipPack would make, built in-process."""
+	writer = NewcWriter(fh)
+	for relpath, st in TreeWalker(src):
+		path = os.path.join(src, relpath)
+		data = None
+		if os.path.isfile(path) and not os.path.islink(path):
+			data = readChunks(path)
+		elif os.path.islink(path):
+			data = os.readlink(path)
+		writer.addEntry(archiveName(relpath), st, data)
+	writer.close()
+	return writer.offset
+
+def readChunks(path):
+	with open(path, 'rb') as fh:
+		while True:
+			buf = fh.read(READ_CHUNK)
+			if not buf:
+				break
+			yield buf
+
+
+class Benchmark(object):
+	def __init__(self, workdir, shapes, scale, seed, repeat, stages=None):
+		self.workdir = workdir
+		self.shapes = shapes
+		self.scale = scale
+		self.seed = seed
+		self.repeat = repeat
+		self.stages = stages
+		self.results = []
+
+	def wanted(self, stage):
+		return self.stages is None or any(stage == s or stage.startswith(s + ':') for s in self.stages)
+
+	def fresh(self, name):
+		path = os.path.join(self.workdir, name)
+		if os.path.lexists(path):
+			if os.path.isdir(path) and not os.path.islink(path):
+				shutil.rmtree(path)
+			else:
+				os.unlink(path)
+		return path
+
+	def time(self, shape, stage, func, setup=None, info=None):
+		"""Run func repeat times, setup (untimed) before each run.  func may return a dict to add to the result."""
+		if not self.wanted(stage):
+			return
+		for run in range(self.repeat):
+			if setup is not None:
+				setup()
+			with Stage(shape, stage) as s:
+				extra = func()
+			s.result['run'] = run
+			s.result.update(info or {})
+			s.result.update(extra or {})
+			self.results.append(s.result)
+			log.info('%-10s %-24s %8.3fs wall %8.3fs cpu %8.3fs children' % (shape, stage, s.result['wall'], s.result['cpu'], s.result['children_cpu']))
+
+	def skip(self, shape, stage, why):
+		if self.wanted(stage):
+			log.info('%-10s %-24s skipped, %s' % (shape, stage, why))
+			self.results.append({'shape': shape, 'stage': stage, 'skipped': why})
+
+	def runShape(self, shape):
+		src = os.path.join(self.workdir, 'src-' + shape)
+		start = time.time()
+		synthtree.makeTree(src, shape, self.scale, self.seed)
+		files, size = treeStats(src)
+		log.info('%-10s generated %d entries, %d bytes in %.1fs' % (shape, files, size, time.time() - start))
+		info = {'files': files, 'bytes': size}
+
+		# walkers
+		def walkOs():
+			for dirpath, dirnames, filenames in os.walk(src):
+				for name in dirnames + filenames:
+					os.lstat(os.path.join(dirpath, name))
+		def walkTree():
+			for entry in TreeWalker(src):
+				pass
+		def walkFind():
+			subprocess.check_call(['find', '.', '-printf', ''], cwd=src)
+		self.time(shape, 'walk:os.walk', walkOs, info=info)
+		self.time(shape, 'walk:treewalker', walkTree, info=info)
+		if have('find'):
+			self.time(shape, 'walk:find', walkFind, info=info)
+
+		# copy
+		dst = os.path.join(self.workdir, 'dst')
+		self.time(shape, 'copy:treecopy', lambda: copyTree(src, dst), setup=lambda: self.fresh('dst'), info=info)
+		self.time(shape, 'copy:treesync', lambda: syncTree(src, dst), setup=lambda: self.fresh('dst'), info=info)
+		if os.path.exists(dst):
+			checkCopy(src, dst)
+		if have('cpio'):
+			self.time(shape, 'copy:cpio', lambda: doit.cpioCopy(src, dst), setup=lambda: self.fresh('dst'), info=info)
+		else:
+			self.skip(shape, 'copy:cpio', 'no cpio')
+		self.fresh('dst')
+
+		# pack
+		archive = os.path.join(self.workdir, 'archive.cpio')
+		def newc():
+			with open(archive, 'wb') as fh:
+				return {'archive_bytes': packNewc(src, fh)}
+		self.time(shape, 'pack:newc', newc, info=info)
+
+		packed = os.path.join(self.workdir, 'rootimg.cpio.gz')
+		if have('cpio', doit.GZIP_C_PROG[0]):
+			self.time(shape, 'pack:cpiozippack', lambda: doit.cpioZipPack(src, packed), setup=lambda: self.fresh('rootimg.cpio.gz'), info=info)
+		else:
+			self.skip(shape, 'pack:cpiozippack', 'no cpio or %s' % doit.GZIP_C_PROG[0])
+
+		# compressors, on the uncompressed archive
+		if os.path.exists(archive):
+			for level in COMPRESS_LEVELS:
+				def zlibCompress(level=level):
+					co = zlib.compressobj(level)
+					out = 0
+					for buf in readChunks(archive):
+						out += len(co.compress(buf))
+					out += len(co.flush())
+					return {'compressed_bytes': out}
+				self.time(shape, 'compress:zlib-%d' % level, zlibCompress, info=info)
+
+			for prog in ('gzip', 'pigz'):
+				if not have(prog):
+					self.skip(shape, 'compress:%s' % prog, 'no %s' % prog)
+					continue
+				def compressProg(prog=prog):
+					with open(archive, 'rb') as fh:
+						with open(os.devnull, 'wb') as devnull:
+							subprocess.check_call([prog, '-9', '-c'], stdin=fh, stdout=devnull)
+				self.time(shape, 'compress:%s-9' % prog, compressProg, info=info)
+
+			def chunk():
+				with open(archive, 'rb') as fh:
+					return {'chunks': sum(1 for c in chunkstore.chunks(fh))}
+			self.time(shape, 'compress:chunkstore', chunk, info=info)
+
+		# extract
+		if os.path.exists(packed):
+			self.time(shape, 'extract:gzcpio', lambda: doit.extractGZCpio(packed, dst), setup=lambda: self.fresh('dst'), info=info)
+			self.fresh('dst')
+		else:
+			self.skip(shape, 'extract:gzcpio', 'no packed archive')
+
+		# boot resources
+		if shape == 'rootfs':
+			if have('cpio', 'file', doit.GZIP_C_PROG[0], doit.GZIP_D_PROG[0]):
+				class BootArgs(object):
+					outdir = os.path.join(self.workdir, 'out')
+				def setup():
+					self.fresh('out')
+					os.mkdir(BootArgs.outdir)
+				self.time(shape, 'boot:createbootpackage', lambda: doit.createBootPackage(BootArgs, src), setup=setup, info=info)
+				self.fresh('out')
+			else:
+				self.skip(shape, 'boot:createbootpackage', 'no cpio, file or gzip tools')
+
+		for name in ('archive.cpio', 'rootimg.cpio.gz'):
+			self.fresh(name)
+		shutil.rmtree(src)
+
+	def run(self):
+		for shape in self.shapes:
+			self.runShape(shape)
+		return self.results
+
+
+def environment():
+	here = os.path.dirname(os.path.abspath(__file__))
+	try:
+		commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here, stderr=open(os.devnull, 'w')).strip()
+		dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=here, stderr=open(os.devnull, 'w')) != 0
+	except (OSError, subprocess.CalledProcessError):
+		commit, dirty = None, None
+	return {
+		'commit': commit,
+		'dirty': dirty,
+		'host': socket.gethostname(),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'cpus': multiprocessing.cpu_count(),
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+	}
+
+def summarize(results):
+	"""{(shape, stage): best wall time} over the runs that weren't skipped."""
+	best = {}
+	for r in results:
+		if 'wall' not in r:
+			continue
+		key = (r['shape'], r['stage'])
+		best[key] = min(best.get(key, r['wall']), r['wall'])
+	return best
+
+def compare(oldpath, newpath):
+	with open(oldpath) as fh:
+		old = json.load(fh)
+	with open(newpath) as fh:
+		new = json.load(fh)
+
+	print 'old: %s (%s)' % (old['environment'].get('commit'), old['environment'].get('time'))
+	print 'new: %s (%s)' % (new['environment'].get('commit'), new['environment'].get('time'))
+	if (old['scale'], old['seed']) != (new['scale'], new['seed']):
+		print 'warning: runs used different scale/seed, the trees are not the same'
+
+	before = summarize(old['results'])
+	after = summarize(new['results'])
+	print '%-10s %-24s %10s %10s %8s' % ('shape', 'stage', 'old', 'new', 'change')
+	for key in sorted(set(before) | set(after)):
+		o = before.get(key)
+		n = after.get(key)
+		change = '%+7.1f%%' % ((n - o) / o * 100) if o and n else ''
+		print '%-10s %-24s %10s %10s %8s' % (key[0], key[1], '%.3fs' % o if o is not None else '-', '%.3fs' % n if n is not None else '-', change)
+
+if __name__ == '__main__':
+	ap = argparse.ArgumentParser(description='time the conversion stages on synthetic trees')
+	ap.add_argument('-s','--shapes', dest='shapes', default=','.join(DEFAULT_SHAPES), help='comma separated tree shapes (%s)' % ', '.join(sorted(synthtree.SHAPES)))
+	ap.add_argument('--stages', dest='stages', help='comma separated stages or stage groups to run, eg. walk,pack:newc (default all)')
+	ap.add_argument('--scale', dest='scale', type=float, default=1.0, help='tree size factor (default 1.0)')
+	ap.add_argument('--seed', dest='seed', type=int, default=0, help='tree generator seed (default 0)')
+	ap.add_argument('-r','--repeat', dest='repeat', type=int, default=3, help='runs per stage, the best one counts in comparisons (default 3)')
+	ap.add_argument('-o','--output', dest='output', default='benchmark.json', help='where to write the results (default benchmark.json)')
+	ap.add_argument('-w','--workdir', dest='workdir', help='directory for the generated trees (default a temporary directory)')
+	ap.add_argument('--compare', dest='compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files instead of running')
+	args = ap.parse_args()
+
+	if args.compare:
+		compare(*args.compare)
+		sys.exit(0)
+
+	# our own progress lines only, the stages are noisy at INFO
+	logging.getLogger().setLevel(logging.WARN)
+	log.setLevel(logging.INFO)
+
+	shapes = args.shapes.split(',')
+	for shape in shapes:
+		if shape not in synthtree.SHAPES:
+			doit.errExcept('unknown shape \'%s\'' % shape)
+
+	# createBootPackage finds the init scripts relative to the checkout
+	os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+	workdir = args.workdir or mkdtemp('all7fever-bench')
+	try:
+		bench = Benchmark(workdir, shapes, args.scale, args.seed, args.repeat, args.stages.split(',') if args.stages else None)
+		results = bench.run()
+	finally:
+		if args.workdir is None:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+	with open(args.output, 'w') as fh:
+		json.dump({'environment': environment(), 'scale': args.scale, 'seed': args.seed, 'repeat': args.repeat, 'results': results}, fh, indent=1, sort_keys=True)
+	log.info('results written to \'%s\'' % args.output)
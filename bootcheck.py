@@ -0,0 +1,191 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+Boots a conversion in qemu and checks that it comes up.
+
+	bootcheck.py output/
+	bootcheck.py --rootsplit output/
+
+serves OUTDIR over http (with Range requests, as the verified downloads
+need), boots OUTDIR/vmlinuz and OUTDIR/initrd.gz with the kernel line of
+OUTDIR/debian.gpxe pointed at that server and a serial console, and watches
+the console.  The boot passes once a login prompt shows up, or with
+--rootsplit (on by default if the gpxe script has rootsplit=1) once the init
+script says the rest of the root was extracted in the background, which
+it only says after the switch to the new root.  It fails on a kernel panic,
+on any of the init script's errors, or when --timeout runs out.  What was
+served is printed at the end, so a download that went wrong shows up too.
+"""
+
+import os
+import re
+import signal
+import sys
+import time
+import argparse
+import threading
+import subprocess
+import SocketServer
+import SimpleHTTPServer
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+GUEST_HOST = '10.0.2.2'	# the host as seen from qemu's user networking
+PASSED = {
+	'login': re.compile(r'login: *$'),
+	'rootsplit': re.compile(r'all7fever: rest of the root extracted'),
+}
+FAILED = re.compile(r'Kernel panic|all7fever: could not|could not download|giving up|cannot extract|extracting everything')
+
+
+class RangeHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+	"""SimpleHTTPRequestHandler with single Range requests, counting the bytes sent per path."""
+
+	def log_message(self, fmt, *args):
+		log.debug('http: ' + fmt % args)
+
+	def translate_path(self, path):
+		# the base class serves the working directory
+		path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+		return os.path.join(self.server.outdir, os.path.relpath(path, os.getcwd()))
+
+	def do_GET(self):
+		path = self.translate_path(self.path)
+		match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.getheader('range') or '')
+		if not match or not os.path.isfile(path):
+			return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+		size = os.path.getsize(path)
+		start = int(match.group(1))
+		end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+		if start > end:
+			self.send_error(416)
+			return
+		self.send_response(206)
+		self.send_header('Content-Type', 'application/octet-stream')
+		self.send_header('Content-Length', str(end - start + 1))
+		self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+		self.end_headers()
+		with open(path, 'rb') as fh:
+			fh.seek(start)
+			left = end - start + 1
+			while left > 0:
+				buf = fh.read(min(left, 1024 * 1024))
+				if not buf:
+					break
+				self.wfile.write(buf)
+				left -= len(buf)
+		self.server.count(self.path, end - start + 1 - left)
+
+	def copyfile(self, source, outputfile):
+		# whole files, see do_GET for ranges
+		before = source.tell()
+		SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+		self.server.count(self.path, source.tell() - before)
+
+class OutdirServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, outdir):
+		self.outdir = os.path.abspath(outdir)
+		self.lock = threading.Lock()
+		self.served = {}	# path -> [requests, bytes]
+		SocketServer.TCPServer.__init__(self, ('0.0.0.0', 0), RangeHandler)
+
+	def count(self, path, nbytes):
+		with self.lock:
+			served = self.served.setdefault(path, [0, 0])
+			served[0] += 1
+			served[1] += nbytes
+
+def serveOutdir(outdir):
+	server = OutdirServer(outdir)
+	t = threading.Thread(target=server.serve_forever, name='http')
+	t.daemon = True
+	t.start()
+	return server
+
+def kernelArgs(outdir, port):
+	"""The kernel line of OUTDIR/debian.gpxe, with its urls pointed at our server."""
+	with open(os.path.join(outdir, 'debian.gpxe'), 'r') as fh:
+		for line in fh:
+			if line.startswith('kernel '):
+				args = line.split()[2:]
+				break
+		else:
+			raise Exception('no kernel line in \'%s\'' % fh.name)
+	return [re.sub(r'http://[^/\s]+/', 'http://%s:%d/' % (GUEST_HOST, port), arg) for arg in args]
+
+def bootCheck(outdir, qemu='qemu-system-x86_64', memory=1024, timeout=600, extra=(), rootsplit=None):
+	server = serveOutdir(outdir)
+	args = kernelArgs(outdir, server.server_address[1]) + ['console=ttyS0'] + list(extra)
+	if rootsplit is None:
+		rootsplit = 'rootsplit=1' in args
+	elif rootsplit and 'rootsplit=1' not in args:
+		args.append('rootsplit=1')
+	passed = PASSED['rootsplit' if rootsplit else 'login']
+
+	cmd = [qemu, '-nographic', '-no-reboot', '-m', str(memory),
+		'-kernel', os.path.join(outdir, 'vmlinuz'), '-initrd', os.path.join(outdir, 'initrd.gz'),
+		'-append', ' '.join(args), '-netdev', 'user,id=net0', '-device', 'e1000,netdev=net0']
+	if os.access('/dev/kvm', os.R_OK | os.W_OK):
+		cmd.append('-enable-kvm')
+	log.info('booting \'%s\' with \'%s\'' % (outdir, ' '.join(args)))
+
+	# in its own process group, so whatever it started goes along with it
+	proc = subprocess.Popen(cmd, stdin=open(os.devnull, 'r'), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
+	kill = lambda: os.killpg(proc.pid, signal.SIGKILL)
+	timer = threading.Timer(timeout, kill)
+	timer.start()
+	result = None
+	started = time.time()
+	try:
+		line = ''
+		while result is None:
+			c = proc.stdout.read(1)
+			if not c:
+				break
+			if c != '\n':
+				line += c
+				# prompts don't end in a newline
+				if not passed.search(line):
+					continue
+			else:
+				sys.stdout.write(line + '\n')
+			if FAILED.search(line):
+				result = 'failed: %s' % line.strip()
+			elif passed.search(line):
+				result = 'passed: %s' % line.strip()
+			line = ''
+	finally:
+		timer.cancel()
+		if proc.poll() is None:
+			kill()
+		proc.wait()
+		server.shutdown()
+
+	if result is None:
+		result = 'failed: no verdict after %ds' % (time.time() - started)
+	for path, (requests, nbytes) in sorted(server.served.iteritems()):
+		size = os.path.getsize(os.path.join(outdir, path.lstrip('/')))
+		log.info('served %-40s %4d requests %12d bytes (%.2fx its size)' % (path, requests, nbytes, nbytes / float(max(1, size))))
+	log.info('boot %s in %.1fs' % (result, time.time() - started))
+	return result.startswith('passed')
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO, format='[%(asctime)s][%(levelname)s][%(name)s] %(message)s')
+
+	ap = argparse.ArgumentParser(description='boot a conversion in qemu and check that it comes up')
+	ap.add_argument('outdir', metavar='OUTDIR')
+	ap.add_argument('--qemu', dest='qemu', default='qemu-system-x86_64')
+	ap.add_argument('-m','--memory', dest='memory', type=int, default=1024, help='guest RAM in MB (default 1024)')
+	ap.add_argument('-t','--timeout', dest='timeout', type=float, default=600, help='seconds to wait for a verdict (default 600)')
+	ap.add_argument('--rootsplit', dest='rootsplit', action='store_true', default=None, help='boot with rootsplit=1 and wait for the rest of the root to be extracted')
+	ap.add_argument('-a','--append', dest='append', action='append', default=[], help='another kernel argument, eg. verify=0')
+	args = ap.parse_args()
+
+	sys.exit(0 if bootCheck(args.outdir, args.qemu, args.memory, args.timeout, args.append, args.rootsplit) else 1)
@@ -0,0 +1,203 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+Which files a node reads while it boots, so the archive can carry them
+first (doit.py --boottrace).
+
+A trace is a text file with one path per line, relative to the root, in
+the order the files were first read.  There are two ways to make one on a
+booted client:
+
+	boottrace.py atime -o boot.list
+		reads the access times of the root tmpfs.  the init script
+		extracts files with their archive mtime as atime too, so with
+		relatime (the default) every file read since boot has an atime
+		after the boot time, and sorting by it gives the read order.
+		run it once the node is up, no root needed.
+	boottrace.py record -o boot.list -t 120
+		watches every open and read on the root filesystem with
+		fanotify for the given time, run as root as early in boot as
+		possible (an rcS.d script).  catches files on filesystems
+		mounted noatime, too.
+
+Any list of paths works, a hand-written one included.
+"""
+
+import os
+import stat
+import time
+import select
+import ctypes
+import struct
+import argparse
+
+from treewalk import TreeWalker
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+FAN_CLASS_NOTIF = 0x0
+FAN_CLOEXEC = 0x1
+FAN_MARK_ADD = 0x1
+FAN_MARK_MOUNT = 0x10
+FAN_ACCESS = 0x1
+FAN_OPEN = 0x20
+FAN_EVENT_METADATA = struct.Struct('=IBBHQii')
+FAN_BUFFER = 64 * 1024
+AT_FDCWD = -100
+
+
+def bootTime():
+	with open('/proc/stat', 'r') as fh:
+		for line in fh:
+			if line.startswith('btime '):
+				return int(line.split()[1])
+	raise Exception('no btime in /proc/stat')
+
+def traceByAtime(root='/', since=None):
+	"""Regular files under root read since the given time (boot by default), in read order."""
+	since = bootTime() if since is None else since
+	read = []
+	dev = os.lstat(root).st_dev
+	stack = ['']
+	while stack:
+		reldir = stack.pop()
+		for name in os.listdir(os.path.join(root, reldir)):
+			relpath = os.path.join(reldir, name)
+			try:
+				st = os.lstat(os.path.join(root, relpath))
+			except OSError:
+				continue
+			if st.st_dev != dev:
+				# /proc, /sys and anything else mounted on the root
+				continue
+			if stat.S_ISDIR(st.st_mode):
+				stack.append(relpath)
+			elif stat.S_ISREG(st.st_mode) and st.st_atime >= since:
+				read.append((st.st_atime, relpath))
+	read.sort()
+	return [relpath for atime, relpath in read]
+
+def traceByFanotify(root='/', seconds=120):
+	"""Regular files on root's filesystem opened or read in the next few seconds, in order."""
+	libc = ctypes.CDLL(None, use_errno=True)
+	libc.fanotify_init.argtypes = [ctypes.c_uint, ctypes.c_uint]
+	libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+
+	fd = libc.fanotify_init(FAN_CLASS_NOTIF | FAN_CLOEXEC, os.O_RDONLY | os.O_LARGEFILE)
+	if fd < 0:
+		e = ctypes.get_errno()
+		raise OSError(e, 'fanotify_init: %s (needs root and CONFIG_FANOTIFY)' % os.strerror(e))
+	try:
+		if libc.fanotify_mark(fd, FAN_MARK_ADD | FAN_MARK_MOUNT, FAN_OPEN | FAN_ACCESS, AT_FDCWD, root) < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, 'fanotify_mark \'%s\': %s' % (root, os.strerror(e)))
+
+		seen = set()
+		order = []
+		me = os.getpid()
+		top = os.path.realpath(root).rstrip('/') + '/'
+		deadline = time.time() + seconds
+		while time.time() < deadline:
+			ready, w, x = select.select([fd], [], [], max(0, deadline - time.time()))
+			if not ready:
+				continue
+			buf = os.read(fd, FAN_BUFFER)
+			offset = 0
+			while offset + FAN_EVENT_METADATA.size <= len(buf):
+				length, vers, reserved, metalen, mask, eventfd, pid = FAN_EVENT_METADATA.unpack_from(buf, offset)
+				offset += length
+				if eventfd < 0:
+					continue
+				try:
+					if pid == me:
+						continue
+					path = os.readlink('/proc/self/fd/%d' % eventfd)
+					if path in seen or not path.startswith(top) or not stat.S_ISREG(os.fstat(eventfd).st_mode):
+						continue
+					seen.add(path)
+					order.append(path[len(top):])
+				except OSError:
+					pass
+				finally:
+					os.close(eventfd)
+		return order
+	finally:
+		os.close(fd)
+
+def writeTrace(path, relpaths):
+	with open(path, 'w') as fh:
+		for relpath in relpaths:
+			fh.write(relpath + '\n')
+
+def readTrace(path):
+	with open(path, 'r') as fh:
+		return [line.strip().strip('/') for line in fh if line.strip() and not line.startswith('#')]
+
+
+def splitTree(top, traced):
+	"""
+	Split the tree at top into what boot needs first and the rest,
+	returns (leading, rest) as lists of relpaths.  The leading segment is
+	every directory and symlink (cheap, and mountpoints and library paths
+	have to exist) followed by the traced files that are in the tree, in
+	trace order, with all the names of any that are hardlinked.  The rest
+	is everything else, in walk order.
+	"""
+	dirs = []
+	links = []
+	files = {}	# relpath -> (st_dev, st_ino)
+	names = {}	# (st_dev, st_ino) -> [relpath]
+	order = []
+	for relpath, st in TreeWalker(top):
+		if stat.S_ISDIR(st.st_mode):
+			dirs.append(relpath)
+		elif stat.S_ISLNK(st.st_mode):
+			links.append(relpath)
+		else:
+			key = (st.st_dev, st.st_ino)
+			files[relpath] = key
+			names.setdefault(key, []).append(relpath)
+			order.append(relpath)
+
+	leading = set()
+	bootfiles = []
+	missing = 0
+	for relpath in traced:
+		if relpath not in files:
+			missing += 1
+			continue
+		for name in names[files[relpath]]:
+			if name not in leading:
+				leading.add(name)
+				bootfiles.append(name)
+	if missing:
+		log.info('%d traced paths are not regular files in \'%s\', skipped' % (missing, top))
+
+	rest = [relpath for relpath in order if relpath not in leading]
+	log.info('boot segment: %d directories, %d symlinks and %d of %d files' % (len(dirs), len(links), len(bootfiles), len(order)))
+	return dirs + links + bootfiles, rest
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO, format='[%(asctime)s][%(levelname)s][%(name)s] %(message)s')
+
+	ap = argparse.ArgumentParser(description='record which files a booting node reads, for doit.py --boottrace')
+	sub = ap.add_subparsers(dest='command')
+	atime = sub.add_parser('atime', help='list files read since boot from their access times')
+	atime.add_argument('-r','--root', dest='root', default='/', help='root of the tree (default /)')
+	atime.add_argument('--since', dest='since', type=float, help='seconds since the epoch (default the boot time)')
+	atime.add_argument('-o','--output', dest='output', required=True)
+	record = sub.add_parser('record', help='record files opened or read with fanotify')
+	record.add_argument('-r','--root', dest='root', default='/', help='a mountpoint to watch (default /)')
+	record.add_argument('-t','--time', dest='seconds', type=float, default=120, help='seconds to record for (default 120)')
+	record.add_argument('-o','--output', dest='output', required=True)
+	args = ap.parse_args()
+
+	if args.command == 'atime':
+		traced = traceByAtime(args.root, args.since)
+	else:
+		traced = traceByFanotify(args.root, args.seconds)
+	writeTrace(args.output, traced)
+	log.info('%d files written to \'%s\'' % (len(traced), args.output))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent, size-bounded cache of build outputs keyed by their inputs.
+
+A key is the sha1 of everything that goes into a build: files, whole trees
+and plain strings (tool versions, options).  Each entry is the output file
+and a small json sidecar with whatever the caller wants back on a hit.
+Entries are used by hardlinking them into place, and the least recently
+used are evicted once the cache grows past its size bound.  Hits touch the
+entry's mtime, which is what "recently used" goes by, so the cache can be
+shared by several output directories and survives between runs.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+from treewalk import TreeWalker
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+HASH_BLOCK = 1024 * 1024
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def hashFile(h, path):
+	with open(path, 'rb') as fh:
+		while True:
+			buf = fh.read(HASH_BLOCK)
+			if not buf:
+				break
+			h.update(buf)
+
+
+class CacheKey(object):
+	"""Accumulates the inputs of a build, see BuildCache."""
+
+	def __init__(self):
+		self.h = hashlib.sha1()
+		self.inputs = []
+
+	def addString(self, name, value):
+		self.h.update('s %s %d\n%s\n' % (name, len(value), value))
+		self.inputs.append(name)
+		return self
+
+	def addFile(self, name, path):
+		self.h.update('f %s %d\n' % (name, os.path.getsize(path)))
+		hashFile(self.h, path)
+		self.inputs.append(name)
+		return self
+
+	def addTree(self, name, top):
+		"""Names, modes, link targets and contents of everything under top, in walk order."""
+		self.h.update('t %s\n' % name)
+		for relpath, st in TreeWalker(top):
+			path = os.path.join(top, relpath)
+			self.h.update('%s %o %d\n' % (relpath, st.st_mode, st.st_size))
+			if os.path.islink(path):
+				self.h.update(os.readlink(path) + '\n')
+			elif os.path.isfile(path):
+				hashFile(self.h, path)
+		self.inputs.append(name)
+		return self
+
+	def hexdigest(self):
+		return self.h.hexdigest()
+
+
+class BuildCache(object):
+	def __init__(self, path, maxbytes=DEFAULT_MAX_BYTES):
+		self.path = path
+		self.maxbytes = maxbytes
+		self.lock = threading.Lock()
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+	def entryPath(self, key):
+		return os.path.join(self.path, key)
+
+	def get(self, key, dst):
+		"""Put the output for key at dst; returns the entry's metadata, or None on a miss."""
+		entry = self.entryPath(key)
+		try:
+			with open(entry + '.json', 'r') as fh:
+				metadata = json.load(fh)
+			# link next to dst and rename over it, so whatever was at dst is never written through
+			tmp = dst + '.cached'
+			if os.path.exists(tmp):
+				os.unlink(tmp)
+			try:
+				os.link(entry, tmp)
+			except OSError:
+				shutil.copyfile(entry, tmp)
+			os.rename(tmp, dst)
+		except (IOError, OSError, ValueError):
+			return None
+		now = time.time()
+		os.utime(entry, (now, now))
+		return metadata
+
+	def put(self, key, src, metadata=None):
+		"""Store a copy of src as the output for key, then evict down to the size bound."""
+		entry = self.entryPath(key)
+		tmp = '%s.%d.%d.tmp' % (entry, os.getpid(), threading.current_thread().ident)
+		shutil.copyfile(src, tmp)
+		with open(tmp + '.json', 'w') as fh:
+			json.dump(metadata or {}, fh, indent=1, sort_keys=True)
+		os.rename(tmp + '.json', entry + '.json')
+		os.rename(tmp, entry)
+		self.evict()
+
+	def entries(self):
+		"""[(last used, size, key)] of every complete entry."""
+		out = []
+		for name in os.listdir(self.path):
+			if name.endswith('.json') or name.endswith('.tmp'):
+				continue
+			try:
+				st = os.stat(self.entryPath(name))
+			except OSError:
+				continue
+			out.append((st.st_mtime, st.st_size, name))
+		return out
+
+	def evict(self):
+		with self.lock:
+			entries = sorted(self.entries())
+			total = sum(size for used, size, key in entries)
+			# the newest entry stays even if it alone is over the bound
+			while total > self.maxbytes and len(entries) > 1:
+				used, size, key = entries.pop(0)
+				log.debug('evicting \'%s\' from the build cache at \'%s\'' % (key, self.path))
+				for path in (self.entryPath(key), self.entryPath(key) + '.json'):
+					if os.path.exists(path):
+						os.unlink(path)
+				total -= size
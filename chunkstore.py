@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed chunk store for delta boots.
+
+The uncompressed rootfs archive is cut into variable-sized chunks wherever a
+rolling hash of the last few bytes hits a boundary pattern, so an edit only
+changes the chunks around it and the boundaries after it fall where they fell
+before.  Each chunk is stored gzip-compressed under its SHA-1 (of the
+uncompressed data), and every published version gets a manifest listing its
+chunks in order.  Concatenated gzip members are a valid gzip stream, so a
+client rebuilds the archive by fetching the chunks it doesn't have and
+catting them together.
+
+Store layout::
+
+	STORE/chunks/ab/ab12...ef.gz	one chunk
+	STORE/manifests/VERSION		"sha1 size" per chunk, in order
+	STORE/latest			the name of the newest version
+"""
+
+import os
+import time
+import zlib
+import bisect
+import struct
+import random
+import hashlib
+import threading
+import collections
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+MIN_CHUNK = 64 * 1024
+AVG_CHUNK = 256 * 1024	# must be a power of two
+MAX_CHUNK = 1024 * 1024
+SEGMENT = 8 * 1024 * 1024	# bytes scanned for boundaries per task
+WINDOW = 32	# the gear hash only depends on this many trailing bytes
+GZIP_LEVEL = 9
+
+# gear hash table, fixed so boundaries are the same on every run and host
+_gearrandom = random.Random(0xa117f3e7)
+GEAR = tuple(_gearrandom.getrandbits(32) for i in range(256))
+del _gearrandom
+
+
+def gearCandidates(args):
+	"""
+	Offsets (relative to the start of buf, after the first skip bytes) where a
+	boundary may go, ie. where the gear hash of the preceding bytes has the
+	boundary pattern.  The hash shifts one bit per byte and keeps 32 bits, so
+	it only depends on the last 32 bytes and any segment can be scanned on its
+	own given that much lead-in.
+	"""
+	buf, skip, mask = args
+	gear = GEAR
+	h = 0
+	out = []
+	i = 0
+	for b in bytearray(buf):
+		h = ((h << 1) + gear[b]) & 0xffffffff
+		i += 1
+		if not h & mask and i > skip:
+			out.append(i - skip)
+	return out
+
+def chunks(fh, minsize=MIN_CHUNK, avgsize=AVG_CHUNK, maxsize=MAX_CHUNK, pool=None):
+	"""
+	Cut a stream into content-defined chunks, yields strings.  Boundary
+	candidates are found in parallel over segments of the stream by a
+	multiprocessing pool (one is made if not given); a chunk ends at the
+	first candidate at least minsize in, or at maxsize.
+	"""
+	# bit k of the hash depends on the last k+1 bytes, so test the high bits
+	bits = avgsize.bit_length() - 1
+	mask = ((1 << bits) - 1) << (32 - bits)
+
+	ownpool = pool is None
+	if ownpool:
+		pool = multiprocessing.Pool()
+	processes = len(pool._pool)
+
+	try:
+		pending = collections.deque()
+		lead = ''
+		eof = False
+
+		buf = ''
+		pos = 0		# start of the current chunk in buf
+		cands = []	# candidate boundaries, offsets into buf
+
+		while pending or not eof:
+			# keep every process busy but only a few segments in memory
+			while not eof and len(pending) < processes + 1:
+				seg = fh.read(SEGMENT)
+				if not seg:
+					eof = True
+					break
+				pending.append((seg, pool.apply_async(gearCandidates, ((lead + seg, len(lead), mask),))))
+				lead = seg[-WINDOW:]
+
+			if pending:
+				seg, result = pending.popleft()
+				buf = buf[pos:]
+				cands = [c - pos for c in cands]
+				pos = 0
+				base = len(buf)
+				buf += seg
+				cands.extend(base + c for c in result.get())
+
+			while pos < len(buf):
+				cut = pickCut(cands, pos, len(buf), minsize, maxsize)
+				if cut is None:
+					if pending or not eof:
+						break
+					cut = len(buf)
+				yield buf[pos:cut]
+				pos = cut
+	finally:
+		if ownpool:
+			pool.terminate()
+			pool.join()
+
+def pickCut(cands, start, buflen, minsize, maxsize):
+	"""Where the chunk starting at start ends, or None if that depends on bytes not read yet."""
+	i = bisect.bisect_left(cands, start + minsize)
+	if i < len(cands) and cands[i] <= start + maxsize:
+		return cands[i]
+	if buflen >= start + maxsize:
+		return start + maxsize
+	return None
+
+def compressChunk(data):
+	"""A standalone gzip member, with no name or timestamp so equal chunks compress equally."""
+	co = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+	body = co.compress(data) + co.flush()
+	return ('\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff' + body +
+		struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff))
+
+def verifyChunk(sha, gz):
+	"""Whether a compressed chunk, from wherever it came, is the one named sha."""
+	try:
+		data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(gz)
+	except zlib.error:
+		return False
+	return hashlib.sha1(data).hexdigest() == sha
+
+def parseManifest(lines):
+	"""Returns [(sha1, size)] in archive order."""
+	out = []
+	for line in lines:
+		line = line.strip()
+		if not line or line.startswith('#'):
+			continue
+		sha, size = line.split()
+		out.append((sha, int(size)))
+	return out
+
+def readManifest(path):
+	with open(path, 'r') as fh:
+		return parseManifest(fh)
+
+def versionKey(version):
+	"""Sort key for version names, so that 20240101120000.10 comes after 20240101120000.9."""
+	base, sep, n = version.rpartition('.')
+	if sep and n.isdigit():
+		return (base, int(n))
+	return (version, 0)
+
+
+class ChunkStore(object):
+	"""A directory of chunks and manifests, see the module docstring."""
+
+	def __init__(self, path):
+		self.path = path
+
+	def chunkPath(self, sha):
+		return os.path.join(self.path, 'chunks', sha[:2], sha + '.gz')
+
+	def manifestPath(self, version):
+		return os.path.join(self.path, 'manifests', version)
+
+	def latest(self):
+		try:
+			with open(os.path.join(self.path, 'latest'), 'r') as fh:
+				return fh.read().strip() or None
+		except IOError:
+			return None
+
+	def versions(self):
+		try:
+			names = os.listdir(os.path.join(self.path, 'manifests'))
+		except OSError:
+			return []
+		return sorted((name for name in names if not name.endswith('~')), key=versionKey)
+
+	def store(self, sha, data):
+		"""Write a chunk unless it is already there, returns the compressed size written (0 if not)."""
+		path = self.chunkPath(sha)
+		if os.path.exists(path):
+			return 0
+
+		gz = compressChunk(data)
+		tmp = '%s.%d.%d~' % (path, os.getpid(), threading.current_thread().ident)
+		with open(tmp, 'wb') as fh:
+			fh.write(gz)
+		os.rename(tmp, path)
+		return len(gz)
+
+	def publish(self, fh, version=None, workers=None):
+		"""
+		Chunk an uncompressed archive stream into the store under a new version
+		and make it the latest.  Without a version the name is the time, with
+		.1, .2 and so on appended if there was already one that second.
+		Returns (version, manifest entries, new chunks, compressed bytes added).
+		"""
+		if version is None:
+			base = version = time.strftime('%Y%m%d%H%M%S')
+			n = 0
+			while os.path.exists(self.manifestPath(version)):
+				n += 1
+				version = '%s.%d' % (base, n)
+		elif os.path.exists(self.manifestPath(version)):
+			raise Exception('version \'%s\' already exists in the chunk store at \'%s\'' % (version, self.path))
+
+		for d in ['manifests'] + ['chunks/%02x' % i for i in range(256)]:
+			if not os.path.isdir(os.path.join(self.path, d)):
+				os.makedirs(os.path.join(self.path, d))
+
+		entries = []
+		newchunks = [0, 0]
+
+		def add(data):
+			sha = hashlib.sha1(data).hexdigest()
+			return sha, len(data), self.store(sha, data)
+
+		def collect(result):
+			sha, size, written = result.get()
+			entries.append((sha, size))
+			if written:
+				newchunks[0] += 1
+				newchunks[1] += written
+
+		# the boundary scan needs processes, compression releases the GIL so
+		# threads will do; fork the processes before there are any threads
+		workers = workers or multiprocessing.cpu_count()
+		scanpool = multiprocessing.Pool(workers)
+		pool = ThreadPool(workers)
+		try:
+			pending = collections.deque()
+			for data in chunks(fh, pool=scanpool):
+				pending.append(pool.apply_async(add, (data,)))
+				while len(pending) > workers * 2:
+					collect(pending.popleft())
+			while pending:
+				collect(pending.popleft())
+		finally:
+			pool.terminate()
+			pool.join()
+			scanpool.terminate()
+			scanpool.join()
+
+		manifest = self.manifestPath(version)
+		with open(manifest + '~', 'w') as out:
+			out.write('# all7fever chunk manifest, version %s\n' % version)
+			out.write('# %d chunks, %d bytes\n' % (len(entries), sum(size for sha, size in entries)))
+			for sha, size in entries:
+				out.write('%s %d\n' % (sha, size))
+		os.rename(manifest + '~', manifest)
+
+		latest = os.path.join(self.path, 'latest')
+		with open(latest + '~', 'w') as out:
+			out.write(version + '\n')
+		os.rename(latest + '~', latest)
+
+		log.info('published version \'%s\': %d chunks, %d new (%d bytes compressed)' % (version, len(entries), newchunks[0], newchunks[1]))
+		return version, entries, newchunks[0], newchunks[1]
+
+	def prune(self, keep):
+		"""Delete all but the newest keep versions and the chunks only they used, returns the number of chunks removed."""
+		if keep < 1:
+			raise Exception('the chunk store at \'%s\' must keep at least the latest version' % self.path)
+		for version in self.versions()[:-keep]:
+			os.unlink(self.manifestPath(version))
+			log.debug('pruned version \'%s\' from the chunk store at \'%s\'' % (version, self.path))
+
+		live = set()
+		for version in self.versions():
+			live.update(sha for sha, size in readManifest(self.manifestPath(version)))
+
+		removed = 0
+		chunkdir = os.path.join(self.path, 'chunks')
+		for sub in os.listdir(chunkdir):
+			for name in os.listdir(os.path.join(chunkdir, sub)):
+				if name.endswith('.gz') and name[:-3] not in live:
+					os.unlink(os.path.join(chunkdir, sub, name))
+					removed += 1
+		return removed
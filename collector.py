@@ -0,0 +1,191 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+Collects boot telemetry from stateless clients and reports boot time
+percentiles per image version.
+
+Clients booted with ``telemetry=http://host:port`` (doit.py --telemetry)
+POST a report to /boot once they reach multi-user.  A report is plain text,
+one record per line, times in seconds since the kernel started:
+
+	value image 20121021133700	the image version, from imageversion=
+	value mountroot 3.10		when the init script took over
+	stage network 3.10 5.42		begin and end of a stage
+	value root.compressed_bytes 171234567
+	stage boot 0 24.77		until rc2.d ran our script
+
+Reports are appended to a file, one json object per line, with the
+client's address and the time received.  GET /report gives the table that
+``collector.py report`` prints, GET /report.json the same as json.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from StringIO import StringIO
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+PERCENTILES = (50, 90, 99)
+MAX_REPORT = 64 * 1024
+
+
+def parseReport(text):
+	"""{'image': ..., 'stages': {name: seconds}, 'values': {name: value}} from a client's report."""
+	stages = {}
+	values = {}
+	for line in text.splitlines():
+		fields = line.split()
+		try:
+			if len(fields) == 4 and fields[0] == 'stage':
+				stages[fields[1]] = round(float(fields[3]) - float(fields[2]), 3)
+			elif len(fields) == 3 and fields[0] == 'value':
+				try:
+					values[fields[1]] = float(fields[2]) if '.' in fields[2] else int(fields[2])
+				except ValueError:
+					values[fields[1]] = fields[2]
+		except ValueError:
+			log.debug('skipping bad telemetry line \'%s\'' % line)
+	return {'image': str(values.pop('image', 'unknown')), 'stages': stages, 'values': values}
+
+def percentile(ordered, p):
+	"""Linear interpolation between closest ranks, ordered must be sorted and not empty."""
+	if len(ordered) == 1:
+		return ordered[0]
+	rank = (len(ordered) - 1) * p / 100.0
+	low = int(rank)
+	high = min(low + 1, len(ordered) - 1)
+	return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def readReports(path):
+	reports = []
+	if not os.path.exists(path):
+		return reports
+	with open(path, 'r') as fh:
+		for line in fh:
+			if line.strip():
+				reports.append(json.loads(line))
+	return reports
+
+def aggregate(reports):
+	"""{image: {'boots': n, 'last': time, 'stages': {name: {'count', 'p50', ...}}, 'values': {...}}}"""
+	byimage = {}
+	for report in reports:
+		image = byimage.setdefault(report['image'], {'boots': 0, 'last': 0, 'stages': {}, 'values': {}})
+		image['boots'] += 1
+		image['last'] = max(image['last'], report.get('received', 0))
+		for name, seconds in report['stages'].iteritems():
+			image['stages'].setdefault(name, []).append(seconds)
+		for name, value in report['values'].iteritems():
+			if isinstance(value, (int, float)):
+				image['values'].setdefault(name, []).append(value)
+
+	for image in byimage.itervalues():
+		for kind in ('stages', 'values'):
+			for name, samples in image[kind].items():
+				samples.sort()
+				summary = {'count': len(samples)}
+				for p in PERCENTILES:
+					summary['p%d' % p] = round(percentile(samples, p), 3)
+				image[kind][name] = summary
+	return byimage
+
+def formatReport(byimage, fh):
+	# oldest image first, so the effect of each new one reads downwards
+	for name, image in sorted(byimage.iteritems(), key=lambda item: item[1]['last']):
+		fh.write('image %s: %d boots, last %s\n' % (name, image['boots'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(image['last']))))
+		fh.write('   %-32s %6s %10s %10s %10s\n' % ('stage', 'boots', 'p50', 'p90', 'p99'))
+		for stage, s in sorted(image['stages'].iteritems(), key=lambda item: item[1]['p50']):
+			fh.write('   %-32s %6d %9.2fs %9.2fs %9.2fs\n' % (stage, s['count'], s['p50'], s['p90'], s['p99']))
+		for value, s in sorted(image['values'].iteritems()):
+			fh.write('   %-32s %6d %10d %10d %10d\n' % (value, s['count'], s['p50'], s['p90'], s['p99']))
+		fh.write('\n')
+
+
+class CollectorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def log_message(self, fmt, *args):
+		log.debug('http: ' + fmt % args)
+
+	def reply(self, code, body, ctype='text/plain'):
+		self.send_response(code)
+		self.send_header('Content-Type', ctype)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_POST(self):
+		if self.path.rstrip('/') != '/boot':
+			return self.reply(404, 'not found\n')
+		length = int(self.headers.getheader('content-length') or 0)
+		if length > MAX_REPORT:
+			return self.reply(413, 'too large\n')
+		report = parseReport(self.rfile.read(length))
+		report['client'] = self.client_address[0]
+		report['received'] = time.time()
+		self.server.record(report)
+		log.info('boot report from %s, image %s, %s' % (report['client'], report['image'],
+			', '.join('%s %.2fs' % kv for kv in sorted(report['stages'].iteritems()))))
+		self.reply(200, 'ok\n')
+
+	def do_GET(self):
+		path = self.path.rstrip('/')
+		if path == '/report.json':
+			self.reply(200, json.dumps(aggregate(self.server.reports()), indent=1, sort_keys=True), 'application/json')
+		elif path in ('', '/report'):
+			out = StringIO()
+			formatReport(aggregate(self.server.reports()), out)
+			self.reply(200, out.getvalue())
+		else:
+			self.reply(404, 'not found\n')
+
+class Collector(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, datafile):
+		self.datafile = datafile
+		self.lock = threading.Lock()
+		BaseHTTPServer.HTTPServer.__init__(self, address, CollectorHandler)
+
+	def record(self, report):
+		with self.lock:
+			with open(self.datafile, 'a') as fh:
+				fh.write(json.dumps(report, sort_keys=True) + '\n')
+
+	def reports(self):
+		with self.lock:
+			return readReports(self.datafile)
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO, format='[%(asctime)s][%(levelname)s][%(name)s] %(message)s')
+
+	ap = argparse.ArgumentParser(description='collect boot telemetry from stateless clients')
+	sub = ap.add_subparsers(dest='command')
+	serve = sub.add_parser('serve', help='accept reports over http')
+	serve.add_argument('-p','--port', dest='port', type=int, default=9091)
+	serve.add_argument('-d','--data', dest='data', default='telemetry.jsonl', help='where reports are kept (default telemetry.jsonl)')
+	report = sub.add_parser('report', help='print percentiles per image version')
+	report.add_argument('-d','--data', dest='data', default='telemetry.jsonl')
+	report.add_argument('--json', dest='json', action='store_true')
+	args = ap.parse_args()
+
+	if args.command == 'serve':
+		server = Collector(('0.0.0.0', args.port), args.data)
+		log.info('collecting boot reports on port %d into \'%s\'' % (args.port, args.data))
+		server.serve_forever()
+	else:
+		byimage = aggregate(readReports(args.data))
+		if args.json:
+			json.dump(byimage, sys.stdout, indent=1, sort_keys=True)
+			sys.stdout.write('\n')
+		else:
+			formatReport(byimage, sys.stdout)
@@ -0,0 +1,439 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+Keeps the conversions of a directory of images up to date.
+
+	daemon.py serve images/ output/ -- --chunkstore /srv/store
+
+converts every image in images/ into output/NAME (NAME being the image's
+file name without its extension) and watches the directory with inotify.
+Once an image has been written and then left alone for a few seconds
+(--settle), it is converted again: with --update, so only the files that
+changed are synced into output/NAME/rootfs and the archive and boot
+resources are only rebuilt if something they depend on changed.  Anything
+after -- goes to doit.py as is.  Conversions from scratch (the first one,
+and every one with --direct or --cpiocopy) are made next to output/NAME and swapped in
+when they're done, so the web server never sees a half-written directory.
+
+Conversions run in this process one at a time, so what doit.py learns about
+the host and the images stays between them: where each tool is, blkid
+results for partitions that didn't change, and what file(1) said about
+kernels and initrds that didn't change.  The image each output was built
+from is recorded in its metadata.json, so restarting the daemon only
+converts what changed while it was down.
+
+The daemon answers on a unix socket (output/daemon.sock by default), one
+command per connection:
+
+	daemon.py status -s output/daemon.sock		every image and its last conversion, as json
+	daemon.py trigger -s output/daemon.sock NAME	convert NAME now, changed or not
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import Queue
+import shutil
+import select
+import signal
+import socket
+import struct
+import ctypes
+import argparse
+import threading
+import SocketServer
+
+import doit
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_CLOEXEC = 0x80000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_BUFFER = 64 * 1024
+
+IMAGE_SUFFIXES = ('.vdi', '.qcow2', '.vmdk', '.img', '.raw')
+SETTLE_SECONDS = 10.0
+RESCAN_SECONDS = 60.0	# in case inotify misses something (network filesystems)
+MAX_COMMAND = 4096
+
+
+def imageName(filename):
+	"""The output name for an image file, or None if it isn't one."""
+	root, ext = os.path.splitext(filename)
+	if filename.startswith('.') or ext.lower() not in IMAGE_SUFFIXES:
+		return None
+	return root
+
+def imageIdentity(path):
+	"""What has to stay the same for a conversion to still be current: [mtime, size]."""
+	st = os.stat(path)
+	return [st.st_mtime, st.st_size]
+
+def builtIdentity(outdir):
+	try:
+		with open(os.path.join(outdir, 'metadata.json'), 'r') as fh:
+			source = json.load(fh).get('source')
+	except (IOError, ValueError):
+		return None
+	return source and source.get('identity')
+
+
+class Inotify(object):
+	def __init__(self, path, mask=WATCH_MASK):
+		libc = ctypes.CDLL(None, use_errno=True)
+		libc.inotify_init1.argtypes = [ctypes.c_int]
+		libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+		self.fd = libc.inotify_init1(IN_CLOEXEC)
+		if self.fd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, 'inotify_init1: %s' % os.strerror(e))
+		if libc.inotify_add_watch(self.fd, path, mask) < 0:
+			e = ctypes.get_errno()
+			os.close(self.fd)
+			raise OSError(e, 'inotify_add_watch \'%s\': %s' % (path, os.strerror(e)))
+
+	def read(self, timeout):
+		"""[(mask, name)] of the events within timeout seconds."""
+		try:
+			ready, w, x = select.select([self.fd], [], [], timeout)
+		except select.error, e:
+			if e.args[0] != errno.EINTR:
+				raise
+			return []
+		if not ready:
+			return []
+		buf = os.read(self.fd, INOTIFY_BUFFER)
+		events = []
+		offset = 0
+		while offset + INOTIFY_EVENT.size <= len(buf):
+			wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+			offset += INOTIFY_EVENT.size
+			name = buf[offset:offset + length].rstrip('\0')
+			offset += length
+			events.append((mask, name))
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+
+class ImageState(object):
+	def __init__(self, name, image, outdir):
+		self.name = name
+		self.image = image
+		self.outdir = outdir
+		self.state = 'idle'	# waiting (to settle), queued, building, failed, gone
+		self.changed = None	# when the image was last seen changing
+		self.built = builtIdentity(outdir)
+		self.builds = 0
+		self.last = None
+
+	def todict(self):
+		return {'image': self.image, 'outdir': self.outdir, 'state': self.state, 'built': self.built, 'builds': self.builds, 'last': self.last}
+
+
+class ConversionDaemon(object):
+	def __init__(self, imagedir, outroot, doitargs=(), settle=SETTLE_SECONDS):
+		self.imagedir = os.path.abspath(imagedir)
+		self.outroot = os.path.abspath(outroot)
+		self.doitargs = list(doitargs)
+		self.settle = settle
+		self.lock = threading.Lock()
+		self.images = {}	# name -> ImageState
+		self.queue = Queue.Queue()
+
+		# fail now rather than at the first conversion
+		parsed = doit.argParser().parse_args(self.doitargs + ['IMAGE', 'OUTDIR'])
+		# --update only syncs a rootfs copy made the in-process way
+		self.updates = not parsed.direct and not parsed.cpiocopy
+		if parsed.update or parsed.onlypack or parsed.onlyboot or parsed.plan:
+			raise Exception('the daemon decides on --update itself, and --onlypack, --onlyboot and --plan don\'t make sense here')
+
+	def status(self):
+		with self.lock:
+			return dict((name, state.todict()) for name, state in self.images.iteritems())
+
+	def enqueue(self, state, why):
+		"""call with the lock held"""
+		if state.state in ('queued', 'building'):
+			return
+		log.info('converting \'%s\': %s' % (state.name, why))
+		state.state = 'queued'
+		self.queue.put(state.name)
+
+	def trigger(self, name):
+		with self.lock:
+			state = self.images.get(name)
+			if state is None or state.state == 'gone':
+				return False
+			self.enqueue(state, 'asked to')
+			return True
+
+	def scan(self):
+		"""Pick up images that appeared, and any that changed since they were last converted."""
+		seen = set()
+		for filename in sorted(os.listdir(self.imagedir)):
+			name = imageName(filename)
+			path = os.path.join(self.imagedir, filename)
+			if name is None or not os.path.isfile(path):
+				continue
+			try:
+				identity = imageIdentity(path)
+			except OSError:
+				continue
+			seen.add(name)
+			with self.lock:
+				state = self.images.get(name)
+				if state is None or state.image != path:
+					state = self.images[name] = ImageState(name, path, os.path.join(self.outroot, name))
+				if state.state == 'gone':
+					state.state = 'idle'
+				if state.state in ('idle', 'failed') and state.built != identity:
+					# a failed conversion is retried when the image changes again, or on trigger
+					if state.state == 'idle' or state.last is None or state.last.get('identity') != identity:
+						state.state = 'waiting'
+						state.changed = time.time()
+		with self.lock:
+			for name, state in self.images.iteritems():
+				if name not in seen and state.state != 'gone':
+					log.info('image for \'%s\' is gone, keeping its output' % name)
+					state.state = 'gone'
+
+	def changed(self, filename, mask):
+		name = imageName(filename)
+		if name is None:
+			return
+		if mask & (IN_DELETE | IN_MOVED_FROM):
+			self.scan()
+			return
+		with self.lock:
+			state = self.images.get(name)
+			if state is None or state.state == 'gone':
+				state = None
+			elif state.state in ('idle', 'failed', 'waiting'):
+				state.state = 'waiting'
+				state.changed = time.time()
+			elif state.state == 'building':
+				# noticed again once this conversion finishes
+				state.changed = time.time()
+		if state is None:
+			self.scan()
+
+	def settled(self):
+		"""Queue the images that stopped changing."""
+		now = time.time()
+		with self.lock:
+			for state in self.images.itervalues():
+				if state.state == 'waiting' and now - state.changed >= self.settle:
+					try:
+						identity = imageIdentity(state.image)
+					except OSError:
+						state.state = 'gone'
+						continue
+					if state.built != identity:
+						self.enqueue(state, 'image changed')
+					else:
+						state.state = 'idle'
+
+	def watch(self):
+		inotify = Inotify(self.imagedir)
+		try:
+			self.scan()
+			lastscan = time.time()
+			while True:
+				for mask, filename in inotify.read(1.0):
+					self.changed(filename, mask)
+				if time.time() - lastscan >= RESCAN_SECONDS:
+					self.scan()
+					lastscan = time.time()
+				self.settled()
+		finally:
+			inotify.close()
+
+	def builder(self):
+		while True:
+			name = self.queue.get()
+			with self.lock:
+				state = self.images[name]
+				if state.state != 'queued':
+					continue
+				state.state = 'building'
+			try:
+				self.build(state)
+			except Exception, e:
+				# never let one image stop the conversions of the others
+				log.exception('converting \'%s\' failed' % state.name)
+				with self.lock:
+					state.state = 'failed'
+					state.last = {'started': time.time(), 'error': str(e)}
+
+	def build(self, state):
+		started = time.time()
+		try:
+			identity = imageIdentity(state.image)
+		except OSError, e:
+			# deleted or renamed since it was queued, the rename shows up as a new image
+			log.info('image for \'%s\' is gone, not converting it: %s' % (state.name, e))
+			with self.lock:
+				state.state = 'gone'
+			return
+		update = self.updates and os.path.isdir(os.path.join(state.outdir, 'rootfs'))
+		last = {'started': started, 'identity': identity, 'mode': 'update' if update else 'full'}
+		try:
+			if update:
+				status = doit.convert(doit.argParser().parse_args(self.doitargs + ['--update', state.image, state.outdir]))
+				with open(os.path.join(state.outdir, 'changes.txt'), 'r') as fh:
+					last['changes'] = sum(1 for line in fh)
+			else:
+				status = self.buildFresh(state)
+			if status != 0:
+				raise Exception('doit.py exited with %d' % status)
+			doit.updateMetadata(state.outdir, 'source', {'image': state.image, 'identity': identity})
+		except Exception, e:
+			log.exception('converting \'%s\' failed' % state.name)
+			last['error'] = str(e)
+
+		last['seconds'] = round(time.time() - started, 3)
+		log.info('%s conversion of \'%s\' %s in %.1fs' % (last['mode'], state.name, 'failed' if 'error' in last else 'done', last['seconds']))
+		with self.lock:
+			state.builds += 1
+			state.last = last
+			if 'error' in last:
+				state.state = 'failed'
+			else:
+				state.built = identity
+				state.state = 'idle'
+			# written to while we were converting, do it again once it settles
+			try:
+				if imageIdentity(state.image) != identity:
+					state.state = 'waiting'
+					state.changed = time.time()
+			except OSError:
+				state.state = 'gone'
+
+	def buildFresh(self, state):
+		"""Convert from scratch next to the output directory and swap it in."""
+		building = os.path.join(self.outroot, '.%s.building' % state.name)
+		old = os.path.join(self.outroot, '.%s.old' % state.name)
+		for leftover in (building, old):
+			if os.path.exists(leftover):
+				shutil.rmtree(leftover)
+		status = doit.convert(doit.argParser().parse_args(self.doitargs + [state.image, building]))
+		if status != 0:
+			return status
+		if os.path.exists(state.outdir):
+			os.rename(state.outdir, old)
+		os.rename(building, state.outdir)
+		if os.path.exists(old):
+			shutil.rmtree(old)
+		return 0
+
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+	def handle(self):
+		words = self.rfile.readline(MAX_COMMAND).split()
+		if words == ['status']:
+			reply = {'images': self.server.daemon.status()}
+		elif len(words) == 2 and words[0] == 'trigger':
+			if self.server.daemon.trigger(words[1]):
+				reply = {'queued': words[1]}
+			else:
+				reply = {'error': 'no image \'%s\'' % words[1]}
+		else:
+			reply = {'error': 'unknown command, try status or trigger NAME'}
+		self.wfile.write(json.dumps(reply, indent=1, sort_keys=True) + '\n')
+
+class CommandServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, path, daemon):
+		self.daemon = daemon
+		# a socket left over from a daemon that died, unless one is still answering on it
+		if os.path.exists(path):
+			probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				probe.connect(path)
+			except socket.error, e:
+				if e.errno != errno.ECONNREFUSED:
+					raise
+				os.unlink(path)
+			else:
+				raise Exception('another daemon is answering on \'%s\'' % path)
+			finally:
+				probe.close()
+		SocketServer.UnixStreamServer.__init__(self, path, CommandHandler)
+
+def sendCommand(path, command):
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		s.connect(path)
+		s.sendall(command + '\n')
+		out = []
+		while True:
+			buf = s.recv(65536)
+			if not buf:
+				break
+			out.append(buf)
+		return ''.join(out)
+	finally:
+		s.close()
+
+def serve(args):
+	if not os.path.isdir(args.outroot):
+		os.makedirs(args.outroot)
+	daemon = ConversionDaemon(args.imagedir, args.outroot, args.doitargs, args.settle)
+
+	sockpath = args.socket or os.path.join(args.outroot, 'daemon.sock')
+	server = CommandServer(sockpath, daemon)
+	threads = [threading.Thread(target=server.serve_forever, name='commands'), threading.Thread(target=daemon.builder, name='builder')]
+	for t in threads:
+		t.daemon = True
+		t.start()
+
+	log.info('watching \'%s\' for images, converting into \'%s\', commands on \'%s\'' % (args.imagedir, args.outroot, sockpath))
+	try:
+		daemon.watch()
+	finally:
+		server.server_close()
+		os.unlink(sockpath)
+
+
+if __name__ == '__main__':
+	ap = argparse.ArgumentParser(description='keep the conversions of a directory of images up to date')
+	sub = ap.add_subparsers(dest='command')
+	servep = sub.add_parser('serve', help='watch a directory of images and convert them as they change, options for doit.py go after --')
+	servep.add_argument('imagedir', metavar='IMAGEDIR')
+	servep.add_argument('outroot', metavar='OUTROOT', help='each image is converted into OUTROOT/NAME')
+	servep.add_argument('-s','--socket', dest='socket', help='the command socket (default OUTROOT/daemon.sock)')
+	servep.add_argument('--settle', dest='settle', type=float, default=SETTLE_SECONDS, help='seconds an image must be left alone before it is converted (default %(default)s)')
+	statusp = sub.add_parser('status', help='print every image and its last conversion')
+	statusp.add_argument('-s','--socket', dest='socket', required=True, help='the command socket, OUTROOT/daemon.sock unless serve was given another')
+	triggerp = sub.add_parser('trigger', help='convert an image now')
+	triggerp.add_argument('name', metavar='NAME')
+	triggerp.add_argument('-s','--socket', dest='socket', required=True, help='the command socket, OUTROOT/daemon.sock unless serve was given another')
+	# everything after -- is for doit.py, argparse would take it for ours
+	argv = sys.argv[1:]
+	doitargs = argv[argv.index('--') + 1:] if '--' in argv else []
+	args = ap.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+	args.doitargs = doitargs
+
+	if args.command == 'serve':
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+		serve(args)
+	elif args.command == 'status':
+		sys.stdout.write(sendCommand(args.socket, 'status'))
+	else:
+		sys.stdout.write(sendCommand(args.socket, 'trigger %s' % args.name))
@@ -0,0 +1,550 @@
+# -*- coding: utf-8 -*-
+"""
+Userspace access to virtual disk images and the partitions on them.
+
+An image is anything with a ``size`` and a ``pread(offset, length)``; reads
+past the end or from unallocated regions return zeros.  ``partitions()``
+parses the MBR (including logical partitions) or GPT of an image and returns
+``Partition`` views that have the same interface, so filesystem readers can
+work on a partition byte range without loop devices or FUSE.
+
+``openImage`` picks the reader from the file's magic: VirtualBox VDI, qcow2
+(v2 and v3, compressed clusters and backing files included), VMDK (sparse
+and stream-optimized extents, or a descriptor listing sparse, flat and zero
+extents) and anything else as a raw disk.  Image files are mmapped, and the
+qcow2 L2 tables, VMDK grain tables and decompressed clusters are kept in
+small LRU caches, since filesystem reads come a block at a time and mostly
+land near each other.
+"""
+
+import os
+import re
+import mmap
+import zlib
+import struct
+import threading
+import collections
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+SECTOR_SIZE = 512
+
+VDI_SIGNATURE = 0xbeda107f
+VDI_TYPE_NORMAL = 1
+VDI_TYPE_FIXED = 2
+VDI_BLOCK_FREE = 0xffffffff
+VDI_BLOCK_ZERO = 0xfffffffe
+
+QCOW2_MAGIC = 'QFI\xfb'
+QCOW2_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+QCOW2_COMPRESSED = 1 << 62
+QCOW2_ZERO = 1
+QCOW2_INCOMPAT_CORRUPT = 1 << 1
+QCOW2_INCOMPAT_DATA_FILE = 1 << 2
+QCOW2_INCOMPAT_COMPRESSION = 1 << 3
+QCOW2_INCOMPAT_EXTL2 = 1 << 4
+QCOW2_INCOMPAT_KNOWN = 0x1f
+
+VMDK_MAGIC = 'KDMV'
+VMDK_HEADER = struct.Struct('<4sIIQQQQIQQQB4sH')
+VMDK_DESCRIPTOR = '# Disk DescriptorFile'
+VMDK_FLAG_COMPRESSED = 1 << 16
+VMDK_GD_AT_END = 0xffffffffffffffff
+VMDK_EXTENT = re.compile(r'^(RW|RDONLY|NOACCESS)\s+(\d+)\s+(SPARSE|FLAT|ZERO|VMFS)(?:\s+"([^"]*)"(?:\s+(\d+))?)?')
+
+L2_CACHE_TABLES = 64	# qcow2 L2 / VMDK grain tables, 64 covers 32G of a qcow2 with 64k clusters
+CLUSTER_CACHE = 32	# decompressed clusters and grains
+
+MBR_EXTENDED_TYPES = (0x05, 0x0f, 0x85)
+MBR_GPT_PROTECTIVE = 0xee
+
+
+class DiskImage(object):
+	"""Base class for image readers."""
+	size = 0
+
+	def pread(self, offset, length):
+		raise NotImplementedError()
+
+	def close(self):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_details):
+		self.close()
+
+
+class MappedFile(object):
+	"""A read-only mmap of a whole file, reads past its end come back as zeros."""
+
+	def __init__(self, path):
+		self.path = path
+		self.fh = open(path, 'rb')
+		self.size = os.fstat(self.fh.fileno()).st_size
+		# an empty file can't be mapped
+		self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ) if self.size else ''
+
+	def read(self, offset, length):
+		return self.map[offset:offset + length].ljust(length, '\0')
+
+	def close(self):
+		if self.size:
+			self.map.close()
+		self.fh.close()
+
+class LRUCache(object):
+	"""The last few values of an expensive function of one key."""
+
+	def __init__(self, load, capacity):
+		self.load = load
+		self.capacity = capacity
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		with self.lock:
+			if key in self.entries:
+				self.hits += 1
+				value = self.entries.pop(key)
+				self.entries[key] = value
+				return value
+			self.misses += 1
+		# loaded outside the lock, two threads may both load a key but never block each other
+		value = self.load(key)
+		with self.lock:
+			self.entries[key] = value
+			while len(self.entries) > self.capacity:
+				self.entries.popitem(last=False)
+		return value
+
+
+class RawImage(DiskImage):
+	"""A raw disk image (dd, qemu raw), read through mmap."""
+
+	def __init__(self, path):
+		self.path = path
+		self.file = MappedFile(path)
+		self.size = self.file.size
+		log.debug('raw image \'%s\': %d bytes' % (path, self.size))
+
+	def pread(self, offset, length):
+		length = max(0, min(length, self.size - offset))
+		return self.file.read(offset, length)
+
+	def close(self):
+		self.file.close()
+
+
+class VDIImage(DiskImage):
+	"""Read-only VirtualBox VDI reader (normal and fixed images, no differencing)."""
+
+	def __init__(self, path):
+		self.path = path
+		self.file = MappedFile(path)
+
+		hdr = self.file.read(0, 0x200)
+		if self.file.size < 0x190:
+			raise Exception('\'%s\' is too short to be a VDI image' % path)
+
+		signature, version = struct.unpack_from('<II', hdr, 0x40)
+		if signature != VDI_SIGNATURE:
+			raise Exception('\'%s\' is not a VDI image (bad signature 0x%08x)' % (path, signature))
+		if version >> 16 != 1:
+			raise Exception('unsupported VDI version %d.%d in \'%s\'' % (version >> 16, version & 0xffff, path))
+
+		(self.imagetype,) = struct.unpack_from('<I', hdr, 0x4c)
+		self.offblocks, self.offdata = struct.unpack_from('<II', hdr, 0x154)
+		(self.size,) = struct.unpack_from('<Q', hdr, 0x170)
+		self.blocksize, self.blockextra, self.blockcount = struct.unpack_from('<III', hdr, 0x178)
+
+		if self.imagetype not in (VDI_TYPE_NORMAL, VDI_TYPE_FIXED):
+			raise Exception('VDI image type %d in \'%s\' is not supported (differencing/undo images need their parent)' % (self.imagetype, path))
+
+		raw = self.file.read(self.offblocks, 4 * self.blockcount)
+		self.blockmap = struct.unpack('<%dI' % self.blockcount, raw)
+
+		log.debug('VDI \'%s\': %d bytes, %d blocks of %d' % (path, self.size, self.blockcount, self.blocksize))
+
+	def pread(self, offset, length):
+		length = max(0, min(length, self.size - offset))
+		out = []
+		while length > 0:
+			blockidx, within = divmod(offset, self.blocksize)
+			n = min(length, self.blocksize - within)
+			entry = self.blockmap[blockidx]
+			if entry in (VDI_BLOCK_FREE, VDI_BLOCK_ZERO):
+				out.append('\0' * n)
+			else:
+				pos = self.offdata + entry * (self.blocksize + self.blockextra) + self.blockextra + within
+				out.append(self.file.read(pos, n))
+			offset += n
+			length -= n
+		return ''.join(out)
+
+	def close(self):
+		self.file.close()
+
+
+class QCOW2Image(DiskImage):
+	"""
+	Read-only qcow2 reader, versions 2 and 3.  Unallocated clusters are read
+	from the backing file if there is one, zlib-compressed clusters are
+	inflated; snapshots are ignored, the active image is what's read.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.file = MappedFile(path)
+		self.backing = None
+
+		hdr = self.file.read(0, 112)
+		(magic, self.version, backingoffset, backingsize, self.clusterbits, self.size, cryptmethod,
+			l1size, l1offset, refcountoffset, refcountclusters, snapshots, snapshotsoffset) = QCOW2_HEADER.unpack_from(hdr)
+		if magic != QCOW2_MAGIC:
+			raise Exception('\'%s\' is not a qcow2 image' % path)
+		if self.version not in (2, 3):
+			raise Exception('unsupported qcow2 version %d in \'%s\'' % (self.version, path))
+		if cryptmethod != 0:
+			raise Exception('\'%s\' is encrypted, decrypt it with qemu-img convert first' % path)
+
+		if self.version >= 3:
+			(incompatible,) = struct.unpack_from('>Q', hdr, 72)
+			(headerlength,) = struct.unpack_from('>I', hdr, 100)
+			if incompatible & ~QCOW2_INCOMPAT_KNOWN:
+				raise Exception('\'%s\' uses qcow2 features this reader doesn\'t know (0x%x)' % (path, incompatible))
+			if incompatible & QCOW2_INCOMPAT_CORRUPT:
+				raise Exception('\'%s\' is marked corrupt, repair it with qemu-img check -r all' % path)
+			if incompatible & (QCOW2_INCOMPAT_DATA_FILE | QCOW2_INCOMPAT_EXTL2):
+				raise Exception('\'%s\' has an external data file or extended L2 entries, which are not supported' % path)
+			if incompatible & QCOW2_INCOMPAT_COMPRESSION and headerlength > 104 and ord(hdr[104]) != 0:
+				raise Exception('\'%s\' compresses clusters with zstd, only zlib is supported' % path)
+
+		self.clustersize = 1 << self.clusterbits
+		self.l2entries = self.clustersize / 8
+		self.l1 = struct.unpack('>%dQ' % l1size, self.file.read(l1offset, 8 * l1size))
+		# compressed cluster descriptors: host offset below csizeshift, 512 byte sectors above
+		self.csizeshift = 62 - (self.clusterbits - 8)
+		self.l2cache = LRUCache(self.loadL2, L2_CACHE_TABLES)
+		self.clustercache = LRUCache(self.inflate, CLUSTER_CACHE)
+
+		if backingoffset:
+			name = self.file.read(backingoffset, backingsize)
+			backing = os.path.join(os.path.dirname(os.path.abspath(path)), name)
+			log.debug('qcow2 \'%s\' is backed by \'%s\'' % (path, backing))
+			self.backing = openImage(backing)
+
+		log.debug('qcow2 \'%s\': version %d, %d bytes, %d byte clusters' % (path, self.version, self.size, self.clustersize))
+
+	def loadL2(self, offset):
+		return struct.unpack('>%dQ' % self.l2entries, self.file.read(offset, self.clustersize))
+
+	def inflate(self, entry):
+		hostoffset = entry & ((1 << self.csizeshift) - 1)
+		sectors = ((entry >> self.csizeshift) & ((1 << (self.clusterbits - 8)) - 1)) + 1
+		data = self.file.read(hostoffset, sectors * SECTOR_SIZE - (hostoffset & (SECTOR_SIZE - 1)))
+		# raw deflate, trailing bytes of the last sector are ignored
+		return zlib.decompressobj(-15).decompress(data, self.clustersize).ljust(self.clustersize, '\0')
+
+	def clusterEntry(self, cluster):
+		l1idx, l2idx = divmod(cluster, self.l2entries)
+		if l1idx >= len(self.l1):
+			return 0
+		l2offset = self.l1[l1idx] & QCOW2_OFFSET_MASK
+		if not l2offset:
+			return 0
+		return self.l2cache.get(l2offset)[l2idx]
+
+	def pread(self, offset, length):
+		length = max(0, min(length, self.size - offset))
+		out = []
+		while length > 0:
+			cluster, within = divmod(offset, self.clustersize)
+			n = min(length, self.clustersize - within)
+			entry = self.clusterEntry(cluster)
+			if entry & QCOW2_COMPRESSED:
+				out.append(self.clustercache.get(entry & ~QCOW2_COMPRESSED)[within:within + n])
+			elif entry & QCOW2_ZERO:
+				# reads as zeros even when a (preallocated) host cluster is set
+				out.append('\0' * n)
+			elif entry & QCOW2_OFFSET_MASK:
+				out.append(self.file.read((entry & QCOW2_OFFSET_MASK) + within, n))
+			elif self.backing is None:
+				out.append('\0' * n)
+			else:
+				out.append(self.backing.pread(offset, n).ljust(n, '\0'))
+			offset += n
+			length -= n
+		return ''.join(out)
+
+	def close(self):
+		log.debug('qcow2 \'%s\': %d/%d L2 table cache hits' % (self.path, self.l2cache.hits, self.l2cache.hits + self.l2cache.misses))
+		if self.backing is not None:
+			self.backing.close()
+		self.file.close()
+
+
+class VMDKSparseExtent(DiskImage):
+	"""One hosted sparse VMDK extent (monolithicSparse, twoGbMaxExtentSparse or streamOptimized)."""
+
+	def __init__(self, path):
+		self.path = path
+		self.file = MappedFile(path)
+
+		hdr = self.parseHeader(self.file.read(0, SECTOR_SIZE))
+		if hdr['gdoffset'] == VMDK_GD_AT_END:
+			# stream-optimized: the real header is the footer, before the end-of-stream marker
+			hdr = self.parseHeader(self.file.read(self.file.size - 2 * SECTOR_SIZE, SECTOR_SIZE))
+		self.flags = hdr['flags']
+		self.size = hdr['capacity'] * SECTOR_SIZE
+		self.grainsize = hdr['grainsize'] * SECTOR_SIZE
+		self.gtentries = hdr['gtentries']
+		if hdr['compression'] not in (0, 1):
+			raise Exception('unsupported VMDK compression %d in \'%s\'' % (hdr['compression'], path))
+
+		gtcoverage = self.gtentries * self.grainsize
+		gdentries = (self.size + gtcoverage - 1) / gtcoverage
+		self.gd = struct.unpack('<%dI' % gdentries, self.file.read(hdr['gdoffset'] * SECTOR_SIZE, 4 * gdentries))
+		self.gtcache = LRUCache(self.loadGT, L2_CACHE_TABLES)
+		self.graincache = LRUCache(self.inflate, CLUSTER_CACHE)
+
+		log.debug('VMDK extent \'%s\': %d bytes, %d byte grains%s' % (path, self.size, self.grainsize, ', compressed' if self.flags & VMDK_FLAG_COMPRESSED else ''))
+
+	def parseHeader(self, raw):
+		(magic, version, flags, capacity, grainsize, descoffset, descsize, gtentries,
+			rgdoffset, gdoffset, overhead, unclean, newlines, compression) = VMDK_HEADER.unpack_from(raw)
+		if magic != VMDK_MAGIC:
+			raise Exception('\'%s\' is not a sparse VMDK extent' % self.path)
+		if version not in (1, 2, 3):
+			raise Exception('unsupported VMDK version %d in \'%s\'' % (version, self.path))
+		return dict(flags=flags, capacity=capacity, grainsize=grainsize, gtentries=gtentries, gdoffset=gdoffset, compression=compression)
+
+	def loadGT(self, sector):
+		return struct.unpack('<%dI' % self.gtentries, self.file.read(sector * SECTOR_SIZE, 4 * self.gtentries))
+
+	def inflate(self, sector):
+		# a grain marker: the grain's lba and the compressed size, then zlib data
+		lba, size = struct.unpack('<QI', self.file.read(sector * SECTOR_SIZE, 12))
+		return zlib.decompress(self.file.read(sector * SECTOR_SIZE + 12, size)).ljust(self.grainsize, '\0')
+
+	def pread(self, offset, length):
+		length = max(0, min(length, self.size - offset))
+		out = []
+		while length > 0:
+			grain, within = divmod(offset, self.grainsize)
+			n = min(length, self.grainsize - within)
+			gdidx, gtidx = divmod(grain, self.gtentries)
+			sector = 0
+			if self.gd[gdidx]:
+				sector = self.gtcache.get(self.gd[gdidx])[gtidx]
+			if sector <= 1:
+				# 0 is unallocated, 1 a grain of zeros
+				out.append('\0' * n)
+			elif self.flags & VMDK_FLAG_COMPRESSED:
+				out.append(self.graincache.get(sector)[within:within + n])
+			else:
+				out.append(self.file.read(sector * SECTOR_SIZE + within, n))
+			offset += n
+			length -= n
+		return ''.join(out)
+
+	def close(self):
+		self.file.close()
+
+class VMDKImage(DiskImage):
+	"""
+	Read-only VMDK reader: a single sparse extent, or a descriptor file and
+	the sparse, flat and zero extents it lists, back to back.  Differencing
+	disks (with a parent) are not supported.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.extents = []	# (start, size, image or None for zeros, offset in the image)
+		self.size = 0
+
+		with open(path, 'rb') as fh:
+			head = fh.read(len(VMDK_MAGIC))
+		if head == VMDK_MAGIC:
+			extent = VMDKSparseExtent(path)
+			self.addExtent(extent.size, extent)
+			return
+
+		try:
+			self.parseDescriptor(path)
+		except Exception:
+			self.close()
+			raise
+
+	def addExtent(self, size, image, base=0):
+		self.extents.append((self.size, size, image, base))
+		self.size += size
+
+	def parseDescriptor(self, path):
+		with open(path, 'r') as fh:
+			descriptor = fh.read(64 * 1024)
+		if not descriptor.startswith(VMDK_DESCRIPTOR):
+			raise Exception('\'%s\' is not a VMDK image' % path)
+
+		parent = re.search(r'^parentCID\s*=\s*(\S+)', descriptor, re.M)
+		if parent and parent.group(1).lower() != 'ffffffff':
+			raise Exception('\'%s\' is a differencing VMDK, convert it with its parent first' % path)
+
+		top = os.path.dirname(os.path.abspath(path))
+		for line in descriptor.splitlines():
+			m = VMDK_EXTENT.match(line.strip())
+			if m is None:
+				continue
+			access, sectors, kind, name, offset = m.groups()
+			size = int(sectors) * SECTOR_SIZE
+			if kind == 'ZERO':
+				self.addExtent(size, None)
+			elif kind == 'SPARSE':
+				self.addExtent(size, VMDKSparseExtent(os.path.join(top, name)))
+			else:
+				# FLAT and VMFS are plain bytes, from a sector offset in their file
+				self.addExtent(size, RawImage(os.path.join(top, name)), int(offset or 0) * SECTOR_SIZE)
+		if not self.extents:
+			raise Exception('no extents in VMDK descriptor \'%s\'' % path)
+		log.debug('VMDK \'%s\': %d bytes in %d extents' % (path, self.size, len(self.extents)))
+
+	def pread(self, offset, length):
+		length = max(0, min(length, self.size - offset))
+		out = []
+		for start, size, image, base in self.extents:
+			if length <= 0:
+				break
+			if offset >= start + size:
+				continue
+			n = min(length, start + size - offset)
+			if image is None:
+				out.append('\0' * n)
+			else:
+				out.append(image.pread(base + offset - start, n).ljust(n, '\0'))
+			offset += n
+			length -= n
+		return ''.join(out)
+
+	def close(self):
+		for start, size, image, base in self.extents:
+			if image is not None:
+				image.close()
+
+
+IMAGE_FORMATS = collections.OrderedDict([
+	('vdi', VDIImage),
+	('qcow2', QCOW2Image),
+	('vmdk', VMDKImage),
+	('raw', RawImage),
+])
+
+def imageFormat(path):
+	"""The format of a disk image from its magic: vdi, qcow2, vmdk or raw."""
+	with open(path, 'rb') as fh:
+		hdr = fh.read(0x200)
+	if hdr[:4] == QCOW2_MAGIC:
+		return 'qcow2'
+	if hdr[:4] == VMDK_MAGIC or hdr.startswith(VMDK_DESCRIPTOR):
+		return 'vmdk'
+	if len(hdr) >= 0x44 and struct.unpack_from('<I', hdr, 0x40)[0] == VDI_SIGNATURE:
+		return 'vdi'
+	return 'raw'
+
+def openImage(path):
+	"""Open a disk image for reading, whatever its format."""
+	fmt = imageFormat(path)
+	log.debug('\'%s\' is a %s image' % (path, fmt))
+	return IMAGE_FORMATS[fmt](path)
+
+
+class Partition(object):
+	"""A byte range of an image, readable like an image."""
+
+	def __init__(self, image, name, start, size, ptype=None):
+		self.image = image
+		self.name = name
+		self.start = start
+		self.size = size
+		self.ptype = ptype
+
+	def pread(self, offset, length):
+		length = max(0, min(length, self.size - offset))
+		return self.image.pread(self.start + offset, length)
+
+	def __repr__(self):
+		return 'Partition(%r, start=%d, size=%d, type=%r)' % (self.name, self.start, self.size, self.ptype)
+
+
+def mbrEntries(sector):
+	for i in range(4):
+		status, ptype, lba, count = struct.unpack_from('<B3xB3xII', sector, 446 + 16 * i)
+		yield (ptype, lba, count)
+
+def gptPartitions(image):
+	hdr = image.pread(SECTOR_SIZE, SECTOR_SIZE)
+	if hdr[:8] != 'EFI PART':
+		raise Exception('protective MBR found but no GPT header')
+
+	entrylba, entrycount, entrysize = struct.unpack_from('<QII', hdr, 72)
+	raw = image.pread(entrylba * SECTOR_SIZE, entrycount * entrysize)
+
+	parts = []
+	for i in range(entrycount):
+		entry = raw[i * entrysize:(i + 1) * entrysize]
+		if len(entry) < 56 or entry[:16] == '\0' * 16:
+			continue
+		first, last = struct.unpack_from('<QQ', entry, 32)
+		parts.append(Partition(image, 'Partition%d' % (i + 1), first * SECTOR_SIZE, (last - first + 1) * SECTOR_SIZE, entry[:16].encode('hex')))
+	return parts
+
+def partitions(image):
+	"""Return the partitions of an image, or the whole image if it has no partition table."""
+	mbr = image.pread(0, SECTOR_SIZE)
+	if mbr[510:512] != '\x55\xaa':
+		log.debug('no partition table, treating the whole image as one partition')
+		return [Partition(image, 'Disk', 0, image.size)]
+
+	entries = list(mbrEntries(mbr))
+	if any(ptype == MBR_GPT_PROTECTIVE for ptype, lba, count in entries):
+		return gptPartitions(image)
+
+	parts = []
+	for i, (ptype, lba, count) in enumerate(entries):
+		if ptype == 0 or count == 0:
+			continue
+		if ptype in MBR_EXTENDED_TYPES:
+			parts.extend(logicalPartitions(image, lba))
+		else:
+			parts.append(Partition(image, 'Partition%d' % (i + 1), lba * SECTOR_SIZE, count * SECTOR_SIZE, '%02x' % ptype))
+
+	# a filesystem on the bare disk can still carry a boot signature
+	if not parts:
+		return [Partition(image, 'Disk', 0, image.size)]
+
+	return parts
+
+def logicalPartitions(image, extstart):
+	parts = []
+	ebr = extstart
+	seen = set()
+	while ebr not in seen:
+		seen.add(ebr)
+		sector = image.pread(ebr * SECTOR_SIZE, SECTOR_SIZE)
+		if sector[510:512] != '\x55\xaa':
+			log.warn('bad extended boot record at sector %d, ignoring the rest of the chain' % ebr)
+			break
+		entries = list(mbrEntries(sector))
+		ptype, lba, count = entries[0]
+		if ptype != 0 and count != 0:
+			parts.append(Partition(image, 'Partition%d' % (5 + len(parts)), (ebr + lba) * SECTOR_SIZE, count * SECTOR_SIZE, '%02x' % ptype))
+		ptype, lba, count = entries[1]
+		if ptype not in MBR_EXTENDED_TYPES or lba == 0:
+			break
+		ebr = extstart + lba
+	return parts
@@ -5,18 +5,41 @@ import re
 import sys
 import time
 import glob
+import json
+import gzip
+import hashlib
 import shlex
 import signal
+import stat
+import functools
+import collections
+import multiprocessing
 import shutil
 import argparse
+import threading
 import contextlib
 import subprocess
 import distutils.dir_util
 
-from fstab import fstab
+import extfs
+import diskimage
+import autotune
+import chunkstore
+import profiling
+import buildcache
+import layers
+import boottrace
+import planner
+from fstab import fstab, mountinfo
+from newc import NewcWriter, NewcExtractor, Stat, archiveName
+from treecopy import copyTree, syncTree, writeChangeList
+from treewalk import TreeWalker, treeSize
 from pprint import pformat
+from StringIO import StringIO
 from tempfile import mkdtemp
 from operator import itemgetter,attrgetter
+from multiprocessing.pool import ThreadPool
+from distutils.version import LooseVersion
 
 
 ### setup logging
@@ -34,21 +57,33 @@ stdouthandler.setFormatter(formatter)
 
 ### constants
 RECOGNIZED_LINUXFS_TYPES = ['ext4', 'xfs', 'ext3', 'ext2' ]
-LOOP_OPTS_RO = ['-o', 'loop', '-o', 'ro']
 GZIP_C_PROG = ['pigz', '-9', '-c']
 GZIP_D_PROG = ['pigz', '-d', '-k', '-c']
+BLOCKIMAGE_BLOCK_SIZE = 4096
+INIT_SCRIPTS = {'debian': 'init-scripts/debian/stateless.debian6.sh'}
+INITRD_CACHE_DIR = os.path.expanduser('~/.cache/all7fever/initrd')
+INITRD_CACHE_FORMAT = '1'	# bump when createBootPackage changes what goes into the initrd
+BLOCKIMAGE_INODE_SIZE = 256
+SUMS_BLOCK_SIZE = 4 * 1024 * 1024	# what clients fetch, verify and retry at a time, a multiple of 64k
+PROBE_BYTES = 64 * 1024	# from each end of a device, enough for blkid's signatures
+STATELESS_FSTAB = '''devpts  /dev/pts devpts   gid=5,mode=620 0 0
+tmpfs   /dev/shm tmpfs    defaults       0 0
+proc    /proc    proc     defaults       0 0
+sysfs   /sys     sysfs    defaults       0 0
+'''
+
+# results that stay good from one conversion to the next in the same process (daemon.py)
+whichCache = {}	# (PATH, program) -> (dir, program)
+magicCache = {}	# (path, ino, size, mtime, ctime) -> file(1) output
+blkidCache = {}	# probeKey -> blkid fields, or None if blkid found nothing
 
 ### mountpoint tests
 def procMountTest(mountpoint):
-	def f():
-		with open('/proc/mounts', 'r') as fh:
-			lines = fh.readlines()
-
-		for line in lines:
-			if mountpoint in line:
-				return True
+	# the kernel reports canonical paths
+	mountpoint = os.path.realpath(mountpoint)
 
-		return False
+	def f():
+		return mountinfo().bydir(mountpoint) is not None
 	
 	return f
 
@@ -73,8 +108,13 @@ def waitForTest(test, timeout=3):
 		time.sleep(0.15)
 
 def which(progname):
+	key = (os.environ['PATH'], progname)
+	found = whichCache.get(key)
+	if found is not None and os.access(os.path.join(*found), os.X_OK):
+		return found
 	for path in os.environ["PATH"].split(os.pathsep):
 		if os.access(os.path.join(path, progname), os.X_OK):
+			whichCache[key] = (path, progname)
 			return (path, progname)
 	return None
 
@@ -83,9 +123,76 @@ def errExcept(*args):
 	log.error(problem)
 	raise Exception(problem)
 
+def runCommand(args):
+	p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=None, close_fds=True)
+	stdout, stderr = p.communicate()
+	return p.wait(), stdout, stderr
+
+metadataLock = threading.Lock()
+
+def updateMetadata(outdir, key, value, merge=True):
+	"""merge value into OUTDIR/metadata.json under key, or replace what is there with merge=False"""
+	path = os.path.join(outdir, 'metadata.json')
+	with metadataLock:
+		metadata = {}
+		if os.path.exists(path):
+			with open(path, 'r') as fh:
+				metadata = json.load(fh)
+		if merge and isinstance(value, dict) and isinstance(metadata.get(key), dict):
+			metadata[key].update(value)
+		else:
+			metadata[key] = value
+		with open(path + '~', 'w') as fh:
+			json.dump(metadata, fh, indent=1, sort_keys=True)
+		os.rename(path + '~', path)
+
+### compression
+def tunedCompressor(args, name, entries):
+	"""the compressor command for a tree, autotuned if asked for; returns (argv, tuning metadata or None)"""
+	if not getattr(args, 'autotune', None):
+		return GZIP_C_PROG, None
+	chosen, tuning = autotune.tune(name, entries, args.autotune)
+	return chosen.argv, tuning
+
+def recordCompression(outdir, name, tuning, dst, seconds):
+	"""put the autotune prediction and what packing actually cost into the output metadata"""
+	if tuning is None:
+		return
+	tuning['actual'] = {'size': os.path.getsize(dst), 'pack_seconds': round(seconds, 3)}
+	log.info('%s: predicted %d bytes in %.1fs, got %d bytes in %.1fs' % (name, tuning['chosen']['size'], tuning['chosen']['pack_seconds'],
+		tuning['actual']['size'], seconds))
+	updateMetadata(outdir, 'compression', {name: tuning})
+
+def probeKey(dev):
+	"""what blkid looks at on a device: its size and the signatures at either end"""
+	h = hashlib.sha1()
+	with open(dev, 'rb') as fh:
+		fh.seek(0, os.SEEK_END)
+		size = fh.tell()
+		h.update(str(size))
+		fh.seek(0)
+		h.update(fh.read(PROBE_BYTES))
+		fh.seek(max(0, size - PROBE_BYTES))
+		h.update(fh.read(PROBE_BYTES))
+	return h.hexdigest()
+
 def blkid(pathglob):
+	"""probe the devices matching pathglob, devices that look the same as in an earlier run aren't probed again"""
+	devs = glob.glob(pathglob)
+	keys = dict((dev, probeKey(dev)) for dev in devs)
+	unprobed = [dev for dev in devs if keys[dev] not in blkidCache]
+	if unprobed:
+		for dev in unprobed:
+			blkidCache[keys[dev]] = None
+		for part in runBlkid(unprobed):
+			blkidCache[keys[part['DEV']]] = part
+	else:
+		log.debug('blkid results for all of \'%s\' are cached' % pathglob)
+	return [dict(blkidCache[keys[dev]], DEV=dev) for dev in devs if blkidCache[keys[dev]] is not None]
+
+def runBlkid(devs):
 	args = ['/sbin/blkid', '-c', '/dev/null']
-	args.extend(glob.glob(pathglob))
+	args.extend(devs)
 	p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=None, stdin=None, close_fds=True)
 	stdout, stderr = p.communicate()
 	rc = p.wait()
@@ -115,101 +222,204 @@ def blkid(pathglob):
 	return parts
 
 
-# open a loop mount with a context manager
-class Mount(object):
-	# TODO - refactor with subclassing for temporary and explicit mountpoints
-	def __init__(self, *opts, **kwargs):
-		self.opts = opts
-
-		if 'mountpoint' in kwargs:
-			self.mountpoint = kwargs['mountpoint']
-			
-			if not self.mountpoint.startswith('/'):
-				errExcept('mountpoint \'%s\' must be an absolute path')
-			elif not os.path.exists(self.mountpoint):
-				errExcept('mountpoint \'%s\' does not exist, cannot continue' % self.mountpoint)
-		else:
-			self.mountpoint = None
+# loop devices and mounts for one conversion, torn down together
+class MountManager(object):
+	"""
+	Every partition is attached to a loop device once (read-only, with direct
+	I/O where the backing file allows it so its pages aren't cached twice,
+	for the image and for the loop device) and mounted once.  Putting a
+	filesystem in its place in the tree is a bind mount of that first mount,
+	so partitions mounted while looking for the root are reused as they are.
+	mountAll and placeAll do a batch of these in parallel.
+	"""
+
+	def __init__(self):
+		self.loops = {}		# backing file -> loop device
+		self.mounted = {}	# backing file -> first mountpoint
+		self.mounts = []	# [(target, parent target or None, tmpdir?)] in mount order
+		self.lock = threading.Lock()
+		self.attachlock = threading.Lock()	# losetup --find races with itself
 
 	def __enter__(self):
-		if self.mountpoint is None:
-			self.tmpdir = mkdtemp('all7fever')
+		return self
 
-		try:
-			mountloc = which('mount')
-			assert(mountloc is not None)
+	def __exit__(self, *exc_details):
+		self.unmountAll()
+
+	def attach(self, path):
+		with self.attachlock:
+			return self.attachLocked(path)
+
+	def attachLocked(self, path):
+		if path in self.loops:
+			return self.loops[path]
+
+		losetup = '/'.join(which('losetup') or ('/sbin', 'losetup'))
+		rc, stdout, stderr = runCommand([losetup, '--find', '--show', '--read-only', '--direct-io=on', path])
+		if rc != 0 and '--direct-io' in stderr:
+			# util-linux before 2.29
+			log.debug('losetup does not know --direct-io, attaching with buffered I/O')
+			rc, stdout, stderr = runCommand([losetup, '--find', '--show', '--read-only', path])
+		if rc != 0:
+			log.debug('losetup err output:\n%s*********' % stderr)
+			errExcept('couldn\'t attach a loop device to \'%s\', are you root?' % path)
 
-			mountpath = '/'.join(mountloc)
+		loopdev = stdout.strip()
+		self.loops[path] = loopdev
 
-			args = list(self.opts)
+		try:
+			with open('/sys/block/%s/loop/dio' % os.path.basename(loopdev)) as fh:
+				dio = fh.read().strip() == '1'
+		except IOError:
+			dio = False
+		log.debug('attached \'%s\' to \'%s\'%s' % (path, loopdev, '' if dio else ' (buffered, no direct I/O)'))
 
-			args.insert(0, mountpath)
-			if self.mountpoint is None:
-				args.append(self.tmpdir) 
-			else:
-				args.append(self.mountpoint) 
+		return loopdev
 
-			log.debug('mount image args: %s (or) %s' % (str(args), ' '.join(args)))
+	def mount(self, path):
+		"""mount a partition at a temporary directory, or return where it already is"""
+		if path in self.mounted:
+			return self.mounted[path]
 
-			p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=None, close_fds=True)
-			stdout, stderr = p.communicate()
-			rc = p.wait()
+		loopdev = self.attach(path)
+		tmpdir = mkdtemp('all7fever')
+		try:
+			self.runMount(['-o', 'ro', loopdev, tmpdir])
+		except Exception:
+			os.rmdir(tmpdir)
+			raise
 
+		with self.lock:
+			self.mounts.append((tmpdir, None, True))
+			self.mounted[path] = tmpdir
+		return tmpdir
+
+	def mountAll(self, paths):
+		"""mount every partition at once, returns {path: mountpoint}"""
+		paths = list(paths)
+		if not paths:
+			return {}
+		pool = ThreadPool(len(paths))
+		try:
+			mountpoints = pool.map(self.mount, paths)
+		finally:
+			pool.close()
+			pool.join()
+		return dict(zip(paths, mountpoints))
+
+	def place(self, path, target):
+		"""make a partition's filesystem appear at target"""
+		source = self.mount(path)
+		self.runMount(['--bind', '-o', 'ro', source, target])
+		with self.lock:
+			self.mounts.append((target, self.parentOf(target), False))
+
+	def placeAll(self, placements):
+		"""
+		place {target: path} where targets may be nested in each other.  the
+		targets are made into a tree once and each level of it is placed in
+		parallel, so a filesystem is only placed after the one it sits in.
+		"""
+		targets = sorted(placements, key=len)
+		depth = {}
+		for target in targets:
+			# the deepest target this one sits in, there are only a handful
+			parents = [t for t in depth if target.startswith(t.rstrip('/') + '/')]
+			depth[target] = max([depth[p] + 1 for p in parents] or [0])
+
+		levels = {}
+		for target, level in depth.iteritems():
+			levels.setdefault(level, []).append(target)
+
+		def placeOne(target):
+			if not os.path.isdir(target):
+				errExcept('could not place mountpoint \'%s\'.  the known filesystems must not contain all the needed mountpoints' % target)
+			self.place(placements[target], target)
+			log.info('mounted \'%s\' at \'%s\'' % (placements[target], target))
+
+		if not levels:
+			return
+		pool = ThreadPool(max(len(l) for l in levels.itervalues()))
+		try:
+			for level in sorted(levels):
+				log.debug('placing %d filesystems at depth %d' % (len(levels[level]), level))
+				pool.map(placeOne, levels[level])
+		finally:
+			pool.close()
+			pool.join()
+
+	def parentOf(self, target):
+		parent = None
+		for mounted, p, tmp in self.mounts:
+			if (target + '/').startswith(mounted + '/') and (parent is None or len(mounted) > len(parent)):
+				parent = mounted
+		return parent
+
+	def runMount(self, args):
+		args = ['/'.join(which('mount'))] + args
+		log.debug('mount args: %s' % ' '.join(args))
+		rc, stdout, stderr = runCommand(args)
+		if rc != 0:
+			log.debug('mount output:\n%s*********' % stdout)
+			log.debug('mount err output:\n%s*********' % stderr)
+			errExcept('couldn\'t mount \'%s\', are you root?' % args[-2])
+
+		# mount(8) only returns once the mount is in place
+		if not procMountTest(args[-1])():
+			errExcept('\'%s\' is not a mountpoint after mounting it' % args[-1])
+
+	def unmountAll(self):
+		"""unmount everything, children before parents and each level in parallel, then free the loop devices"""
+		if not self.mounts and not self.loops:
+			return
+
+		log.info('unmounting filesystems')
+
+		parents = dict((target, parent) for target, parent, tmp in self.mounts)
+		def depth(target):
+			n = 0
+			while parents.get(target) is not None:
+				target = parents[target]
+				n += 1
+			return n
+
+		levels = {}
+		for target, parent, tmp in self.mounts:
+			levels.setdefault(depth(target), []).append(target)
+
+		umount = '/'.join(which('umount') or ('/bin', 'umount'))
+		losetup = '/'.join(which('losetup') or ('/sbin', 'losetup'))
+		failures = []
+
+		def run(args):
+			rc, stdout, stderr = runCommand(args)
 			if rc != 0:
-				log.debug('mount output:\n%s*********' % stdout)
-				log.debug('mount err output:\n%s*********' % stderr)
-				errExcept('couldn\'t mount image, are you root?')
+				failures.append('%s [rc=%d]: %s' % (' '.join(args), rc, stderr.strip()))
 
-			if self.mountpoint is None:
-				waitForTest(procMountTest(self.tmpdir))
-			else:
-				waitForTest(procMountTest(self.mountpoint))
-
-			log.debug('mounted successfully')
-
-		except Exception, e:
-			if self.mountpoint is None:
+		pool = ThreadPool(max(1, max([len(l) for l in levels.values()] + [len(self.loops)])))
+		try:
+			for level in sorted(levels, reverse=True):
+				pool.map(run, [[umount, target] for target in levels[level]])
+			if not failures:
+				pool.map(run, [[losetup, '-d', loopdev] for loopdev in self.loops.itervalues()])
+		finally:
+			pool.close()
+			pool.join()
+
+		for target, parent, tmp in self.mounts:
+			if tmp:
 				try:
-					os.rmdir(self.tmpdir)
-				except OSError, e2:
-					log.warn('could not remove temporary directory \'%s\'' % self.tmpdir)
-					log.debug('OSError exception: %s' % str(e2))
-			raise e
-
-		if self.mountpoint is None:
-			return self.tmpdir
-		else:
-			return self.mountpoint
+					os.rmdir(target)
+				except OSError, e:
+					log.warn('could not remove temporary directory \'%s\'' % target)
+					log.debug('OSError exception: %s' % str(e))
 
-	def __exit__(self, *exc_details):
-		log.info('unmounting image')
-		# log.debug('exc_details: %s' % str(exc_details))
+		self.mounts = []
+		self.mounted = {}
+		self.loops = {}
 
-		umountloc = which('umount')
-		if umountloc is None:
-			raise Exception('cannot find umount command???')
-
-		umountpath = '/'.join(umountloc)
-
-		if self.mountpoint is None:
-			p = subprocess.Popen([umountpath, self.tmpdir], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=None, close_fds=True)
-		else:
-			p = subprocess.Popen([umountpath, self.mountpoint], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=None, close_fds=True)
-
-		(stdout, stderr) = p.communicate()
-		rc = p.wait()
-	
-		if rc != 0:
-			log.warn('umount did not exit nicely[rc=%d]' % rc)
-			log.debug('umount output:\n%s*********' % stdout)
-			log.debug('umount err output:\n%s*********' % stderr)
-
-		if self.mountpoint is None:
-			try:
-				os.rmdir(self.tmpdir)
-			except OSError, e:
-				log.warn('could not remove temporary directory \'%s\'' % self.tmpdir)
-				log.debug('OSError exception: %s' % str(e))
+		if failures:
+			errExcept('ok, i\'m going to level with you.  this is not good.\nwe failed while trying to unmount some of the filesystems.\nat this point you have to manually unmount them or risk corruption.\nsorry brah.\n%s' % '\n'.join(failures))
 
 
 # open a vdi fuse session with a context manager
@@ -331,22 +541,34 @@ def createDiskMap(stabbystabby, vdiparts):
 
 	return diskmap
 
-def unmountStack(s):
-	while len(s) > 0:
-		m = s.pop()
+def du(path):
+	return treeSize(path)
+
+class NameFeeder(threading.Thread):
+	"""feed the names under src (or just the relpaths in names) to `cpio -0 -o` in place of `find .`, walking in parallel"""
+	def __init__(self, src, fh, names=None):
+		threading.Thread.__init__(self, name='namefeeder')
+		self.daemon = True
+		self.src = src
+		self.fh = fh
+		self.names = names
+		self.error = None
+
+	def run(self):
 		try:
-			time.sleep(0.1)
-			m.__exit__()
+			if self.names is not None:
+				for relpath in self.names:
+					self.fh.write(archiveName(relpath) + '\0')
+				return
+			for relpath, st in TreeWalker(self.src):
+				self.fh.write(archiveName(relpath) + '\0')
 		except Exception, e:
-			errExcept('ok, i\'m going to level with you.  this is not good.\nwe failed while trying to unmount one of the filesystems.\nat this point you have to manually unmount them or risk corruption.\nsorry brah.\n%s' % str(e))
-
-def du(path):
-	dupath = '/'.join(which('du'))
-	dup = subprocess.Popen([dupath, '-b', path], stderr=None, stdin=None, stdout=subprocess.PIPE, close_fds=True)
-	while dup.poll() is None:
-		for line in dup.stdout.readlines():
-			pass
-	return int(line.strip().split()[0])
+			self.error = e
+		finally:
+			try:
+				self.fh.close()
+			except IOError:
+				pass
 
 def cpioCopy(src, dst, **kwargs):
 	log.debug('starting cpio-based copy \'%s\' -> \'%s\'' % (src, dst))
@@ -361,28 +583,26 @@ def cpioCopy(src, dst, **kwargs):
 	else:
 		log.debug('no progress bar')
 
-	findcp = None
+	feeder = None
 	srccp = None
 	midcp = None
 	dstcp = None
 
 	def killPipeline():
-		for fh in [dstcp, midcp, srccp, findcp]:
+		for fh in [dstcp, midcp, srccp]:
 			if fh is not None:
 				fh.send_signal(signal.SIGINT)
 
 	try:
 		devnull = open('/dev/null', 'w')
 
-		findpath = '/'.join(which('find'))
-		args = [findpath, '.']
-		log.debug('find args: %s' % str(args))
-		findcp = subprocess.Popen(args, close_fds=True, stdin=None, stdout=subprocess.PIPE, stderr=devnull, cwd=src)
-
 		cpiopath = '/'.join(which('cpio'))
-		args = [cpiopath, '-H', 'newc', '-o']
+		args = [cpiopath, '-0', '-H', 'newc', '-o']
 		log.debug('src cpio args: %s' % str(args))
-		srccp =  subprocess.Popen(args, close_fds=True, stdin=findcp.stdout, stdout=subprocess.PIPE, cwd=src, stderr=devnull)
+		srccp =  subprocess.Popen(args, close_fds=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=src, stderr=devnull)
+
+		feeder = NameFeeder(src, srccp.stdin)
+		feeder.start()
 		
 		if progress:
 			pvpath = which('pv')
@@ -395,7 +615,7 @@ def cpioCopy(src, dst, **kwargs):
 			copybytes = du(src)
 			args = [pvpath, '-pter', '-s', str(int(copybytes * 0.98)), '-i', '0.5']
 			log.debug('pv args: %s' % str(args))
-			midcp = subprocess.Popen(args, stdin=srccp.stdout, stdout=subprocess.PIPE)
+			midcp = subprocess.Popen(args, stdin=srccp.stdout, stdout=subprocess.PIPE, close_fds=True)
 		else:
 			midcp = srccp
 
@@ -411,7 +631,7 @@ def cpioCopy(src, dst, **kwargs):
 		raise
 
 	finally:
-		for fh in [dstcp, midcp, srccp, findcp]:
+		for fh in [dstcp, midcp, srccp]:
 			if fh is not None:
 				rc = fh.wait()
 				if rc != 0:
@@ -419,6 +639,11 @@ def cpioCopy(src, dst, **kwargs):
 					killPipeline()
 					errExcept('killed pipeline because of bad exit codes')
 
+		if feeder is not None:
+			feeder.join()
+			if feeder.error is not None:
+				errExcept('walking \'%s\' failed: %s' % (src, str(feeder.error)))
+
 	log.info('rootfs copy completed')
 
 def cpioZipPack(src, dst, **kwargs):
@@ -433,28 +658,26 @@ def cpioZipPack(src, dst, **kwargs):
 	else:
 		log.debug('no progress bar')
 
-	findcp = None
+	feeder = None
 	srccp = None
 	midcp = None
 	zipcp = None
 
 	def killPipeline():
-		for fh in [zipcp, midcp, srccp, findcp]:
+		for fh in [zipcp, midcp, srccp]:
 			if fh is not None:
 				fh.send_signal(signal.SIGINT)
 
 	try:
 		devnull = open('/dev/null', 'w')
 
-		findpath = '/'.join(which('find'))
-		args = [findpath, '.']
-		log.debug('find args: %s' % str(args))
-		findcp = subprocess.Popen(args, close_fds=True, stdin=None, stdout=subprocess.PIPE, stderr=devnull, cwd=src)
-
 		cpiopath = '/'.join(which('cpio'))
-		args = [cpiopath, '-H', 'newc', '-o']
+		args = [cpiopath, '-0', '-H', 'newc', '-o']
 		log.debug('src cpio args: %s' % str(args))
-		srccp =  subprocess.Popen(args, close_fds=True, stdin=findcp.stdout, stdout=subprocess.PIPE, cwd=src, stderr=devnull)
+		srccp =  subprocess.Popen(args, close_fds=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=src, stderr=devnull)
+
+		feeder = NameFeeder(src, srccp.stdin, kwargs.get('names'))
+		feeder.start()
 		
 		if progress:
 			pvpath = which('pv')
@@ -467,14 +690,15 @@ def cpioZipPack(src, dst, **kwargs):
 			copybytes = du(src)
 			args = [pvpath, '-pter', '-s', str(int(copybytes * 0.98)), '-i', '0.5']
 			log.debug('pv args: %s' % str(args))
-			midcp = subprocess.Popen(args, stdin=srccp.stdout, stdout=subprocess.PIPE)
+			midcp = subprocess.Popen(args, stdin=srccp.stdout, stdout=subprocess.PIPE, close_fds=True)
 		else:
 			midcp = srccp
 
-		assert(len(GZIP_C_PROG) > 0)
-		assert(which(GZIP_C_PROG[0]) is not None)
-		gzipcp = '/'.join(which(GZIP_C_PROG[0]))
-		args = [ gzipcp ] + GZIP_C_PROG[1:]
+		compressor = kwargs.get('compressor', GZIP_C_PROG)
+		assert(len(compressor) > 0)
+		assert(which(compressor[0]) is not None)
+		gzipcp = '/'.join(which(compressor[0]))
+		args = [ gzipcp ] + compressor[1:]
 		log.debug('gzip args: %s' % str(args))
 		zipcp = subprocess.Popen(args, cwd='/tmp', stdin=midcp.stdout, stderr=devnull, stdout=dstcp, close_fds=True)
 
@@ -492,7 +716,7 @@ def cpioZipPack(src, dst, **kwargs):
 
 	finally:
 		e = None
-		for fh in [zipcp, midcp, srccp, findcp]:
+		for fh in [zipcp, midcp, srccp]:
 			if fh is not None:
 				rc = fh.wait()
 				if rc != 0:
@@ -500,6 +724,11 @@ def cpioZipPack(src, dst, **kwargs):
 					killPipeline()
 					e = 'killed pipeline because of bad exit codes'
 
+		if feeder is not None:
+			feeder.join()
+			if feeder.error is not None and e is None:
+				e = 'walking \'%s\' failed: %s' % (src, str(feeder.error))
+
 		dstcp.close()
 
 		if e is not None:
@@ -507,8 +736,10 @@ def cpioZipPack(src, dst, **kwargs):
 
 	log.info('pack completed')
 
-def mountAndCopyDisk(args, rootfsdir):
-	with VDIFuse(args.vdifile) as vdimount:
+@contextlib.contextmanager
+def mountDisk(vdifile):
+	"""mount the image's filesystems as they are laid out in the guest, yields the root mountpoint"""
+	with VDIFuse(vdifile) as vdimount:
 		parts = blkid(os.path.join(vdimount,'Partition*'))
 
 		def isLinuxFS(fshash):
@@ -523,26 +754,24 @@ def mountAndCopyDisk(args, rootfsdir):
 
 		log.debug('linux partitions: ' + str(['%s=%s' % (p['DEV'], p['TYPE']) for p in parts]))
 
-		# find root device
-		log.info('finding root device')
-		rootdev = None
+		with MountManager() as mounts:
+			# find root device, probing every partition at once; they all stay mounted for the copy
+			log.info('finding root device among %d partitions' % len(parts))
+			rootdev = None
 
-		searched = 0
-		
-		for part in parts:
-			assert('DEV' in part)
-			dev = part['DEV']
-			mountargs = LOOP_OPTS_RO + [dev] 
-			with Mount(*mountargs) as loopmount:
-				searched += 1
-				log.info('searching mount %d' % searched)
-				log.debug('mounted \'%s\' at \'%s\'' % (dev, loopmount,))
+			loopmounts = mounts.mountAll([part['DEV'] for part in parts])
+
+			for part in parts:
+				loopmount = loopmounts[part['DEV']]
+				log.debug('mounted \'%s\' at \'%s\'' % (part['DEV'], loopmount,))
 				if isRootFS(loopmount):
 					rootdev = part
 					stabbystabby = fstab(os.path.join(loopmount,'etc/fstab'))
 					break
-		
-		if rootdev is not None:
+
+			if rootdev is None:
+				errExcept('could not find root device')
+
 			log.info('found root device')
 			log.debug('root device \'%s\' type \'%s\'' % (rootdev['DEV'], rootdev['TYPE']))
 
@@ -551,9 +780,6 @@ def mountAndCopyDisk(args, rootfsdir):
 			diskmap = createDiskMap(stabbystabby, parts)
 			log.debug('created map:\n%s********' % pformat(diskmap))
 
-			# mount each filesystem in its place, starting with root
-			mountstack = []
-
 			try:
 				# make the fses we care about into a dictionary
 				fses = dict([ (fs.dir, diskmap[fs.fsname],) for fs in iter(stabbystabby) if fs.fsname in diskmap])
@@ -562,55 +788,443 @@ def mountAndCopyDisk(args, rootfsdir):
 				if '/' not in fses:	
 					errExcept('no (recognized) device with root mountpoint exists in fstab')
 				elif rootdev['DEV'] != fses['/']:
-					errExcept('we thought we knew what the root device was, but we were wrong.\n\'%s\' has the root mountpoint but fstab was found on \'%s\'' % (rootdev['DEV'], diskmap[fses['/'].fsname]))
-
-				# mount the root fs
-				rootdev = fses['/']
-				mountargs = LOOP_OPTS_RO + [rootdev]
-				rootmount = Mount(*mountargs)
-				topdir = rootmount.__enter__()
-				mountstack.append(rootmount)
+					errExcept('we thought we knew what the root device was, but we were wrong.\n\'%s\' has the root mountpoint but fstab was found on \'%s\'' % (fses['/'], rootdev['DEV']))
+
+				# the root is already mounted from the search
+				topdir = mounts.mount(fses['/'])
 				log.info('mounted \'/\' at \'%s\'' % topdir)
 
 				del fses['/']
 
-				# mount each other filesystem
-				while len(fses) > 0:
-					delmount = None
-
-					for mount in fses.iterkeys():	
-						# check if the mountpoint is accessible off the tree we have now (for nested mountpoints)
-						realmount = os.path.join(topdir, mount.lstrip('/'))
-						if os.path.exists(realmount):
-							thisdev = fses[mount]
-							mountargs = LOOP_OPTS_RO + [thisdev]
-							thismount = Mount(*mountargs, mountpoint=realmount)
-							thismount.__enter__()
-							mountstack.append(thismount)
-							log.info('mounted \'%s\' at \'%s\'' % (thisdev, realmount))
-							delmount = mount
-							break
-
-					if delmount is not None:
-						del fses[delmount]
-					else:
-						log.debug('remaining fses:\n%s*******' % '\n'.join([repr(f) for f in fses]))
-						errExcept('could not place remaining mountpoints.  the known filesystems must not contain all the needed mountpoints')
+				# place the other filesystems, a level of the mountpoint tree at a time
+				mounts.placeAll(dict((os.path.join(topdir, mount.lstrip('/')), dev) for mount, dev in fses.iteritems()))
 
 				log.info('all filesystems mounted')
 
-				# copy off the contents into a root dir somewhere
-				os.makedirs(args.outdir)
-				cpioCopy(topdir, rootfsdir, progress=True)
+				yield topdir
 
 			except Exception, e:
 				log.error('problem while mounting and packing the filesystem')
 				raise
+
+def mountAndCopyDisk(args, rootfsdir):
+	with mountDisk(args.vdifile) as topdir:
+		# copy off the contents into a root dir somewhere
+		os.makedirs(args.outdir)
+		if args.cpiocopy:
+			cpioCopy(topdir, rootfsdir, progress=True)
+		else:
+			copyTree(topdir, rootfsdir, workers=args.copyjobs, progress=True)
+
+def mountAndSyncDisk(args, rootfsdir):
+	"""update an existing rootfs from the image, returns the change list"""
+	with mountDisk(args.vdifile) as topdir:
+		# fstab is always replaced with the stateless one, don't let it count as a change
+		return syncTree(topdir, rootfsdir, checksum=args.checksum, exclude=['etc/fstab'], workers=args.copyjobs, progress=True)
+
+def bootResourcesChanged(changes):
+	for op, relpath in changes:
+		if relpath == 'boot' or relpath.startswith('boot/') or relpath.startswith('lib/modules/'):
+			return True
+	return False
+
+### userspace conversion, no mounts
+def probeImagePartitions(image):
+	"""find ext filesystems on an image, returns ([blkid-like part dicts], {DEV: ExtFS})"""
+	parts = []
+	filesystems = {}
+
+	for i, part in enumerate(diskimage.partitions(image)):
+		fs = extfs.probe(part, part.name, devno=i + 1)
+		if fs is None:
+			log.debug('no ext filesystem on \'%s\'' % part.name)
+			continue
+		parts.append({'DEV': part.name, 'TYPE': fs.fstype, 'UUID': fs.uuid, 'LABEL': fs.label})
+		filesystems[part.name] = fs
+
+	return parts, filesystems
+
+def findImageTree(image):
+	"""locate the root filesystem and graft the fstab mounts onto it, returns an extfs.FSTree"""
+	parts, filesystems = probeImagePartitions(image)
+	log.debug('linux partitions: ' + str(['%s=%s' % (p['DEV'], p['TYPE']) for p in parts]))
+
+	log.info('finding root device')
+	rootdev = None
+
+	for part in parts:
+		fstabinode = filesystems[part['DEV']].lookup('/etc/fstab', follow=True)
+		if fstabinode is not None and fstabinode.isreg():
+			rootdev = part
+			stabbystabby = fstab(StringIO(fstabinode.readAll()))
+			break
+
+	if rootdev is None:
+		errExcept('could not find root device')
+
+	log.info('found root device')
+	log.debug('root device \'%s\' type \'%s\'' % (rootdev['DEV'], rootdev['TYPE']))
+
+	diskmap = createDiskMap(stabbystabby, parts)
+	log.debug('created map:\n%s********' % pformat(diskmap))
+
+	fses = dict([ (fs.dir, diskmap[fs.fsname],) for fs in iter(stabbystabby) if fs.fsname in diskmap])
+
+	if '/' not in fses:
+		errExcept('no (recognized) device with root mountpoint exists in fstab')
+	elif rootdev['DEV'] != fses['/']:
+		errExcept('we thought we knew what the root device was, but we were wrong.\n\'%s\' has the root mountpoint but fstab was found on \'%s\'' % (fses['/'], rootdev['DEV']))
+
+	for mount, dev in sorted(fses.iteritems()):
+		log.info('grafting \'%s\' at \'%s\'' % (dev, mount))
+
+	mounts = dict((mount, filesystems[dev]) for mount, dev in fses.iteritems() if mount != '/')
+	return extfs.FSTree(filesystems[fses['/']], mounts)
+
+def treeZipPack(tree, dst, replace=None, compressor=GZIP_C_PROG):
+	"""pack an extfs.FSTree into a cpio-gz archive in-process, replace maps relpath -> file contents"""
+	log.debug('starting in-process cpio-gz pack -> \'%s\'' % dst)
+	replace = replace or {}
+
+	assert(len(compressor) > 0)
+	assert(which(compressor[0]) is not None)
+	gzipcp = '/'.join(which(compressor[0]))
+	args = [ gzipcp ] + compressor[1:]
+	log.debug('gzip args: %s' % str(args))
+
+	dstfh = open(dst, 'w')
+	zipcp = subprocess.Popen(args, cwd='/tmp', stdin=subprocess.PIPE, stdout=dstfh, close_fds=True)
+
+	try:
+		writer = NewcWriter(zipcp.stdin)
+		lastreport = time.time()
+
+		for relpath, inode in tree.walk():
+			name = archiveName(relpath)
+
+			if relpath in replace:
+				data = replace[relpath]
+				writer.addEntry(name, Stat(inode, st_mode=(inode.st_mode & 07777) | 0100000, st_size=len(data), st_nlink=1), data)
+			elif inode.isreg():
+				writer.addEntry(name, inode, inode.read())
+			elif inode.islnk():
+				writer.addEntry(name, inode, inode.readlink())
+			else:
+				writer.addEntry(name, inode)
+
+			if time.time() - lastreport >= 5:
+				log.info('packed %d entries, %d MiB' % (writer.entries, writer.offset >> 20))
+				lastreport = time.time()
+
+		writer.close()
+		zipcp.stdin.close()
+
+	except Exception, e:
+		log.warn('encountered exception while packing %s' % str(e))
+		zipcp.send_signal(signal.SIGINT)
+		raise
+
+	finally:
+		rc = zipcp.wait()
+		dstfh.close()
+		if rc != 0:
+			errExcept('gzip process did not exit nicely [rc=%d]' % rc)
+
+	log.info('pack completed')
+
+def copyRange(src, dst, offset, length=None):
+	"""append length bytes (or the rest) of file src from offset to the open file dst"""
+	with open(src, 'rb') as fh:
+		fh.seek(offset)
+		while length is None or length > 0:
+			buf = fh.read(1024 * 1024 if length is None else min(length, 1024 * 1024))
+			if not buf:
+				break
+			dst.write(buf)
+			if length is not None:
+				length -= len(buf)
+
+def orderedZipPack(src, dst, segments, compressor=GZIP_C_PROG):
+	"""
+	pack the relpaths of each segment in order into one cpio-gz archive at
+	dst, each segment its own gzip member.  the archive is extracted as a
+	whole like any other.  the first segment is also written on its own to
+	DST.boot.cpio.gz, with a trailer so it's a whole archive, and the rest
+	to DST.rest.cpio.gz, so clients can extract the boot segment first.
+	"""
+	log.debug('starting boot ordered cpio-gz pack \'%s\' -> \'%s\'' % (src, dst))
+	assert(len(compressor) > 0)
+	assert(which(compressor[0]) is not None)
+	args = [ '/'.join(which(compressor[0])) ] + compressor[1:]
+
+	class Segment(object):
+		"""the compressor for one gzip member, appending to the output file"""
+		def __init__(self, out):
+			self.out = out
+			out.flush()
+			self.zipcp = subprocess.Popen(args, cwd='/tmp', stdin=subprocess.PIPE, stdout=out, close_fds=True)
+		def write(self, buf):
+			self.zipcp.stdin.write(buf)
+		def close(self):
+			self.zipcp.stdin.close()
+			rc = self.zipcp.wait()
+			if rc != 0:
+				errExcept('gzip process did not exit nicely [rc=%d]' % rc)
+
+	class Switch(object):
+		"""what the archive writer writes to, moved from segment to segment"""
+		def write(self, buf):
+			self.segment.write(buf)
+
+	switch = Switch()
+	writer = NewcWriter(switch)
+	boundary = None
+	with open(dst, 'wb') as out:
+		for i, relpaths in enumerate(segments):
+			switch.segment = Segment(out)
+			try:
+				for relpath in relpaths:
+					path = os.path.join(src, relpath)
+					st = os.lstat(path)
+					if stat.S_ISREG(st.st_mode):
+						with open(path, 'rb') as fh:
+							writer.addEntry(archiveName(relpath), st, iter(functools.partial(fh.read, 1024 * 1024), ''))
+					elif stat.S_ISLNK(st.st_mode):
+						writer.addEntry(archiveName(relpath), st, os.readlink(path))
+					else:
+						writer.addEntry(archiveName(relpath), st)
+				if i == len(segments) - 1:
+					writer.close()
+			except Exception:
+				switch.segment.zipcp.send_signal(signal.SIGINT)
+				raise
 			finally:
-				unmountStack(mountstack)
+				switch.segment.close()
+			if i == 0:
+				boundary = os.fstat(out.fileno()).st_size
+
+	# the boot segment on its own needs a trailer, in a gzip member of its own
+	boot = dst[:-len('.cpio.gz')] + '.boot.cpio.gz' if dst.endswith('.cpio.gz') else dst + '.boot'
+	rest = dst[:-len('.cpio.gz')] + '.rest.cpio.gz' if dst.endswith('.cpio.gz') else dst + '.rest'
+	with open(boot, 'wb') as out:
+		copyRange(dst, out, 0, boundary)
+		trailer = Segment(out)
+		NewcWriter(trailer).close()
+		trailer.close()
+	with open(rest, 'wb') as out:
+		copyRange(dst, out, boundary)
+	writeBlockSums(boot)
+	writeBlockSums(rest)
+	log.info('pack completed, boot segment is %d of %d bytes' % (boundary, os.path.getsize(dst)))
+
+def reproducibleZipPack(src, dst, names=None, mtimeclamp=None, workers=None):
+	"""
+	pack src (or just the relpaths in names) into a cpio-gz archive that
+	only depends on the tree: entries sorted by name, inode numbers hashed
+	from names (so adding a file doesn't renumber the ones after it), no
+	mtime later than mtimeclamp.  the archive is cut at the
+	chunk store's content-defined boundaries and each piece compressed as
+	a gzip member of its own, so a small change to the tree only changes
+	the compressed bytes around it and rsync-like tools only move those.
+	"""
+	log.debug('starting reproducible cpio-gz pack \'%s\' -> \'%s\'' % (src, dst))
+	if names is None:
+		entries = sorted(TreeWalker(src))
+	else:
+		entries = sorted((relpath, os.lstat(os.path.join(src, relpath))) for relpath in names)
+
+	# the boundary scan needs processes, fork them before the writer thread starts
+	workers = workers or multiprocessing.cpu_count()
+	scanpool = multiprocessing.Pool(workers)
+	pool = ThreadPool(workers)
+	rfd, wfd = os.pipe()
+	errors = []
+
+	def produce():
+		try:
+			with os.fdopen(wfd, 'wb') as pipe:
+				writer = NewcWriter(pipe, mtimeclamp=mtimeclamp, stableinodes=True)
+				for relpath, st in entries:
+					path = os.path.join(src, relpath)
+					if stat.S_ISREG(st.st_mode):
+						with open(path, 'rb') as fh:
+							writer.addEntry(archiveName(relpath), st, iter(functools.partial(fh.read, 1024 * 1024), ''))
+					elif stat.S_ISLNK(st.st_mode):
+						writer.addEntry(archiveName(relpath), st, os.readlink(path))
+					else:
+						writer.addEntry(archiveName(relpath), st)
+				writer.close()
+		except Exception, e:
+			errors.append(e)
+
+	producer = threading.Thread(target=produce, name='reproducible-pack')
+	producer.daemon = True
+	producer.start()
 
+	members = 0
+	try:
+		with os.fdopen(rfd, 'rb') as fh:
+			with open(dst, 'wb') as out:
+				pending = collections.deque()
+				for data in chunkstore.chunks(fh, pool=scanpool):
+					pending.append(pool.apply_async(chunkstore.compressChunk, (data,)))
+					while len(pending) > workers * 2:
+						out.write(pending.popleft().get())
+						members += 1
+				while pending:
+					out.write(pending.popleft().get())
+					members += 1
+	finally:
+		# a reader that gave up leaves the writer with a broken pipe, not blocked
+		producer.join()
+		pool.terminate()
+		pool.join()
+		scanpool.terminate()
+		scanpool.join()
+
+	if errors:
+		errExcept('packing \'%s\' failed: %s' % (src, str(errors[0])))
+	log.info('pack completed, %d entries in %d gzip members' % (len(entries), members))
+
+def readInodeHead(inode, n):
+	out = []
+	got = 0
+	for buf in inode.read():
+		out.append(buf)
+		got += len(buf)
+		if got >= n:
+			break
+	return ''.join(out)[:n]
+
+def fsTreeEntries(tree):
+	"""autotune sample entries for an extfs.FSTree"""
+	for relpath, inode in tree.walk():
+		if inode.isreg():
+			yield inode.st_size, functools.partial(readInodeHead, inode)
 		else:
-			errExcept('could not find root device')
+			yield None, None
+
+def fsTreePlanEntries(tree):
+	"""planner entries for an extfs.FSTree"""
+	for relpath, inode in tree.walk():
+		yield relpath, inode, functools.partial(readInodeHead, inode)
+
+def planConversion(args, rootfsdir):
+	"""predict what the conversion will write, how long packing takes and what clients need, and print it; returns [problem]"""
+	if (args.onlypack or args.onlyboot) and os.path.isdir(rootfsdir):
+		log.info('planning from the rootfs at \'%s\'' % rootfsdir)
+		plan = planner.Plan(planner.dirEntries(rootfsdir), GZIP_C_PROG)
+	else:
+		log.info('planning from the image \'%s\'' % args.vdifile)
+		with diskimage.openImage(args.vdifile) as image:
+			tree = findImageTree(image)
+			plan = planner.Plan(fsTreePlanEntries(tree), GZIP_C_PROG)
+		plan.layout = [('/', tree.rootfs.name, tree.rootfs.fstype)] + [('/' + mount, fs.name, fs.fstype) for mount, fs in sorted(tree.mounts.iteritems())]
+
+	# the rootfs copy only costs space if this run makes it
+	budget = dict(rootfs=not args.direct and not os.path.isdir(rootfsdir), blockimage=args.blockimage, chunkstore=bool(args.chunkstore))
+	clientram = args.clientram * 1024 * 1024 if args.clientram else None
+	problems = plan.check(args.outdir, clientram, **budget)
+	planner.formatPlan(plan, sys.stdout, problems, **budget)
+	return problems
+
+def directConvertDisk(args, rootimg, bootfsdir):
+	"""archive the image straight from its partitions and pull out /boot and the modules, no root needed"""
+	with diskimage.openImage(args.vdifile) as image:
+		tree = findImageTree(image)
+
+		os.makedirs(args.outdir)
+
+		compressor, tuning = tunedCompressor(args, 'rootimg', fsTreeEntries(tree))
+
+		log.info('packing rootfs straight from the image')
+		start = time.time()
+		treeZipPack(tree, rootimg, replace={'etc/fstab': STATELESS_FSTAB}, compressor=compressor)
+		recordCompression(args.outdir, 'rootimg', tuning, rootimg, time.time() - start)
+		writeBlockSums(rootimg)
+
+		log.info('extracting boot resources')
+		tree.extract('boot', os.path.join(bootfsdir, 'boot'))
+		tree.extract('lib/modules', os.path.join(bootfsdir, 'lib/modules'))
+
+def writeBlockSums(archive, blocksize=SUMS_BLOCK_SIZE):
+	"""write ARCHIVE.sums, the sha1 of every block of the archive, so clients can verify it as it streams in and resume at the last good block"""
+	dst = archive + '.sums'
+	size = os.path.getsize(archive)
+	with open(archive, 'rb') as fh:
+		with open(dst + '~', 'w') as out:
+			out.write('# all7fever block sums for %s, %d bytes\n' % (os.path.basename(archive), size))
+			out.write('# sha1 offset length\n')
+			offset = 0
+			while True:
+				buf = fh.read(blocksize)
+				if not buf:
+					break
+				out.write('%s %d %d\n' % (hashlib.sha1(buf).hexdigest(), offset, len(buf)))
+				offset += len(buf)
+	os.rename(dst + '~', dst)
+	log.debug('wrote block sums for \'%s\' to \'%s\'' % (archive, dst))
+
+def publishChunks(rootimg, storedir, keep=None):
+	"""add the packed rootfs to a chunk store as a new version, for clients that boot with chunkstore=, then drop all but the newest keep versions"""
+	log.info('publishing \'%s\' to the chunk store at \'%s\'' % (rootimg, storedir))
+	store = chunkstore.ChunkStore(storedir)
+	with gzip.open(rootimg, 'rb') as fh:
+		version, entries, newchunks, newbytes = store.publish(fh)
+	log.info('chunk store version \'%s\': %d of %d chunks are new, %d bytes to download for clients with the previous version cached' % (version, newchunks, len(entries), newbytes))
+	if keep:
+		removed = store.prune(keep)
+		log.info('pruned the chunk store to the newest %d versions, %d chunks removed' % (keep, removed))
+
+def makeBlockImage(rootfsdir, dst):
+	"""write the rootfs as an ext4 image for clients that boot with rootblock=, shrunk to fit"""
+	size = treeSize(rootfsdir)
+	inodes = sum(1 for entry in TreeWalker(rootfsdir))
+	# generous to start with, resize2fs takes it down to the minimum
+	kbytes = int(size * 1.3 / 1024) + inodes * BLOCKIMAGE_INODE_SIZE / 1024 + 64 * 1024
+	log.info('writing block image \'%s\'' % dst)
+	if os.path.exists(dst):
+		os.unlink(dst)
+	rc, out, err = runCommand(['mke2fs', '-q', '-F', '-t', 'ext4', '-O', '^has_journal', '-b', str(BLOCKIMAGE_BLOCK_SIZE),
+		'-I', str(BLOCKIMAGE_INODE_SIZE), '-N', str(inodes + 1024), '-m', '0', '-L', 'rootfs', '-d', rootfsdir, dst, '%dk' % kbytes])
+	if rc != 0:
+		errExcept('mke2fs failed [rc=%d] (-d needs e2fsprogs 1.43 or newer): %s' % (rc, err.strip()))
+	rc, out, err = runCommand(['resize2fs', '-M', dst])
+	if rc != 0:
+		log.warn('could not shrink \'%s\' [rc=%d]: %s' % (dst, rc, err.strip()))
+	log.info('block image is %d bytes for %d bytes of files' % (os.path.getsize(dst), size))
+
+def packLayers(args, rootfsdir):
+	"""pack what the rootfs adds to the base conversion in args.layered as an overlay archive, packing the base too if need be"""
+	basefsdir = os.path.join(args.layered, 'rootfs')
+	baseimg = os.path.join(args.layered, 'rootimg.cpio.gz')
+	if not os.path.isdir(basefsdir):
+		errExcept('no base rootfs at \'%s\', convert the base image into \'%s\' first' % (basefsdir, args.layered))
+	if not os.path.exists(baseimg):
+		log.info('packing base layer \'%s\'' % baseimg)
+		if args.reproducible:
+			reproducibleZipPack(basefsdir, baseimg, mtimeclamp=args.clampmtime)
+		else:
+			cpioZipPack(basefsdir, baseimg, progress=True)
+		writeBlockSums(baseimg)
+
+	diff = layers.TreeDiff(basefsdir, rootfsdir, checksum=args.checksum).diff()
+	whiteouts = os.path.join(args.outdir, 'overlay.whiteouts')
+	diff.writeWhiteouts(whiteouts)
+
+	overlay = os.path.join(args.outdir, 'overlay.cpio.gz')
+	compressor, tuning = tunedCompressor(args, 'overlay', autotune.pathEntries(rootfsdir, diff.overlay))
+	start = time.time()
+	if args.reproducible:
+		reproducibleZipPack(rootfsdir, overlay, names=diff.overlay, mtimeclamp=args.clampmtime)
+	else:
+		cpioZipPack(rootfsdir, overlay, compressor=compressor, names=diff.overlay)
+	recordCompression(args.outdir, 'overlay', tuning, overlay, time.time() - start)
+	writeBlockSums(overlay)
+
+	updateMetadata(args.outdir, 'layers', {'base': os.path.abspath(baseimg), 'overlay_entries': len(diff.overlay),
+		'overlay_file_bytes': diff.overlaybytes, 'whiteouts': len(diff.whiteouts), 'overlay_bytes': os.path.getsize(overlay)})
+	log.info('overlay is %d bytes, the base layer \'%s\' is %d bytes and shared' % (os.path.getsize(overlay), baseimg, os.path.getsize(baseimg)))
 
 def mtime(fname):
 	return os.stat(fname)[8]
@@ -624,6 +1238,11 @@ def strInFileMagic(fname, s):
 	return False
 
 def getFileMagic(fname):
+	st = os.stat(fname)
+	key = (os.path.abspath(fname), st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+	if key in magicCache:
+		return magicCache[key]
+
 	log.debug('checking file magic for \'%s\'' % fname)
 	filepath = '/'.join(which('file'))
 	fp = subprocess.Popen([filepath, fname], close_fds=True, stderr=None, stdout=subprocess.PIPE, stdin=None)
@@ -633,6 +1252,7 @@ def getFileMagic(fname):
 	if rc != 0:
 		errExcept('file utility did not exit nicely [rc=%d]' % rc)
 
+	magicCache[key] = stdout
 	return stdout
 
 # TODO use /etc/issue to detect types (lookup types)
@@ -640,80 +1260,49 @@ def detectOSType(rootfsdir):
 	return 'debian'
 
 # TODO write generalized pipeline library
+@contextlib.contextmanager
+def gzipStream(src):
+	"""the decompressed contents of src as a file object, from GZIP_D_PROG when installed"""
+	progpath = which(GZIP_D_PROG[0])
+	if progpath is None:
+		log.debug('no %s, decompressing \'%s\' in-process' % (GZIP_D_PROG[0], src))
+		fh = gzip.open(src, 'rb')
+		try:
+			yield fh
+		finally:
+			fh.close()
+		return
+
+	args = ['/'.join(progpath)] + GZIP_D_PROG[1:] + [src]
+	log.debug('gzip args: %s' % str(args))
+	with open(os.devnull, 'w') as devnull:
+		gzipcp = subprocess.Popen(args, stdin=None, stderr=devnull, stdout=subprocess.PIPE, close_fds=True)
+	try:
+		yield gzipcp.stdout
+		# whatever the reader left, so the decompressor isn't killed by a closed pipe
+		while gzipcp.stdout.read(1024 * 1024):
+			pass
+	except Exception:
+		gzipcp.send_signal(signal.SIGINT)
+		gzipcp.wait()
+		raise
+	finally:
+		gzipcp.stdout.close()
+	rc = gzipcp.wait()
+	if rc != 0:
+		errExcept('decompressing \'%s\' failed [rc=%d]' % (src, rc))
+
 def extractGZCpio(src, dst, **kwargs):
 	log.debug('starting cpio extraction \'%s\' -> \'%s\'' % (src, dst))
 
 	if not os.path.exists(src):
-		errExcept('cannot find cpio-gz archive for extraction \'\'')
+		errExcept('cannot find cpio-gz archive for extraction \'%s\'' % src)
 
 	log.debug('creating dst directory \'%s\'' % dst)
 	os.mkdir(dst)
 
-	progress = False
-	if 'progress' in kwargs:
-		progress = kwargs['progress']
-		log.debug('requested progress bar')
-	else:
-		log.debug('no progress bar')
-	
-	srccp = None
-	midcp = None
-	dstcp = None
-
-	def killPipeline():
-		for fh in [dstcp, midcp, srccp]:
-			if fh is not None:
-				fh.send_signal(signal.SIGINT)
-
-	try:
-		devnull = open('/dev/null', 'w')
-
-		assert(len(GZIP_D_PROG) > 0)
-		assert(which(GZIP_D_PROG[0]) is not None)
-		gzipcp = '/'.join(which(GZIP_D_PROG[0]))
-		args = [ gzipcp ] + GZIP_D_PROG[1:] + [ src ]
-		log.debug('gzip args: %s' % str(args))
-		srccp = subprocess.Popen(args, stdin=None, stderr=devnull, stdout=subprocess.PIPE, close_fds=True)
-
-		if progress:
-			pvpath = which('pv')
-			if pvpath is None:
-				log.warn('install pv for progress bar, disabling')
-				progress = False
-
-		if progress:
-			pvpath = '/'.join(pvpath)
-			args = [pvpath, '-pter', '-i', '0.5']
-			log.debug('pv args: %s' % str(args))
-			midcp = subprocess.Popen(args, stdin=srccp.stdout, stdout=subprocess.PIPE)
-		else:
-			midcp = srccp
-
-		cpiopath = '/'.join(which('cpio'))
-		args = [cpiopath, '-idmv']
-		log.debug('dst cpio args: %s' % str(args))
-		dstcp = subprocess.Popen(args, cwd=dst, stdin=midcp.stdout, stderr=devnull, stdout=devnull, close_fds=True)
-
-		devnull.close()
-
-	except OSError, e:
-		log.warn('encountered os error %s' % str(e)) 
-		killPipeline()
-		raise
-
-	except Exception, e:
-		log.warn('encountered unhandled exception %s' % str(e)) 
-		killPipeline()
-		raise	
-
-	finally:
-		for fh in [dstcp, midcp, srccp]:
-			if fh is not None:
-				rc = fh.wait()
-				if rc != 0:
-					log.warn('cpio extract process did not exit nicely [rc=%d]' % rc)
-					killPipeline()
-					errExcept('killed pipeline because of bad exit codes')
+	with gzipStream(src) as fh:
+		NewcExtractor(dst, progress=kwargs.get('progress', False)).extract(fh)
 
 	log.info('rootfs copy completed')
 
@@ -735,94 +1324,184 @@ def copyNetworkDrivers(modpath, tgt):
 	distutils.dir_util.copy_tree(hostmod, tgtmod)
 
 def toolInitScript(initrdtmp, ostype):
-	if ostype == 'debian':
+	if ostype in INIT_SCRIPTS:
 		dstfile = os.path.join(initrdtmp, 'scripts/stateless')
-		shutil.copyfile('init-scripts/debian/stateless.debian6.sh', dstfile)
+		shutil.copyfile(INIT_SCRIPTS[ostype], dstfile)
 	else:
 		errExcept('don\'t know how to tool initrd to boot stateless for \'%s\', cannot continue')
 
-def writeGpxeScript(outdir, ostype):
+def toolBlockClient(initrdtmp):
+	"""add the on-demand block client for rootblock=, which also needs python and nbd-client in the initrd"""
+	shutil.copyfile('httpblock.py', os.path.join(initrdtmp, 'scripts/httpblock.py'))
+	missing = [prog for prog in ('python', 'nbd-client') if not glob.glob(os.path.join(initrdtmp, '*bin', prog)) and not glob.glob(os.path.join(initrdtmp, 'usr/*bin', prog))]
+	if missing:
+		log.warn('the initrd has no %s, clients booting with rootblock= will fall back to root=' % ' or '.join(missing))
+
+def initrdCacheKey(args, ipath, modpath, modrelpath, ostype):
+	"""everything the modified initrd is made from"""
+	key = buildcache.CacheKey()
+	key.addString('format', INITRD_CACHE_FORMAT)
+	key.addString('ostype', ostype)
+	key.addFile('initrd', ipath)
+	key.addString('modrelpath', modrelpath)
+	key.addTree('netmodules', os.path.join(modpath, 'kernel/net'))
+	if ostype in INIT_SCRIPTS:
+		key.addFile('initscript', INIT_SCRIPTS[ostype])
+	if getattr(args, 'blockimage', False):
+		key.addFile('httpblock', 'httpblock.py')
+	if getattr(args, 'autotune', None):
+		key.addString('compressor', 'autotune ' + args.autotune)
+	else:
+		key.addString('compressor', ' '.join(GZIP_C_PROG))
+	return key.hexdigest()
+
+def layeredGpxeScript(script, outdir, basedir):
+	"""boot the base and overlay archives in place of root=, with the directory holding both output directories served"""
+	role = os.path.basename(os.path.abspath(outdir))
+	base = os.path.basename(os.path.abspath(basedir))
+	script = re.sub(r'(http://[^/\s]+)/(vmlinuz|initrd\.gz)', r'\1/%s/\2' % role, script)
+	return re.sub(r'root=(http://[^/\s]+)/rootimg\.cpio\.gz', r'layers=\1/%s/rootimg.cpio.gz,\1/%s/overlay.cpio.gz' % (base, role), script)
+
+def imageVersion(outdir):
+	"""when the newest root archive or image in outdir was written, which stays put while the image doesn't change"""
+	images = [os.path.join(outdir, name) for name in ('rootimg.cpio.gz', 'overlay.cpio.gz', 'rootimg.ext4')]
+	images = [path for path in images if os.path.exists(path)]
+	if not images:
+		return 'unknown'
+	return time.strftime('%Y%m%d%H%M%S', time.gmtime(max(mtime(path) for path in images)))
+
+def writeGpxeScript(outdir, ostype, args=None, kversion=None):
+	"""OUTDIR/debian.gpxe boots the default kernel, with kversion OUTDIR/debian-KVERSION.gpxe boots that one"""
 	if ostype == 'debian':
 		dstfile = os.path.join(outdir, 'debian.gpxe')
-		shutil.copyfile('gpxe-scripts/debian.gpxe', dstfile)
+		with open('gpxe-scripts/debian.gpxe', 'r') as fh:
+			script = fh.read()
+		if getattr(args, 'layered', None):
+			script = layeredGpxeScript(script, outdir, args.layered)
+		if kversion is not None:
+			dstfile = os.path.join(outdir, 'debian-%s.gpxe' % kversion)
+			script = re.sub(r'/(vmlinuz|initrd\.gz)\b', r'/kernels/%s/\1' % kversion, script)
+		if getattr(args, 'boottrace', None):
+			# the init script extracts rootimg.boot.cpio.gz first, see orderedZipPack
+			script = re.sub(r'(root=\S+)', r'\1 rootsplit=1', script)
+		if getattr(args, 'telemetry', None):
+			version = imageVersion(outdir)
+			updateMetadata(outdir, 'image_version', version)
+			script = re.sub(r'((root|layers)=\S+)', r'\1 telemetry=%s imageversion=%s' % (args.telemetry.rstrip('/'), version), script)
+		with open(dstfile, 'w') as fh:
+			fh.write(script)
 		log.info('gpxe script written to \'%s\'' % dstfile)
 	else:
 		errExcept('don\'t know how to generate gpxe script for \'%s\', cannot continue')
 
+def writeGpxeMenu(outdir, ostype, kversions, default):
+	"""OUTDIR/OSTYPE-menu.gpxe chains to the script of the kernel picked, menus need iPXE"""
+	dstfile = os.path.join(outdir, '%s-menu.gpxe' % ostype)
+	with open(dstfile, 'w') as fh:
+		fh.write('#!gpxe\n')
+		fh.write('menu boot kernel\n')
+		for kversion in reversed(kversions):
+			fh.write('item %s %s%s\n' % (kversion, kversion, ' (default)' if kversion == default else ''))
+		fh.write('choose --default %s --timeout 5000 kversion || goto failed\n' % default)
+		# relative to where this script was fetched from
+		fh.write('chain %s-${kversion}.gpxe\n' % ostype)
+		fh.write(':failed\n')
+		fh.write('chain %s.gpxe\n' % ostype)
+	log.info('gpxe menu for %d kernels written to \'%s\'' % (len(kversions), dstfile))
+
 def writeStatelessFstab(rootfsdir):
 	fstabpath = os.path.join(rootfsdir, 'etc/fstab')
 	fsfh = open(fstabpath, 'w')
-	print >>fsfh, "devpts  /dev/pts devpts   gid=5,mode=620 0 0"
-	print >>fsfh, "tmpfs   /dev/shm tmpfs    defaults       0 0"
-	print >>fsfh, "proc    /proc    proc     defaults       0 0"
-	print >>fsfh, "sysfs   /sys     sysfs    defaults       0 0"
+	fsfh.write(STATELESS_FSTAB)
 	fsfh.close()
 	log.debug('modified fstab at \'%s\'' % fstabpath)
 
-def createBootPackage(args, rootfsdir):
-	outdir = args.outdir
-	bootdir = os.path.join(rootfsdir, 'boot')
-
-	### detect OS type
-	ostype = detectOSType(rootfsdir)
-	log.info('guessing OS type \'%s\'' % ostype)
+def kernelVersion(kpath):
+	"""the version string the kernel reports, from its file magic or else its name (vmlinuz-VERSION)"""
+	verstring = re.search(':\s*Linux kernel.*,\s*version\s+(\S+)', getFileMagic(kpath))
+	if verstring is not None:
+		return verstring.group(1)
+	name = os.path.basename(kpath)
+	if '-' in name:
+		return name.split('-', 1)[1]
+	return None
 
-	### locate and copy the current initrd, kernel
-	# TODO/HACK based on file modification times
-	bootfiles = os.listdir(bootdir)
-	bootfiles = map(lambda fname: os.path.join(bootdir, fname), bootfiles)
+def bootKernels(rootfsdir):
+	"""
+	pair every kernel in /boot with its initrd and modules by version,
+	returns [{'version', 'kernel', 'initrd', 'modules'}] oldest kernel first
+	"""
+	bootdir = os.path.join(rootfsdir, 'boot')
+	bootfiles = sorted(os.path.join(bootdir, fname) for fname in os.listdir(bootdir))
+	bootfiles = filter(os.path.isfile, bootfiles)
 
-	# kernel
 	kernels = filter(lambda fname: strInFileMagic(fname, 'Linux kernel'), bootfiles)
-	kernels = sorted(kernels, key=mtime)
-
-	kpath  = os.path.join(outdir, 'vmlinuz')
-	ipath  = os.path.join(outdir, 'initrd.orig.gz')
-
-	for k in kernels:
-		# other checking?
-		log.info('chose kernel \'%s\'' % k)
-		shutil.copyfile(k, kpath)
-		break
 
-	# initrd
 	initrds = filter(lambda fname: 'initrd' in fname or 'initramfs' in fname, bootfiles)
 	initrds = sorted(initrds, key=mtime)
-
-	for i in initrds:
+	for i in list(initrds):
 		if not strInFileMagic(i, 'gzip compressed data'):
 			log.warn('this does not look like a gzip compressed initrd: \'%s\', skipping' % i)
+			initrds.remove(i)
+
+	pairs = []
+	for k in kernels:
+		kversion = kernelVersion(k)
+		if kversion is None:
+			log.warn('cannot determine the version of kernel \'%s\', skipping' % k)
 			continue
-		log.info('chose initrd \'%s\'' % i)
-		shutil.copyfile(i, ipath)
-		break
-
-	### process initrd to stateless boot
-	if not os.path.exists(kpath):
-		errExcept('missing kernel at \'%s\'- cannot continue preparing boot resources' % kpath)
-	if not os.path.exists(ipath):
-		errExcept('missing initrd at \'%s\'- cannot continue preparing boot resources' % ipath)
-
-	log.info('determine kernel version')
-	kmagic = getFileMagic(kpath)
-	verstring = re.search(':\s*Linux kernel.*,\s*version\s*([0-9]+\.[0-9]\.[0-9](-[0-9]+))', kmagic)
-	if verstring is None:
-		errExcept('cannot determine kernel version')
-
-	kversion = verstring.group(1)
-	log.debug('kernel version \'%s\'' % kversion)
-
-	log.info('locate kernel modules')
-	modpaths= glob.glob("%s/lib/modules/%s-*" % (rootfsdir, kversion))
-	if len(modpaths) < 1:
-		errExcept('could not find kernel modules for kernel version')
-		
-	modpath = modpaths[0]
-	log.debug('modules found at \'%s\'' % modpath)
-	
+		log.debug('kernel \'%s\' is version \'%s\'' % (k, kversion))
+
+		# initrd.img-VERSION, initramfs-VERSION.img and the like
+		matching = [i for i in initrds if re.search(r'[-_.]%s(\.img|\.gz)?$' % re.escape(kversion), os.path.basename(i))]
+		if not matching and len(kernels) == 1 and initrds:
+			# a single kernel goes with the newest initrd, whatever it is called
+			matching = initrds
+		if not matching:
+			log.warn('no initrd for kernel version \'%s\', skipping' % kversion)
+			continue
+
+		modpath = os.path.join(rootfsdir, 'lib/modules', kversion)
+		if not os.path.isdir(modpath):
+			modpaths = sorted(glob.glob('%s/lib/modules/%s*' % (rootfsdir, kversion.split('-')[0])))
+			if len(modpaths) < 1:
+				log.warn('could not find kernel modules for kernel version \'%s\', skipping' % kversion)
+				continue
+			modpath = modpaths[0]
+
+		pairs.append({'version': kversion, 'kernel': k, 'initrd': matching[-1], 'modules': modpath})
+		log.info('kernel \'%s\' with initrd \'%s\' and modules \'%s\'' % (k, matching[-1], modpath))
+
+	# newest last, by version where package installs left the same mtimes
+	return sorted(pairs, key=lambda pair: (mtime(pair['kernel']), LooseVersion(pair['version'])))
+
+def buildKernelInitrd(args, rootfsdir, ostype, pair):
+	"""copy one kernel to OUTDIR/kernels/VERSION and put a stateless initrd.gz for it next to it"""
+	outdir = args.outdir
+	kversion = pair['version']
+	kerneldir = os.path.join(outdir, 'kernels', kversion)
+	if not os.path.isdir(kerneldir):
+		os.makedirs(kerneldir)
+
+	kpath = os.path.join(kerneldir, 'vmlinuz')
+	ipath = os.path.join(kerneldir, 'initrd.orig.gz')
+	shutil.copyfile(pair['kernel'], kpath)
+	shutil.copyfile(pair['initrd'], ipath)
+
+	modpath = pair['modules']
 	modrelpath = str(modpath[len(rootfsdir):]).lstrip('/')
 
-	log.info('extracting initrd')
+	modifiedinitrd = os.path.join(kerneldir, 'initrd.gz')
+	cache = None
+	if getattr(args, 'initrdcache', None):
+		cache = buildcache.BuildCache(args.initrdcache, args.initrdcachesize * 1024 * 1024)
+		cachekey = initrdCacheKey(args, ipath, modpath, modrelpath, ostype)
+		cached = cache.get(cachekey, modifiedinitrd)
+		if cached is not None:
+			log.info('initrd for kernel \'%s\' was built from the same initrd, modules and init script before, using the cached one' % kversion)
+			return cached.get('compression')
+
+	log.info('extracting initrd for kernel \'%s\'' % kversion)
 	with tempdir() as tmpdir:
 		initrdtmp = os.path.join(tmpdir, 'initrd')
 		log.debug('initrd working dir: \'%s\'' % initrdtmp)
@@ -831,37 +1510,198 @@ def createBootPackage(args, rootfsdir):
 		# add network drivers
 		tgt = os.path.join(initrdtmp, modrelpath)
 		copyNetworkDrivers(modpath, tgt)
-	
+
 		# replace init file
 		toolInitScript(initrdtmp, ostype)
+		if getattr(args, 'blockimage', False):
+			toolBlockClient(initrdtmp)
+
+		# repack initrd, never writing through to a cached initrd linked in by an earlier run
+		compressor, tuning = tunedCompressor(args, 'initrd-%s' % kversion, autotune.dirEntries(initrdtmp))
+		start = time.time()
+		if os.path.exists(modifiedinitrd):
+			os.unlink(modifiedinitrd)
+		cpioZipPack(initrdtmp, modifiedinitrd, compressor=compressor)
+		recordCompression(outdir, 'initrd-%s' % kversion, tuning, modifiedinitrd, time.time() - start)
+		log.debug('wrote modified initrd to \'%s\'' % modifiedinitrd)
+
+	if cache is not None:
+		cache.put(cachekey, modifiedinitrd, {'kernel': kversion, 'source': os.path.basename(pair['initrd']), 'compression': tuning})
+	return tuning
+
+def linkOrCopy(src, dst):
+	if os.path.exists(dst):
+		os.unlink(dst)
+	try:
+		os.link(src, dst)
+	except OSError:
+		shutil.copyfile(src, dst)
 
-		# repack initrd
-		modifiedinitrd = os.path.join(outdir, 'initrd.gz')
-		cpioZipPack(initrdtmp, modifiedinitrd)
-		log.debug('wrote modified initrd to \'%s\'' % modifiedinitrd, progress=True)
+def createBootPackage(args, rootfsdir):
+	outdir = args.outdir
 
-	# write gpxe script
-	writeGpxeScript(outdir, ostype)
+	### detect OS type
+	ostype = detectOSType(rootfsdir)
+	log.info('guessing OS type \'%s\'' % ostype)
 
-# MAIN
-if __name__ == '__main__':
+	### pair up every kernel, initrd and module tree in the image
+	pairs = bootKernels(rootfsdir)
+	if not pairs:
+		errExcept('no kernel with an initrd and modules in \'%s\' - cannot continue preparing boot resources' % os.path.join(rootfsdir, 'boot'))
+
+	### process each initrd to stateless boot, all at once
+	pool = ThreadPool(len(pairs))
+	try:
+		tunings = pool.map(functools.partial(buildKernelInitrd, args, rootfsdir, ostype), pairs)
+	finally:
+		pool.close()
+		pool.join()
+
+	# the newest kernel is the one OUTDIR/vmlinuz, initrd.gz and debian.gpxe boot, as before
+	default = pairs[-1]['version']
+	kerneldir = os.path.join(outdir, 'kernels', default)
+	linkOrCopy(os.path.join(kerneldir, 'vmlinuz'), os.path.join(outdir, 'vmlinuz'))
+	linkOrCopy(os.path.join(kerneldir, 'initrd.gz'), os.path.join(outdir, 'initrd.gz'))
+	log.info('default kernel is \'%s\'' % default)
+
+	# drop kernels that are no longer in the image
+	versions = [pair['version'] for pair in pairs]
+	for name in os.listdir(os.path.join(outdir, 'kernels')):
+		if name not in versions:
+			log.info('kernel \'%s\' is gone from the image, removing its boot resources' % name)
+			shutil.rmtree(os.path.join(outdir, 'kernels', name))
+			if os.path.exists(os.path.join(outdir, '%s-%s.gpxe' % (ostype, name))):
+				os.unlink(os.path.join(outdir, '%s-%s.gpxe' % (ostype, name)))
+
+	kernels = {}
+	for pair, tuning in zip(pairs, tunings):
+		kernels[pair['version']] = {'kernel': os.path.basename(pair['kernel']), 'initrd': os.path.basename(pair['initrd']),
+			'modules': pair['modules'][len(rootfsdir):]}
+		if tuning is not None:
+			updateMetadata(outdir, 'compression', {'initrd-%s' % pair['version']: tuning})
+			if pair['version'] == default:
+				updateMetadata(outdir, 'compression', {'initrd': tuning})
+	updateMetadata(outdir, 'kernels', kernels, merge=False)
+	updateMetadata(outdir, 'default_kernel', default)
+
+	# write gpxe scripts, one per kernel and a menu to pick from them
+	writeGpxeScript(outdir, ostype, args)
+	for kversion in versions:
+		writeGpxeScript(outdir, ostype, args, kversion)
+	writeGpxeMenu(outdir, ostype, versions, default)
+
+def saveProfile(profiler, outdir):
+	profiler.stop()
+	# the output directory won't exist if we failed early
+	dst = outdir if os.path.isdir(outdir) else '.'
+	report = os.path.join(dst, 'profile.txt')
+	profiler.save(report, os.path.join(dst, 'profile.pstats'))
+	log.info('profile written to \'%s\'' % report)
+
+def argParser():
 	ap = argparse.ArgumentParser()
-	ap.add_argument('vdifile', metavar='VDI', help='a (.vdi) disk image')
+	ap.add_argument('vdifile', metavar='IMAGE', help='a disk image, vdi (or with --direct also qcow2, vmdk or raw)')
 	ap.add_argument('outdir', metavar='OUTDIR', help='an output directory, must not exist')
 	ap.add_argument('-p','--onlypack', dest='onlypack', action='store_true', help='only run the packing phase (assumes root copied to outdir)')
 	ap.add_argument('-b','--onlyboot', dest='onlyboot', action='store_true', help='only run the boot resources phase (assumes root copied to outdir)')
-	args = ap.parse_args()
-
+	ap.add_argument('-c','--cpiocopy', dest='cpiocopy', action='store_true', help='copy the rootfs with a find|cpio pipeline instead of the in-process copier')
+	ap.add_argument('-d','--direct', dest='direct', action='store_true', help='read the image in userspace and pack it without mounting or copying the rootfs (ext2/3/4 only, no root needed)')
+	ap.add_argument('-u','--update', dest='update', action='store_true', help='sync an existing OUTDIR/rootfs with the image instead of copying it from scratch, and only repack if something changed')
+	ap.add_argument('--checksum', dest='checksum', action='store_true', help='with --update or --layered, compare file contents and not just size and mtime')
+	ap.add_argument('--layered', dest='layered', metavar='BASEDIR', help='instead of a full archive, pack what the rootfs adds to the base image converted into BASEDIR as OUTDIR/overlay.cpio.gz; clients extract BASEDIR/rootimg.cpio.gz and then the overlay')
+	ap.add_argument('--chunkstore', dest='chunkstore', metavar='DIR', help='also publish the rootfs archive as a new version in the chunk store at DIR, for delta boots')
+	ap.add_argument('--chunkstore-keep', dest='chunkstorekeep', metavar='N', type=int, help='with --chunkstore, delete all but the newest N versions and the chunks only they used after publishing (default keep everything)')
+	ap.add_argument('--boottrace', dest='boottrace', metavar='LIST', help='pack the files in LIST, made with boottrace.py on a booted client, first and also as OUTDIR/rootimg.boot.cpio.gz, so clients run init once those are extracted and get the rest in the background')
+	ap.add_argument('--telemetry', dest='telemetry', metavar='URL', help='have clients report how long each boot stage took to the collector at URL (see collector.py), grouped by image version')
+	ap.add_argument('--blockimage', dest='blockimage', action='store_true', help='also write the rootfs as an ext4 image, OUTDIR/rootimg.ext4, that clients booting with rootblock= mount over HTTP and fetch on demand')
+	ap.add_argument('--initrdcache', dest='initrdcache', metavar='DIR', default=INITRD_CACHE_DIR, help='reuse modified initrds built from the same initrd, modules and init script, kept in DIR (default %(default)s)')
+	ap.add_argument('--initrdcache-size', dest='initrdcachesize', metavar='MB', type=int, default=512, help='least recently used initrds are evicted past this size (default 512)')
+	ap.add_argument('--no-initrdcache', dest='initrdcache', action='store_const', const=None, help='always rebuild the initrd')
+	ap.add_argument('--reproducible', dest='reproducible', action='store_true', help='pack archives that only depend on the tree (sorted entries, inode numbers hashed from names, mtimes clamped) with compression restarted at content-defined boundaries, so replicating a new archive with rsync only moves what changed')
+	ap.add_argument('--clamp-mtime', dest='clampmtime', metavar='EPOCH', type=int, default=os.environ.get('SOURCE_DATE_EPOCH'), help='with --reproducible, archive no mtime later than EPOCH (default $SOURCE_DATE_EPOCH, if set)')
+	ap.add_argument('--autotune', dest='autotune', metavar='TARGET', help='pick the gzip level for the archive and the initrd from a sample of each; TARGET is time=SECONDS, size=BYTES, decompress=SECONDS or balanced.  the choice is recorded in OUTDIR/metadata.json')
+	ap.add_argument('--plan', dest='plan', action='store_true', help='only predict the rootfs and archive sizes, the pack time and the RAM clients need, from the image\'s layout and a sample of its files; exits 1 if the output won\'t fit or clients don\'t have the RAM')
+	ap.add_argument('--preflight', dest='preflight', action='store_true', help='plan as --plan does first, and refuse to start if the output won\'t fit or clients don\'t have the RAM')
+	ap.add_argument('--client-ram', dest='clientram', metavar='MB', type=int, help='with --plan or --preflight, the RAM of the smallest client')
+	ap.add_argument('--profile', dest='profile', action='store_true', help='profile the run and write a report of python, child process and i/o wait time per phase to OUTDIR/profile.txt')
+	ap.add_argument('-j','--copyjobs', dest='copyjobs', metavar='N', type=int, default=8, help='number of files copied in parallel by the in-process copier (default 8)')
+	return ap
+
+def convert(args):
+	"""run a conversion with parsed arguments, returns the exit status"""
 	# TODO make more sense of onlyPHASE and notPHASE, calculate phases at arg time and make logic simpler during phase exec
 
-	if not args.onlypack and not args.onlyboot and os.path.exists(args.outdir):
-		errExcept('cannot make output directory \'%s\', check permissions and path' % args.outdir)
+	if args.reproducible and (args.boottrace or args.autotune or args.direct):
+		errExcept('--reproducible can\'t be combined with --boottrace, --autotune or --direct, it packs and compresses in its own way')
+
+	if args.layered and (args.chunkstore or args.boottrace):
+		errExcept('--layered can\'t be combined with --chunkstore or --boottrace, they need the full archive')
+
+	if args.chunkstorekeep is not None and (not args.chunkstore or args.chunkstorekeep < 1):
+		errExcept('--chunkstore-keep needs --chunkstore and at least 1 version to keep')
+
+	if args.update and (args.onlypack or args.onlyboot or args.direct or args.cpiocopy):
+		errExcept('--update can\'t be combined with --onlypack, --onlyboot, --direct or --cpiocopy')
+
+	if not args.plan and not args.direct and not args.onlypack and not args.onlyboot and os.path.isfile(args.vdifile):
+		imageformat = diskimage.imageFormat(args.vdifile)
+		if imageformat != 'vdi':
+			errExcept('\'%s\' is a %s image and vdfuse only mounts vdi images, convert it with --direct, which reads %s images itself' % (args.vdifile, imageformat, imageformat))
 
 	rootfsdir = os.path.join(args.outdir, 'rootfs')
 
+	if args.plan or args.preflight:
+		problems = planConversion(args, rootfsdir)
+		if args.plan:
+			return 1 if problems else 0
+		if problems:
+			errExcept('refusing to start the conversion: %s' % '; '.join(problems))
+
+	if not args.onlypack and not args.onlyboot and not args.update and os.path.exists(args.outdir):
+		errExcept('cannot make output directory \'%s\', check permissions and path' % args.outdir)
+
+	if not args.profile:
+		return convertPhases(args, rootfsdir, profiling.NullProfiler())
+
+	profiler = profiling.Profiler()
+	profiler.start()
+	try:
+		return convertPhases(args, rootfsdir, profiler)
+	finally:
+		saveProfile(profiler, args.outdir)
+
+def convertPhases(args, rootfsdir, profiler):
+	# DIRECT MODE: no rootfs copy, the archive and boot resources come straight from the image
+	if args.direct:
+		if args.onlypack or args.onlyboot:
+			errExcept('--direct runs every phase from the image, it can\'t be combined with --onlypack/--onlyboot')
+		if args.blockimage or args.layered or args.boottrace:
+			errExcept('--blockimage, --layered and --boottrace work from the rootfs copy, they can\'t be combined with --direct')
+
+		bootfsdir = os.path.join(args.outdir, 'bootfs')
+		rootimg = os.path.join(args.outdir, 'rootimg.cpio.gz')
+		with profiler.phase('direct'):
+			directConvertDisk(args, rootimg, bootfsdir)
+		if args.chunkstore:
+			with profiler.phase('chunkstore'):
+				publishChunks(rootimg, args.chunkstore, args.chunkstorekeep)
+		with profiler.phase('boot'):
+			createBootPackage(args, bootfsdir)
+		return 0
+
 	# COPY DISK PHASE
-	if not args.onlypack and not args.onlyboot:
-		mountAndCopyDisk(args, rootfsdir)
+	changes = None
+	if args.update:
+		if not os.path.exists(rootfsdir):
+			errExcept('nothing to update, rootfs does not exist at \'%s\'' % rootfsdir)
+		with profiler.phase('sync'):
+			changes = mountAndSyncDisk(args, rootfsdir)
+		changelist = os.path.join(args.outdir, 'changes.txt')
+		writeChangeList(changelist, changes)
+		log.info('%d changes written to \'%s\'' % (len(changes), changelist))
+	elif not args.onlypack and not args.onlyboot:
+		with profiler.phase('copy'):
+			mountAndCopyDisk(args, rootfsdir)
 
 	# rootfs should have been created at this point, in this run or a previous one
 	if not os.path.exists(rootfsdir):
@@ -874,9 +1714,46 @@ if __name__ == '__main__':
 	writeStatelessFstab(rootfsdir)
 
 	# PACK ROOTFS PHASE
-	if not args.onlyboot:
-		cpioZipPack(rootfsdir, os.path.join(args.outdir,'rootimg.cpio.gz'), progress=True)
+	rootimg = os.path.join(args.outdir,'rootimg.cpio.gz')
+	if args.layered:
+		if not args.onlyboot:
+			with profiler.phase('pack'):
+				packLayers(args, rootfsdir)
+	elif changes is not None and len(changes) == 0 and os.path.exists(rootimg):
+		log.info('rootfs unchanged, keeping \'%s\'' % rootimg)
+		if not os.path.exists(rootimg + '.sums'):
+			writeBlockSums(rootimg)
+	elif not args.onlyboot:
+		with profiler.phase('pack'):
+			compressor, tuning = tunedCompressor(args, 'rootimg', autotune.dirEntries(rootfsdir))
+			start = time.time()
+			if args.boottrace:
+				segments = boottrace.splitTree(rootfsdir, boottrace.readTrace(args.boottrace))
+				orderedZipPack(rootfsdir, rootimg, segments, compressor=compressor)
+			elif args.reproducible:
+				reproducibleZipPack(rootfsdir, rootimg, mtimeclamp=args.clampmtime)
+			else:
+				cpioZipPack(rootfsdir, rootimg, progress=True, compressor=compressor)
+			recordCompression(args.outdir, 'rootimg', tuning, rootimg, time.time() - start)
+			writeBlockSums(rootimg)
+		if args.chunkstore:
+			with profiler.phase('chunkstore'):
+				publishChunks(rootimg, args.chunkstore, args.chunkstorekeep)
+
+	blockimg = os.path.join(args.outdir, 'rootimg.ext4')
+	if args.blockimage and not args.onlyboot and not (changes is not None and len(changes) == 0 and os.path.exists(blockimg)):
+		with profiler.phase('blockimage'):
+			makeBlockImage(rootfsdir, blockimg)
 
 	# BOOT RESOURCES PHASE
-	if not args.onlypack:
-		createBootPackage(args, rootfsdir)
+	if changes is not None and not bootResourcesChanged(changes) and os.path.exists(os.path.join(args.outdir, 'initrd.gz')):
+		log.info('kernel, initrd and modules unchanged, keeping boot resources')
+	elif not args.onlypack:
+		with profiler.phase('boot'):
+			createBootPackage(args, rootfsdir)
+
+	return 0
+
+# MAIN
+if __name__ == '__main__':
+	sys.exit(convert(argParser().parse_args()))
@@ -0,0 +1,605 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only userspace ext2/3/4 reader.
+
+Works on anything with a ``pread(offset, length)`` (see diskimage.py), so a
+guest filesystem can be walked and archived without root, loop devices or
+FUSE.  Supports indirect and extent mapped files, linear and htree
+directories (htree index blocks look like empty entries to a linear scan),
+inline data, fast and slow symlinks, device nodes, in-inode and block
+xattrs and 64-bit block numbers.
+
+``FSTree`` grafts several filesystems at their mountpoints so a whole fstab
+layout can be walked as one tree.
+"""
+
+import os
+import stat
+import struct
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+EXT_SUPER_MAGIC = 0xef53
+EXT_ROOT_INO = 2
+
+COMPAT_HAS_JOURNAL = 0x4
+INCOMPAT_COMPRESSION = 0x1
+INCOMPAT_FILETYPE = 0x2
+INCOMPAT_RECOVER = 0x4
+INCOMPAT_JOURNAL_DEV = 0x8
+INCOMPAT_META_BG = 0x10
+INCOMPAT_EXTENTS = 0x40
+INCOMPAT_64BIT = 0x80
+INCOMPAT_FLEX_BG = 0x200
+INCOMPAT_INLINE_DATA = 0x8000
+INCOMPAT_ENCRYPT = 0x10000
+RO_COMPAT_SPARSE_SUPER = 0x1
+RO_COMPAT_HUGE_FILE = 0x8
+
+EXT4_INDEX_FL = 0x1000
+EXT4_HUGE_FILE_FL = 0x40000
+EXT4_EXTENTS_FL = 0x80000
+EXT4_INLINE_DATA_FL = 0x10000000
+
+EXTENT_MAGIC = 0xf30a
+EXTENT_INIT_MAX_LEN = 32768
+XATTR_MAGIC = 0xea020000
+
+XATTR_PREFIXES = {
+	1: 'user.',
+	2: 'system.posix_acl_access',
+	3: 'system.posix_acl_default',
+	4: 'trusted.',
+	6: 'security.',
+	7: 'system.',
+	8: 'system.richacl',
+}
+
+# ext4's on-disk acl tags that carry an id
+ACL_USER = 0x02
+ACL_GROUP = 0x08
+
+READ_CHUNK = 1024 * 1024
+
+
+def u32pair(lo, hi):
+	return lo | (hi << 32)
+
+def decodeTime(seconds, extra):
+	"""Seconds from the base field (signed) plus epoch bits and nanoseconds from the _extra field."""
+	if seconds & 0x80000000:
+		seconds -= 1 << 32
+	if extra is None:
+		return float(seconds)
+	return float(seconds + ((extra & 3) << 32)) + (extra >> 2) / 1e9
+
+def aclToXattr(value):
+	"""Convert ext4's compact on-disk posix acl to the xattr format the VFS uses."""
+	out = [struct.pack('<I', 2)]
+	pos = 4
+	while pos + 4 <= len(value):
+		tag, perm = struct.unpack_from('<HH', value, pos)
+		if tag in (ACL_USER, ACL_GROUP):
+			(ident,) = struct.unpack_from('<I', value, pos + 4)
+			pos += 8
+		else:
+			ident = 0xffffffff
+			pos += 4
+		out.append(struct.pack('<HHI', tag, perm, ident))
+	return ''.join(out)
+
+
+class ExtFS(object):
+	"""One ext2/3/4 filesystem on a device with pread()."""
+
+	def __init__(self, dev, name=None, devno=0):
+		self.dev = dev
+		self.name = name or repr(dev)
+		self.devno = devno	# reported as st_dev so inodes from grafted filesystems don't collide
+
+		sb = dev.pread(1024, 1024)
+		if len(sb) < 1024 or struct.unpack_from('<H', sb, 56)[0] != EXT_SUPER_MAGIC:
+			raise Exception('no ext2/3/4 superblock on \'%s\'' % self.name)
+
+		(inodescount, blockslo, _, _, _, self.firstdatablock, logblocksize, _,
+			self.blockspergroup, _, self.inodespergroup) = struct.unpack_from('<11I', sb, 0)
+		(revlevel,) = struct.unpack_from('<I', sb, 76)
+		firstino, inodesize = struct.unpack_from('<IH', sb, 84)
+		self.compat, self.incompat, self.rocompat = struct.unpack_from('<III', sb, 92)
+		uuid = sb[104:120].encode('hex')
+		self.label = sb[120:136].rstrip('\0')
+		(self.firstmetabg,) = struct.unpack_from('<I', sb, 260)
+		(descsize,) = struct.unpack_from('<H', sb, 254)
+		(blockshi,) = struct.unpack_from('<I', sb, 0x150)
+
+		self.uuid = '%s-%s-%s-%s-%s' % (uuid[0:8], uuid[8:12], uuid[12:16], uuid[16:20], uuid[20:32])
+		self.blocksize = 1024 << logblocksize
+		self.inodesize = inodesize if revlevel >= 1 else 128
+		self.is64 = bool(self.incompat & INCOMPAT_64BIT)
+		self.descsize = descsize if self.is64 and descsize >= 64 else 32
+		self.hasfiletype = bool(self.incompat & INCOMPAT_FILETYPE)
+		self.blockscount = u32pair(blockslo, blockshi if self.is64 else 0)
+
+		unsupported = self.incompat & (INCOMPAT_COMPRESSION | INCOMPAT_JOURNAL_DEV)
+		if unsupported:
+			raise Exception('\'%s\' uses unsupported ext features (incompat 0x%x)' % (self.name, unsupported))
+		if self.incompat & INCOMPAT_RECOVER:
+			log.warn('\'%s\' was not cleanly unmounted and its journal is not replayed, recent changes may be missing' % self.name)
+		if self.incompat & INCOMPAT_ENCRYPT:
+			log.warn('\'%s\' has encryption enabled, encrypted files will be read as ciphertext' % self.name)
+
+		self.groupcount = (self.blockscount - self.firstdatablock + self.blockspergroup - 1) // self.blockspergroup
+		self.inodetables = self.loadInodeTables()
+
+	@property
+	def fstype(self):
+		"""What blkid would call it."""
+		if self.incompat & (INCOMPAT_EXTENTS | INCOMPAT_64BIT | INCOMPAT_FLEX_BG | INCOMPAT_INLINE_DATA) or self.rocompat & RO_COMPAT_HUGE_FILE:
+			return 'ext4'
+		if self.compat & COMPAT_HAS_JOURNAL:
+			return 'ext3'
+		return 'ext2'
+
+	def readBlocks(self, block, count=1):
+		return self.dev.pread(block * self.blocksize, count * self.blocksize)
+
+	def groupHasSuper(self, group):
+		if group <= 1 or not self.rocompat & RO_COMPAT_SPARSE_SUPER:
+			return True
+		for base in (3, 5, 7):
+			n = base
+			while n < group:
+				n *= base
+			if n == group:
+				return True
+		return False
+
+	def loadInodeTables(self):
+		perblock = self.blocksize // self.descsize
+		descblocks = (self.groupcount + perblock - 1) // perblock
+
+		raw = []
+		for i in range(descblocks):
+			if self.incompat & INCOMPAT_META_BG and i >= self.firstmetabg:
+				group = i * perblock
+				block = self.firstdatablock + group * self.blockspergroup + (1 if self.groupHasSuper(group) else 0)
+			else:
+				block = self.firstdatablock + 1 + i
+			raw.append(self.readBlocks(block))
+		raw = ''.join(raw)
+
+		tables = []
+		for g in range(self.groupcount):
+			off = g * self.descsize
+			(lo,) = struct.unpack_from('<I', raw, off + 8)
+			hi = struct.unpack_from('<I', raw, off + 0x28)[0] if self.descsize >= 64 else 0
+			tables.append(u32pair(lo, hi))
+		return tables
+
+	def inode(self, ino):
+		group, index = divmod(ino - 1, self.inodespergroup)
+		if group >= len(self.inodetables):
+			raise Exception('inode %d out of range on \'%s\'' % (ino, self.name))
+		offset = self.inodetables[group] * self.blocksize + index * self.inodesize
+		return Inode(self, ino, self.dev.pread(offset, self.inodesize))
+
+	def root(self):
+		return self.inode(EXT_ROOT_INO)
+
+	def lookup(self, path, follow=False):
+		"""Return the inode at an absolute path, or None.  Symlinks along the way are followed."""
+		parts = [p for p in path.split('/') if p]
+		inode = self.root()
+		resolved = []
+		links = 0
+		while parts:
+			name = parts.pop(0)
+			if name == '.':
+				continue
+			if name == '..':
+				resolved = resolved[:-1]
+				inode = self.lookup('/'.join(resolved))
+				continue
+			if not inode.isdir():
+				return None
+			entries = dict((n, i) for n, i, t in inode.listdir())
+			if name not in entries:
+				return None
+			child = self.inode(entries[name])
+			if child.islnk() and (parts or follow):
+				links += 1
+				if links > 40:
+					raise Exception('too many levels of symbolic links resolving \'%s\'' % path)
+				target = child.readlink()
+				if target.startswith('/'):
+					resolved = []
+					inode = self.root()
+				parts = [p for p in target.split('/') if p] + parts
+				continue
+			resolved.append(name)
+			inode = child
+		return inode
+
+
+class Inode(object):
+	"""An inode, with a stat-like interface (st_mode, st_size, ...)."""
+
+	def __init__(self, fs, ino, raw):
+		self.fs = fs
+		self.ino = ino
+		self.raw = raw
+
+		(mode, uidlo, sizelo, atime, ctime, mtime, _, gidlo, self.st_nlink, self.blockslo,
+			self.flags) = struct.unpack_from('<HHIIIIIHHII', raw, 0)
+		self.iblock = raw[40:100]
+		(filelo, sizehi) = struct.unpack_from('<II', raw, 104)
+		(blockshi, filehi, uidhi, gidhi) = struct.unpack_from('<HHHH', raw, 116)
+
+		self.extra = 0
+		if fs.inodesize > 128:
+			(self.extra,) = struct.unpack_from('<H', raw, 128)
+
+		def extratime(off):
+			if self.extra >= off - 128 + 4:
+				return struct.unpack_from('<I', raw, off)[0]
+			return None
+
+		self.st_mode = mode
+		self.st_uid = uidlo | (uidhi << 16)
+		self.st_gid = gidlo | (gidhi << 16)
+		self.st_size = u32pair(sizelo, sizehi)
+		self.st_atime = decodeTime(atime, extratime(140))
+		self.st_mtime = decodeTime(mtime, extratime(136))
+		self.st_ctime = decodeTime(ctime, extratime(132))
+		self.st_ino = ino
+		self.st_dev = fs.devno
+		self.st_rdev = 0
+		self.fileacl = u32pair(filelo, filehi if fs.is64 else 0)
+		self.blocks512 = u32pair(self.blockslo, blockshi)
+
+		if stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+			old, new = struct.unpack_from('<II', self.iblock, 0)
+			if old:
+				self.st_rdev = os.makedev((old >> 8) & 0xff, old & 0xff)
+			else:
+				self.st_rdev = os.makedev((new & 0xfff00) >> 8, (new & 0xff) | ((new >> 12) & 0xfff00))
+
+	def __repr__(self):
+		return 'Inode(%s, %d, mode=%o, size=%d)' % (self.fs.name, self.ino, self.st_mode, self.st_size)
+
+	def isdir(self):
+		return stat.S_ISDIR(self.st_mode)
+
+	def isreg(self):
+		return stat.S_ISREG(self.st_mode)
+
+	def islnk(self):
+		return stat.S_ISLNK(self.st_mode)
+
+	### block mapping
+	def blockRuns(self):
+		"""Yield (logical block, physical block, count, initialized) for mapped data."""
+		if self.flags & EXT4_EXTENTS_FL:
+			for run in self.extentRuns(self.iblock):
+				yield run
+		else:
+			for run in self.indirectRuns():
+				yield run
+
+	def extentRuns(self, node):
+		magic, entries, _, depth = struct.unpack_from('<HHHH', node, 0)
+		if magic != EXTENT_MAGIC:
+			raise Exception('bad extent header in inode %d on \'%s\'' % (self.ino, self.fs.name))
+		for i in range(entries):
+			off = 12 + 12 * i
+			if depth == 0:
+				lblk, length, starthi, startlo = struct.unpack_from('<IHHI', node, off)
+				initialized = length <= EXTENT_INIT_MAX_LEN
+				if not initialized:
+					length -= EXTENT_INIT_MAX_LEN
+				yield (lblk, u32pair(startlo, starthi), length, initialized)
+			else:
+				lblk, leaflo, leafhi = struct.unpack_from('<IIH', node, off)
+				for run in self.extentRuns(self.fs.readBlocks(u32pair(leaflo, leafhi))):
+					yield run
+
+	def indirectRuns(self):
+		ptrs = struct.unpack_from('<15I', self.iblock, 0)
+		perblock = self.fs.blocksize // 4
+		nblocks = (self.st_size + self.fs.blocksize - 1) // self.fs.blocksize
+
+		def walkIndirect(block, level, lblk):
+			if block == 0:
+				return
+			entries = struct.unpack('<%dI' % perblock, self.fs.readBlocks(block))
+			span = perblock ** (level - 1)
+			for i, child in enumerate(entries):
+				base = lblk + i * span
+				if base >= nblocks:
+					return
+				if child == 0:
+					continue
+				if level == 1:
+					yield (base, child)
+				else:
+					for pair in walkIndirect(child, level - 1, base):
+						yield pair
+
+		def singles():
+			for i in range(12):
+				if ptrs[i]:
+					yield (i, ptrs[i])
+			lblk = 12
+			for level, ptr in ((1, ptrs[12]), (2, ptrs[13]), (3, ptrs[14])):
+				if lblk >= nblocks:
+					return
+				for pair in walkIndirect(ptr, level, lblk):
+					yield pair
+				lblk += perblock ** level
+
+		# coalesce single blocks into runs
+		run = None
+		for lblk, pblk in singles():
+			if run and lblk == run[0] + run[2] and pblk == run[1] + run[2]:
+				run[2] += 1
+				continue
+			if run:
+				yield tuple(run) + (True,)
+			run = [lblk, pblk, 1]
+		if run:
+			yield tuple(run) + (True,)
+
+	### data
+	def hasInlineData(self):
+		return bool(self.flags & EXT4_INLINE_DATA_FL)
+
+	def inlineData(self):
+		data = self.iblock
+		for name, value in self.rawXattrs():
+			if name == 'system.data':
+				data += value
+				break
+		return data[:self.st_size]
+
+	def read(self):
+		"""Yield the file contents in chunks, holes and unwritten extents as zeros."""
+		size = self.st_size
+		if self.hasInlineData():
+			yield self.inlineData()
+			return
+
+		bs = self.fs.blocksize
+		chunkblocks = max(1, READ_CHUNK // bs)
+		pos = 0
+		for lblk, pblk, count, initialized in sorted(self.blockRuns()):
+			start = lblk * bs
+			if start >= size:
+				break
+			while pos < start:
+				n = min(start - pos, READ_CHUNK)
+				yield '\0' * n
+				pos += n
+			done = 0
+			while done < count and pos < size:
+				n = min(chunkblocks, count - done)
+				if initialized:
+					buf = self.fs.readBlocks(pblk + done, n)
+				else:
+					buf = '\0' * (n * bs)
+				buf = buf[:size - pos]
+				yield buf
+				pos += len(buf)
+				done += n
+		while pos < size:
+			n = min(size - pos, READ_CHUNK)
+			yield '\0' * n
+			pos += n
+
+	def readAll(self):
+		return ''.join(self.read())
+
+	def readlink(self):
+		if not self.islnk():
+			raise Exception('inode %d on \'%s\' is not a symlink' % (self.ino, self.fs.name))
+		if self.hasInlineData():
+			return self.inlineData()
+		eablocks = (self.fs.blocksize // 512) if self.fileacl else 0
+		if self.st_size < 60 and self.blocks512 - eablocks == 0:
+			return self.iblock[:self.st_size]
+		return self.readAll()
+
+	### directories
+	def parseDirents(self, data, out):
+		bs = self.fs.blocksize
+		pos = 0
+		while pos + 8 <= len(data):
+			ino, reclen, namelen, ftype = struct.unpack_from('<IHBB', data, pos)
+			if reclen in (0, 65535) and bs >= 65536:
+				reclen = bs
+			else:
+				reclen = (reclen & 65532) | ((reclen & 3) << 16)
+			if reclen < 8:
+				log.warn('corrupt directory entry in inode %d on \'%s\', skipping the rest of the block' % (self.ino, self.fs.name))
+				break
+			if not self.fs.hasfiletype:
+				namelen |= ftype << 8
+				ftype = 0
+			if ino and namelen:
+				name = data[pos + 8:pos + 8 + namelen]
+				if name not in ('.', '..'):
+					out.append((name, ino, ftype))
+			pos += reclen
+
+	def listdir(self):
+		"""Return [(name, ino, filetype)] without '.' and '..'."""
+		if not self.isdir():
+			raise Exception('inode %d on \'%s\' is not a directory' % (self.ino, self.fs.name))
+		out = []
+		if self.hasInlineData():
+			data = self.iblock
+			for name, value in self.rawXattrs():
+				if name == 'system.data':
+					data += value
+					break
+			# the first four bytes are the parent inode
+			self.parseDirents(data[4:], out)
+		else:
+			bs = self.fs.blocksize
+			data = self.readAll()
+			for off in range(0, len(data), bs):
+				self.parseDirents(data[off:off + bs], out)
+		return out
+
+	### xattrs
+	def parseXattrEntries(self, data, pos, valuebase):
+		out = []
+		while pos + 16 <= len(data) and data[pos:pos + 4] != '\0\0\0\0':
+			namelen, index, valueoffs, valueinum, valuesize = struct.unpack_from('<BBHII', data, pos)
+			name = data[pos + 16:pos + 16 + namelen]
+			if valueinum:
+				value = self.fs.inode(valueinum).readAll()[:valuesize]
+			else:
+				value = data[valuebase + valueoffs:valuebase + valueoffs + valuesize]
+			prefix = XATTR_PREFIXES.get(index)
+			if prefix is None:
+				log.debug('skipping xattr with unknown name index %d on inode %d' % (index, self.ino))
+			else:
+				out.append((prefix + name, value, index))
+			pos += (16 + namelen + 3) & ~3
+		return out
+
+	def rawXattrEntries(self):
+		entries = []
+		start = 128 + self.extra
+		if self.fs.inodesize > 128 and start + 4 <= len(self.raw):
+			if struct.unpack_from('<I', self.raw, start)[0] == XATTR_MAGIC:
+				entries.extend(self.parseXattrEntries(self.raw, start + 4, start + 4))
+		if self.fileacl:
+			block = self.fs.readBlocks(self.fileacl)
+			if struct.unpack_from('<I', block, 0)[0] == XATTR_MAGIC:
+				entries.extend(self.parseXattrEntries(block, 32, 0))
+			else:
+				log.warn('bad xattr block %d for inode %d on \'%s\'' % (self.fileacl, self.ino, self.fs.name))
+		return entries
+
+	def rawXattrs(self):
+		return [(name, value) for name, value, index in self.rawXattrEntries()]
+
+	def xattrs(self):
+		"""Return [(name, value)] as getxattr(2) would, without the inline data attribute."""
+		out = []
+		for name, value, index in self.rawXattrEntries():
+			if name == 'system.data':
+				continue
+			if index in (2, 3):
+				value = aclToXattr(value)
+			out.append((name, value))
+		return out
+
+
+def probe(dev, name=None, devno=0):
+	"""Return an ExtFS for dev, or None if it doesn't hold one."""
+	try:
+		return ExtFS(dev, name, devno)
+	except Exception, e:
+		log.debug('no ext filesystem on \'%s\': %s' % (name, str(e)))
+		return None
+
+
+class FSTree(object):
+	"""Several filesystems grafted at their mountpoints, walked as one tree."""
+
+	def __init__(self, rootfs, mounts=None):
+		self.rootfs = rootfs
+		# relative path ('usr', 'var/log') -> ExtFS
+		self.mounts = dict((mp.strip('/'), fs) for mp, fs in (mounts or {}).iteritems() if mp.strip('/'))
+
+	def walk(self, top=''):
+		"""Yield (relpath, inode) parents first, each directory's entries sorted by name."""
+		grafted = set()
+		top, inode = self.resolve(top)
+		if inode is None:
+			return
+
+		stack = [(top, inode)]
+		while stack:
+			relpath, inode = stack.pop()
+			if relpath in self.mounts:
+				inode = self.mounts[relpath].root()
+				grafted.add(relpath)
+			yield (relpath, inode)
+			if not inode.isdir():
+				continue
+			children = []
+			for name, ino, ftype in sorted(inode.listdir()):
+				childpath = os.path.join(relpath, name)
+				children.append((childpath, inode.fs.inode(ino)))
+			stack.extend(reversed(children))
+
+		if top == '':
+			missing = set(self.mounts) - grafted
+			if missing:
+				raise Exception('could not place mountpoints %s, they don\'t exist in the tree' % ', '.join('/' + m for m in sorted(missing)))
+
+	def resolve(self, relpath):
+		"""Return (real relpath, inode) for relpath, crossing mountpoints and following symlinks, or (None, None)."""
+		parts = [p for p in relpath.split('/') if p]
+		resolved = []
+		inode = self.rootfs.root()
+		links = 0
+		while parts:
+			name = parts.pop(0)
+			if name == '.':
+				continue
+			if name == '..':
+				parts = resolved[:-1] + parts
+				resolved = []
+				inode = self.rootfs.root()
+				continue
+			if not inode.isdir():
+				return (None, None)
+			entries = dict((n, i) for n, i, t in inode.listdir())
+			if name not in entries:
+				return (None, None)
+			path = '/'.join(resolved + [name])
+			if path in self.mounts:
+				child = self.mounts[path].root()
+			else:
+				child = inode.fs.inode(entries[name])
+			if child.islnk():
+				links += 1
+				if links > 40:
+					raise Exception('too many levels of symbolic links resolving \'%s\'' % relpath)
+				target = child.readlink()
+				if target.startswith('/'):
+					resolved = []
+					inode = self.rootfs.root()
+				parts = [p for p in target.split('/') if p] + parts
+				continue
+			resolved.append(name)
+			inode = child
+		return ('/'.join(resolved), inode)
+
+	def extract(self, top, dst):
+		"""Copy the subtree at top into dst as the current user (no owners or device nodes)."""
+		count = 0
+		realtop, inode = self.resolve(top)
+		if inode is None:
+			raise Exception('\'/%s\' does not exist in the image' % top)
+		for relpath, inode in self.walk(realtop):
+			target = os.path.normpath(os.path.join(dst, os.path.relpath(relpath or '.', realtop or '.')))
+			if inode.isdir():
+				if not os.path.isdir(target):
+					os.makedirs(target)
+			elif inode.isreg():
+				with open(target, 'wb') as fh:
+					for buf in inode.read():
+						fh.write(buf)
+				os.chmod(target, stat.S_IMODE(inode.st_mode) | 0600)
+				os.utime(target, (inode.st_atime, inode.st_mtime))
+				count += 1
+			elif inode.islnk():
+				os.symlink(inode.readlink(), target)
+		log.debug('extracted %d files from \'/%s\' to \'%s\'' % (count, top, dst))
@@ -34,13 +34,26 @@ See <http://linux.die.net/include/mntent.h>.
 # /usr/share/common-licenses/AGPL-3; if not, see
 # <http://www.gnu.org/licenses/>.
 
+import os
+import re
+
 class mntent(object):
-	"""Structure describing a mount table entry."""
+	"""
+	Structure describing a mount table entry.
+
+	Text fields are kept as they appear in the table (octal-quoted) and only
+	unquoted when read; options are only split when first asked for.  Large
+	mount tables are mostly scanned for a few entries, so most fields are
+	never decoded at all.
+	"""
+	__slots__ = ('_fsname', '_dir', '_type', '_opts', '_optlist', 'freq', 'passno', 'comment')
+
 	def __init__(self, fsname, dir, type, opts=None, freq=0, passno=0, comment=None):
-		self.fsname = mntent.unquote(fsname)
-		self.dir = mntent.unquote(dir)
-		self.type = mntent.unquote(type)
-		self.opts = mntent.unquote(opts).split(',')
+		self._fsname = fsname
+		self._dir = dir
+		self._type = type
+		self._opts = opts or ''
+		self._optlist = None
 		try:
 			self.freq = int(freq)
 		except ValueError:
@@ -51,6 +64,37 @@ class mntent(object):
 			self.passno = 0
 		self.comment = comment
 
+	def _get_fsname(self):
+		return mntent.unquote(self._fsname)
+	def _set_fsname(self, value):
+		self._fsname = mntent.quote(value)
+	fsname = property(_get_fsname, _set_fsname)
+
+	def _get_dir(self):
+		return mntent.unquote(self._dir)
+	def _set_dir(self, value):
+		self._dir = mntent.quote(value)
+	dir = property(_get_dir, _set_dir)
+
+	def _get_type(self):
+		return mntent.unquote(self._type)
+	def _set_type(self, value):
+		self._type = mntent.quote(value)
+	type = property(_get_type, _set_type)
+
+	def _get_opts(self):
+		if self._optlist is None:
+			self._optlist = mntent.unquote(self._opts).split(',')
+		return self._optlist
+	def _set_opts(self, value):
+		self._optlist = list(value)
+	opts = property(_get_opts, _set_opts, doc="Options as a list, changes to it are kept.")
+
+	def _rawopts(self):
+		if self._optlist is None:
+			return self._opts
+		return mntent.quote(','.join(self._optlist))
+
 	def __repr__(self):
 		"""
 		Return the canonical string representation of the object.
@@ -76,12 +120,14 @@ class mntent(object):
 		'proc\\t/proc\\tproc\\tdefaults\\t0\\t0'
 		>>> str(mntent('/dev/sda', '/', 'ext2,ext3', 'defaults,rw', 0, 0, '# comment'))
 		'/dev/sda\\t/\\text2,ext3\\tdefaults,rw\\t0\\t0\\t# comment'
+		>>> str(mntent('/dev/sdb1', '/media/my\\\\040disk', 'vfat', 'defaults', 0, 0))
+		'/dev/sdb1\\t/media/my\\\\040disk\\tvfat\\tdefaults\\t0\\t0'
 		"""
 		h = [
-				mntent.quote(self.fsname),
-				mntent.quote(self.dir),
-				mntent.quote(self.type),
-				mntent.quote(','.join(self.opts)),
+				self._fsname,
+				self._dir,
+				self._type,
+				self._rawopts(),
 				str(self.freq),
 				str(self.passno),
 				]
@@ -95,11 +141,13 @@ class mntent(object):
 		Quote string to octal.
 		>>> mntent.quote('a b')
 		'a\\\\040b'
+		>>> mntent.unquote(mntent.quote('a\\\\b'))
+		'a\\\\b'
 		"""
 		try:
 			t = cls.__quote_dict
 		except AttributeError:
-			t = cls.__quote_dict = dict([(c, '\\%s' % oct(ord(c))) for c in ' \t\n\r\\'])
+			t = cls.__quote_dict = dict([(c, '\\%03o' % ord(c)) for c in ' \t\n\r\\'])
 		return ''.join([t.get(c, c) for c in s])
 
 	@classmethod
@@ -108,12 +156,15 @@ class mntent(object):
 		Unquote octal to string.
 		>>> mntent.unquote('a\\040b')
 		'a b'
+		>>> mntent.unquote('a\\134b')
+		'a\\\\b'
 		"""
+		if '\\' not in s:
+			return s
 		try:
 			r = cls.__quote_re
 		except AttributeError:
-			import re
-			r = cls.__quote_re = re.compile('\\\\0([0-7]+)')
+			r = cls.__quote_re = re.compile('\\\\([0-7]{3})')
 		return r.sub(lambda m: chr(int(m.group(1), 8)), s)
 
 	def hasopt(self, opt):
@@ -124,12 +175,90 @@ class mntent(object):
 		"""
 		return filter(lambda o: o.startswith(opt), self.opts)
 
+	def getopt(self, opt, default=None):
+		"""
+		Return the value of option OPT, True for flags without a value.
+		>>> e = mntent('/dev/sda', '/', 'ext3', 'rw,errors=remount-ro', 0, 0)
+		>>> e.getopt('errors'), e.getopt('rw'), e.getopt('acl')
+		('remount-ro', True, None)
+		"""
+		for o in self.opts:
+			name, sep, value = o.partition('=')
+			if name == opt:
+				return value if sep else True
+		return default
+
+class mountinfoent(mntent):
+	"""
+	Structure describing a line of /proc/<pid>/mountinfo, see proc(5).
+	fsname is the mount source and opts the per-mount options; the
+	superblock options are in superopts.
+	"""
+	__slots__ = ('mountid', 'parentid', 'devno', '_root', 'optional', '_superopts')
+
+	def __init__(self, mountid, parentid, devno, root, dir, opts, optional, type, fsname, superopts):
+		mntent.__init__(self, fsname, dir, type, opts)
+		self.mountid = int(mountid)
+		self.parentid = int(parentid)
+		self.devno = devno
+		self._root = root
+		self.optional = optional
+		self._superopts = superopts
+
+	@classmethod
+	def parse(cls, line):
+		"""
+		Parse a mountinfo line.
+		>>> e = mountinfoent.parse('36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue')
+		>>> e.mountid, e.parentid, e.devno, e.root, e.dir, e.fsname, e.type, e.optional
+		(36, 35, '98:0', '/mnt1', '/mnt2', '/dev/root', 'ext3', ['master:1'])
+		>>> e.opts, e.superopts
+		(['rw', 'noatime'], ['rw', 'errors=continue'])
+		"""
+		fields = line.split()
+		sep = fields.index('-', 6)
+		superopts = fields[sep + 3] if len(fields) > sep + 3 else ''
+		return cls(fields[0], fields[1], fields[2], fields[3], fields[4], fields[5], fields[6:sep], fields[sep + 1], fields[sep + 2], superopts)
+
+	@property
+	def root(self):
+		return mntent.unquote(self._root)
+
+	@property
+	def superopts(self):
+		return mntent.unquote(self._superopts).split(',')
+
+	@property
+	def major(self):
+		return int(self.devno.split(':')[0])
+
+	@property
+	def minor(self):
+		return int(self.devno.split(':')[1])
+
+	def __repr__(self):
+		return "mountinfoent(%d, %d, %r, %r, %r, %r, %r, %r, %r)" % (self.mountid, self.parentid, self.devno,
+				self.root, self.dir, ','.join(self.opts), self.type, self.fsname, ','.join(self.superopts))
+
+	def __str__(self, delim=' '):
+		return delim.join([str(self.mountid), str(self.parentid), self.devno, self._root, self._dir, self._rawopts()] +
+				self.optional + ['-', self._type, self._fsname, self._superopts])
+
 class fstab(object):
-	"""Handle parsing and writing /etc/fstab."""
+	"""
+	Handle parsing and writing /etc/fstab.
+
+	Besides the list interface, entries can be looked up by mountpoint,
+	source, UUID or LABEL through indexes that are built on the first lookup
+	and dropped whenever the list changes.  Changing an entry in place does
+	not update them.
+	"""
 
 	def __init__(self, fstab='/etc/fstab'):
+		"""Parse a fstab, given its path or an open file."""
 		self.fn = fstab
-		self.__load()
+		self.__index = None
+		self._load()
 
 	def __getitem__(self, i):
 		"""Get i-th line."""
@@ -138,6 +267,7 @@ class fstab(object):
 	def __delitem__(self, i):
 		"""Remove i-th line."""
 		del self.__cache[i]
+		self.__index = None
 
 	def __len__(self):
 		"""Return number of entries."""
@@ -152,27 +282,77 @@ class fstab(object):
 	def remove(self, entry):
 		"""Remove entry."""
 		self.__cache.remove(entry)
+		self.__index = None
 
 	def append(self, entry):
 		"""Add entry."""
 		self.__cache.append(entry)
+		self.__index = None
+
+	def _parse(self, line):
+		"""Parse a line into an entry, comments and blank lines are kept as strings."""
+		line = line.strip()
+		if not line or line.startswith('#'):
+			return line
+		return mntent(*line.split(None, 6))
 
-	def __load(self):
+	def _load(self):
 		"""Load and parse fstab."""
-		f = open(self.fn, 'r')
+		if hasattr(self.fn, 'read'):
+			f = self.fn
+		else:
+			f = open(self.fn, 'r')
 		try:
-			self.__cache = []
-			for line in f:
-				line = line.strip()
-				if line.startswith('#'):
-					self.__cache.append(line)
-				else:
-					fields = line.split(None, 6)
-					ent = mntent(*fields)
-					self.__cache.append(ent)
+			parse = self._parse
+			self.__cache = [parse(line) for line in f]
 		finally:
 			f.close()
 
+	def _indexes(self):
+		"""
+		Build the lookup indexes, keyed by the quoted table text so nothing
+		has to be unquoted.  Later entries win for a mountpoint, like the
+		topmost of stacked mounts.
+		"""
+		if self.__index is not None:
+			return self.__index
+
+		bydir = {}
+		bysource = {}
+		byuuid = {}
+		bylabel = {}
+		for ent in self:
+			bydir[ent._dir] = ent
+			source = ent._fsname
+			bysource.setdefault(source, []).append(ent)
+			if source.startswith('UUID='):
+				byuuid.setdefault(source[5:].lower(), []).append(ent)
+			elif source.startswith('/dev/disk/by-uuid/'):
+				byuuid.setdefault(source[18:].lower(), []).append(ent)
+			elif source.startswith('LABEL='):
+				bylabel.setdefault(source[6:], []).append(ent)
+			elif source.startswith('/dev/disk/by-label/'):
+				bylabel.setdefault(source[19:], []).append(ent)
+
+		self.__index = (bydir, bysource, byuuid, bylabel)
+		return self.__index
+
+	def bydir(self, dir):
+		"""Return the entry mounted at DIR, or None."""
+		return self._indexes()[0].get(mntent.quote(dir))
+
+	def bysource(self, fsname):
+		"""Return the entries for the device or source FSNAME."""
+		return list(self._indexes()[1].get(mntent.quote(fsname), ()))
+
+	def byuuid(self, uuid):
+		"""Return the entries given as UUID=<uuid> or /dev/disk/by-uuid/<uuid>."""
+		return list(self._indexes()[2].get(mntent.quote(uuid.lower()), ()))
+
+	def bylabel(self, label):
+		"""Return the entries given as LABEL=<label> or /dev/disk/by-label/<label>."""
+		return list(self._indexes()[3].get(mntent.quote(label), ()))
+
 	def save(self, fn=None):
 		"""Save new fstab."""
 		f = open(fn or self.fn, 'w')
@@ -182,13 +362,67 @@ class fstab(object):
 		finally:
 			f.close()
 
+class mountinfo(fstab):
+	"""Parse /proc/<pid>/mountinfo, with the same lookups as fstab."""
+
+	def __init__(self, mountinfo='/proc/self/mountinfo'):
+		"""Parse a mountinfo table, given its path or an open file."""
+		fstab.__init__(self, mountinfo)
+
+	def _parse(self, line):
+		line = line.strip()
+		if not line:
+			return line
+		return mountinfoent.parse(line)
+
+	def bymountid(self, mountid):
+		"""Return the entry with the given mount ID, or None."""
+		for ent in self:
+			if ent.mountid == mountid:
+				return ent
+		return None
+
+	def save(self, fn=None):
+		raise IOError('mountinfo is read-only')
+
+def benchmark(count=50000, lookups=10000):
+	"""
+	Time parsing and looking up a synthetic mountinfo table of COUNT entries,
+	about what a busy container host has.  Returns {stage: seconds}.
+	"""
+	import time
+	import random
+	from StringIO import StringIO
+
+	lines = []
+	for i in range(count):
+		lines.append('%d 1 0:%d / /var/lib/docker/overlay2/%032x/merged rw,relatime shared:%d - overlay overlay rw,lowerdir=/var/lib/docker/overlay2/l/%026x,upperdir=/var/lib/docker/overlay2/%032x/diff' % (i + 2, i + 100, i, i, i, i))
+	text = '\n'.join(lines) + '\n'
+	dirs = ['/var/lib/docker/overlay2/%032x/merged' % random.randrange(count) for i in range(lookups)]
+
+	times = {}
+	start = time.time()
+	mi = mountinfo(StringIO(text))
+	times['parse'] = time.time() - start
+
+	start = time.time()
+	for d in dirs:
+		assert mi.bydir(d) is not None
+	times['lookup'] = time.time() - start
+
+	start = time.time()
+	for d in dirs[:100]:
+		assert [e for e in mi if e.dir == d]
+	times['scan100'] = time.time() - start
+
+	return times
+
 if __name__ == '__main__':
 	import doctest
 	doctest.testmod()
 
 	import tempfile
 	fd, name = tempfile.mkstemp()
-	import os
 	os.write(fd, """# /etc/fstab: static file system information.
 # <file system> <mount point>   <type>  <options>       <dump>  <pass>
 /dev/vda3       /       ext3    acl,errors=remount-ro   0       1
@@ -198,3 +432,18 @@ proc            /proc           proc    defaults        0       0
 192.168.0.81:/home             /home           nfs     defaults,timeo=21,retrans=9,wsize=8192,rsize=8192,nfsvers=3     1       2	# LDAP""")
 	fs = fstab(name)
 	assert fs[6].comment == '# LDAP'
+	assert fs.bydir('/boot').fsname == '/dev/vda1'
+	assert fs.bysource('proc')[0].dir == '/proc'
+	os.close(fd)
+	os.unlink(name)
+
+	import sys
+	if '--benchmark' in sys.argv:
+		count = 50000
+		for arg in sys.argv[1:]:
+			if arg.isdigit():
+				count = int(arg)
+		times = benchmark(count)
+		print 'parsed %d mountinfo entries in %.3fs' % (count, times['parse'])
+		print '10000 indexed lookups in %.3fs (first includes building the index)' % times['lookup']
+		print '100 linear scans in %.3fs' % times['scan100']
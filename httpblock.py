@@ -0,0 +1,650 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+A read-only block device backed by an image served over HTTP.
+
+``BlockDevice`` fetches fixed-size blocks of the image with HTTP Range
+requests only when they are first read, keeps them in a local cache file
+(sparse, with a bitmap of what it holds, so a cache on a persistent disk
+survives reboots), reads ahead when it sees sequential access, and fills in
+the rest in the background while nothing else is waiting.  ``NBDServer``
+exports it with the NBD protocol on a unix or TCP socket, so the kernel's
+nbd client can mount it as the root filesystem long before the whole image
+has been downloaded.
+
+Run ``httpblock.py serve FILE`` for a loopback HTTP server with Range
+support to test against, and ``httpblock.py selftest`` to check the whole
+chain (HTTP server, block cache and NBD server) on this host without root.
+"""
+
+import os
+import sys
+import mmap
+import time
+import errno
+import Queue
+import random
+import socket
+import struct
+import httplib
+import urlparse
+import argparse
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+BLOCK_SIZE = 64 * 1024
+MAX_REQUEST = 32		# blocks per Range request
+READAHEAD_MIN = 4		# blocks, the first window after a sequential read
+READAHEAD_MAX = 128		# blocks, the window doubles up to this
+FILL_RUN = 32			# blocks per background fill request
+WORKERS = 4			# concurrent HTTP connections
+MAP_SAVE_INTERVAL = 30.0	# seconds between saves of the cache bitmap while filling
+RETRIES = 5
+MAP_MAGIC = 'all7fever-blockmap-1'
+
+PRIO_READ = 0
+PRIO_READAHEAD = 1
+PRIO_FILL = 2
+
+MISSING = 0
+PRESENT = 1
+INFLIGHT = 2
+
+# NBD protocol, newstyle fixed handshake
+NBD_MAGIC = 0x4e42444d41474943		# "NBDMAGIC"
+NBD_OPTS_MAGIC = 0x49484156454f5054	# "IHAVEOPT"
+NBD_REP_MAGIC = 0x3e889045565a9
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_REPLY_MAGIC = 0x67446698
+NBD_FLAG_FIXED_NEWSTYLE = 1
+NBD_FLAG_NO_ZEROES = 2
+NBD_FLAG_C_NO_ZEROES = 2
+NBD_FLAG_HAS_FLAGS = 1
+NBD_FLAG_READ_ONLY = 2
+NBD_FLAG_SEND_FLUSH = 4
+NBD_OPT_EXPORT_NAME = 1
+NBD_OPT_ABORT = 2
+NBD_OPT_INFO = 6
+NBD_OPT_GO = 7
+NBD_REP_ACK = 1
+NBD_REP_INFO = 3
+NBD_REP_ERR_UNSUP = 0x80000001
+NBD_INFO_EXPORT = 0
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+NBD_CMD_TRIM = 4
+
+
+class HTTPSource(object):
+	"""Range reads from a URL, one persistent connection per thread."""
+
+	def __init__(self, url):
+		self.url = url
+		parts = urlparse.urlsplit(url)
+		if parts.scheme != 'http':
+			raise Exception('only http:// images are supported, not \'%s\'' % url)
+		self.host = parts.hostname
+		self.port = parts.port or 80
+		self.path = parts.path + ('?' + parts.query if parts.query else '')
+		self.local = threading.local()
+		self.connections = []
+
+	def connection(self, fresh=False):
+		conn = getattr(self.local, 'conn', None)
+		if conn is None or fresh:
+			if conn is not None:
+				conn.close()
+			conn = self.local.conn = httplib.HTTPConnection(self.host, self.port, timeout=30)
+			self.connections.append(conn)
+		return conn
+
+	def close(self):
+		for conn in self.connections:
+			conn.close()
+
+	def request(self, method, headers):
+		error = None
+		for attempt in range(RETRIES):
+			try:
+				conn = self.connection(fresh=attempt > 0)
+				conn.request(method, self.path, headers=headers)
+				response = conn.getresponse()
+				body = response.read()
+				return response, body
+			except (httplib.HTTPException, socket.error), e:
+				error = e
+				log.debug('%s %s failed (attempt %d): %s' % (method, self.url, attempt + 1, str(e)))
+				time.sleep(min(2.0, 0.1 * 2 ** attempt))
+		raise IOError(errno.EIO, 'could not reach \'%s\': %s' % (self.url, str(error)))
+
+	def stat(self):
+		"""(size, validator) of the image; the validator changes when the image does."""
+		response, body = self.request('HEAD', {})
+		if response.status != 200:
+			raise IOError(errno.EIO, 'HEAD %s: %d %s' % (self.url, response.status, response.reason))
+		validator = response.getheader('etag') or response.getheader('last-modified') or ''
+		return int(response.getheader('content-length')), validator
+
+	def fetch(self, offset, length):
+		response, body = self.request('GET', {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
+		if response.status != 206:
+			raise IOError(errno.EIO, 'GET %s bytes %d+%d: %d %s (does the server do Range requests?)' % (self.url, offset, length, response.status, response.reason))
+		if len(body) != length:
+			raise IOError(errno.EIO, 'GET %s bytes %d+%d: short read of %d' % (self.url, offset, length, len(body)))
+		return body
+
+
+class BlockDevice(object):
+	"""
+	The image as a read-only device, see the module docstring.  cachepath
+	keeps the cache (and its bitmap, in cachepath.map) for later runs;
+	without it the cache is an anonymous temporary file.
+	"""
+
+	def __init__(self, source, cachepath=None, blocksize=BLOCK_SIZE, workers=WORKERS, fill=True):
+		self.source = source
+		self.blocksize = blocksize
+		self.size, self.validator = source.stat()
+		self.nblocks = (self.size + blocksize - 1) // blocksize
+		self.cachepath = cachepath
+
+		if cachepath is None:
+			self.cachefh = tempfile.TemporaryFile(prefix='all7fever-blocks')
+		else:
+			self.cachefh = open(cachepath, 'r+b' if os.path.exists(cachepath) else 'w+b')
+		self.cachefh.truncate(self.size)
+		self.cache = mmap.mmap(self.cachefh.fileno(), self.size) if self.size else None
+
+		self.state = bytearray(self.nblocks)
+		self.remaining = self.nblocks
+		self.loadMap()
+
+		self.cond = threading.Condition()
+		self.queue = Queue.PriorityQueue()
+		self.seq = 0
+		self.errors = {}	# block -> IOError, for readers waiting on a failed fetch
+		self.lastblock = None
+		self.window = READAHEAD_MIN
+		self.closed = False
+		self.stats = {'reads': 0, 'hits': 0, 'fetched_blocks': 0, 'fetch_requests': 0, 'readahead_blocks': 0, 'fill_blocks': 0}
+
+		self.threads = [threading.Thread(target=self.worker, name='httpblock-%d' % i) for i in range(workers)]
+		if fill:
+			self.threads.append(threading.Thread(target=self.filler, name='httpblock-fill'))
+		for t in self.threads:
+			t.daemon = True
+			t.start()
+
+	### persistent cache map
+	def mapHeader(self):
+		return '%s %d %d %s\n' % (MAP_MAGIC, self.size, self.blocksize, self.validator)
+
+	def loadMap(self):
+		if self.cachepath is None or not os.path.exists(self.cachepath + '.map'):
+			return
+		with open(self.cachepath + '.map', 'rb') as fh:
+			header = fh.readline()
+			bitmap = fh.read()
+		if header != self.mapHeader() or len(bitmap) != self.nblocks:
+			log.info('cache \'%s\' is for another image, starting over' % self.cachepath)
+			return
+		for i, c in enumerate(bytearray(bitmap)):
+			if c == PRESENT:
+				self.state[i] = PRESENT
+		self.remaining = sum(1 for s in self.state if s == MISSING)
+		log.info('cache \'%s\' already holds %d of %d blocks' % (self.cachepath, self.nblocks - self.remaining, self.nblocks))
+
+	def saveMap(self):
+		if self.cachepath is None:
+			return
+		self.cache.flush()
+		with self.cond:
+			bitmap = bytearray(PRESENT if s == PRESENT else MISSING for s in self.state)
+		with open(self.cachepath + '.map~', 'wb') as fh:
+			fh.write(self.mapHeader())
+			fh.write(bitmap)
+		os.rename(self.cachepath + '.map~', self.cachepath + '.map')
+
+	### fetching
+	def schedule(self, first, last, prio):
+		"""Queue the missing blocks in [first, last] in runs; call with cond held.  Returns how many were queued."""
+		queued = 0
+		block = first
+		while block <= last:
+			if self.state[block] != MISSING:
+				block += 1
+				continue
+			start = block
+			while block <= last and self.state[block] == MISSING and block - start < MAX_REQUEST:
+				self.state[block] = INFLIGHT
+				block += 1
+			self.seq += 1
+			self.queue.put((prio, self.seq, start, block - start))
+			queued += block - start
+		return queued
+
+	def worker(self):
+		while True:
+			prio, seq, start, count = self.queue.get()
+			if self.closed:
+				return
+			offset = start * self.blocksize
+			length = min(count * self.blocksize, self.size - offset)
+			try:
+				data = self.source.fetch(offset, length)
+				self.cache[offset:offset + length] = data
+				error = None
+			except IOError, e:
+				log.warn('fetching blocks %d-%d failed: %s' % (start, start + count - 1, str(e)))
+				error = e
+			with self.cond:
+				for block in range(start, start + count):
+					if error is None:
+						self.state[block] = PRESENT
+						self.errors.pop(block, None)
+					else:
+						self.state[block] = MISSING
+						self.errors[block] = error
+				if error is None:
+					self.remaining -= count
+					self.stats['fetched_blocks'] += count
+					self.stats['fetch_requests'] += 1
+					if prio == PRIO_READAHEAD:
+						self.stats['readahead_blocks'] += count
+					elif prio == PRIO_FILL:
+						self.stats['fill_blocks'] += count
+				self.cond.notify_all()
+
+	def filler(self):
+		"""Fetch whatever is still missing, a run at a time, whenever no read is waiting."""
+		block = 0
+		lastsave = time.time()
+		while not self.closed:
+			if time.time() - lastsave > MAP_SAVE_INTERVAL:
+				self.saveMap()
+				lastsave = time.time()
+			with self.cond:
+				while not self.closed and self.remaining > 0 and not self.queue.empty():
+					self.cond.wait()
+				if self.closed or self.remaining == 0:
+					break
+				while block < self.nblocks and self.state[block] != MISSING:
+					block += 1
+				if block >= self.nblocks:
+					# some blocks failed or are in flight, go round again
+					block = 0
+					self.cond.wait()
+					continue
+				self.schedule(block, min(self.nblocks, block + FILL_RUN) - 1, PRIO_FILL)
+				# wait for it before queueing more, so reads never queue behind a pile of fills
+				while not self.closed and self.state[block] == INFLIGHT:
+					self.cond.wait()
+		if self.remaining == 0:
+			log.info('all %d blocks of \'%s\' are local' % (self.nblocks, self.source.url))
+			self.saveMap()
+
+	### reading
+	def read(self, offset, length):
+		length = max(0, min(length, self.size - offset))
+		if length == 0:
+			return ''
+		first = offset // self.blocksize
+		last = (offset + length - 1) // self.blocksize
+
+		with self.cond:
+			self.stats['reads'] += 1
+			if all(self.state[b] == PRESENT for b in range(first, last + 1)):
+				self.stats['hits'] += 1
+			self.schedule(first, last, PRIO_READ)
+
+			# read ahead on sequential access, doubling the window like the kernel does
+			if self.lastblock is not None and first in (self.lastblock, self.lastblock + 1):
+				self.window = min(self.window * 2, READAHEAD_MAX)
+				self.schedule(last + 1, min(self.nblocks - 1, last + self.window), PRIO_READAHEAD)
+			else:
+				self.window = READAHEAD_MIN
+			self.lastblock = last
+
+			for block in range(first, last + 1):
+				while self.state[block] != PRESENT:
+					if self.state[block] == MISSING:
+						error = self.errors.get(block)
+						if error is not None:
+							raise IOError(errno.EIO, 'block %d: %s' % (block, str(error)))
+						self.schedule(block, block, PRIO_READ)
+					self.cond.wait()
+
+		return self.cache[offset:offset + length]
+
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+		for t in self.threads:
+			self.queue.put((-1, 0, 0, 0))
+		for t in self.threads:
+			t.join()
+		self.source.close()
+		self.saveMap()
+		if self.cache is not None:
+			self.cache.close()
+		self.cachefh.close()
+
+
+### NBD export
+def recvall(sock, n):
+	out = []
+	while n > 0:
+		buf = sock.recv(n)
+		if not buf:
+			raise EOFError('connection closed')
+		out.append(buf)
+		n -= len(buf)
+	return ''.join(out)
+
+class NBDConnection(object):
+	"""One client: the handshake, then requests served by worker threads (the kernel pipelines them)."""
+
+	def __init__(self, device, sock, workers=WORKERS):
+		self.device = device
+		self.sock = sock
+		self.sendlock = threading.Lock()
+		self.requests = Queue.Queue(workers * 4)
+		self.workers = workers
+
+	def send(self, data):
+		with self.sendlock:
+			self.sock.sendall(data)
+
+	def optionReply(self, option, reptype, data=''):
+		self.send(struct.pack('>QIII', NBD_REP_MAGIC, option, reptype, len(data)) + data)
+
+	def exportInfo(self):
+		return struct.pack('>QH', self.device.size, NBD_FLAG_HAS_FLAGS | NBD_FLAG_READ_ONLY | NBD_FLAG_SEND_FLUSH)
+
+	def handshake(self):
+		"""Returns True once the client has picked the export."""
+		self.send(struct.pack('>QQH', NBD_MAGIC, NBD_OPTS_MAGIC, NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES))
+		(clientflags,) = struct.unpack('>I', recvall(self.sock, 4))
+		while True:
+			magic, option, length = struct.unpack('>QII', recvall(self.sock, 16))
+			if magic != NBD_OPTS_MAGIC:
+				raise Exception('bad NBD option magic 0x%x' % magic)
+			data = recvall(self.sock, length)
+			if option == NBD_OPT_EXPORT_NAME:
+				# there is only one export, whatever its name
+				self.send(self.exportInfo() + ('' if clientflags & NBD_FLAG_C_NO_ZEROES else '\0' * 124))
+				return True
+			elif option in (NBD_OPT_INFO, NBD_OPT_GO):
+				self.optionReply(option, NBD_REP_INFO, struct.pack('>H', NBD_INFO_EXPORT) + self.exportInfo())
+				self.optionReply(option, NBD_REP_ACK)
+				if option == NBD_OPT_GO:
+					return True
+			elif option == NBD_OPT_ABORT:
+				self.optionReply(option, NBD_REP_ACK)
+				return False
+			else:
+				self.optionReply(option, NBD_REP_ERR_UNSUP)
+
+	def reply(self, handle, error, data=''):
+		self.send(struct.pack('>IIQ', NBD_REPLY_MAGIC, error, handle) + data)
+
+	def worker(self):
+		while True:
+			request = self.requests.get()
+			if request is None:
+				return
+			handle, offset, length = request
+			try:
+				data = self.device.read(offset, length)
+				self.reply(handle, 0, data)
+			except IOError, e:
+				self.reply(handle, e.errno or errno.EIO)
+			except socket.error:
+				return
+
+	def serve(self):
+		if not self.handshake():
+			return
+		threads = [threading.Thread(target=self.worker) for i in range(self.workers)]
+		for t in threads:
+			t.daemon = True
+			t.start()
+		try:
+			while True:
+				magic, flags, cmd, handle, offset, length = struct.unpack('>IHHQQI', recvall(self.sock, 28))
+				if magic != NBD_REQUEST_MAGIC:
+					raise Exception('bad NBD request magic 0x%x' % magic)
+				if cmd == NBD_CMD_READ:
+					self.requests.put((handle, offset, length))
+				elif cmd == NBD_CMD_DISC:
+					break
+				elif cmd == NBD_CMD_WRITE:
+					recvall(self.sock, length)
+					self.reply(handle, errno.EPERM)
+				elif cmd == NBD_CMD_FLUSH:
+					self.reply(handle, 0)
+				else:
+					self.reply(handle, errno.EINVAL)
+		except EOFError:
+			pass
+		finally:
+			for t in threads:
+				self.requests.put(None)
+			for t in threads:
+				t.join()
+			self.sock.close()
+
+class NBDServer(object):
+	"""Export a device on a unix socket (path) or TCP (host, port), one client at a time."""
+
+	def __init__(self, device, path=None, address=None):
+		self.device = device
+		if path is not None:
+			if os.path.exists(path):
+				os.unlink(path)
+			self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.sock.bind(path)
+		else:
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			self.sock.bind(address)
+		self.sock.listen(1)
+
+	def serve_forever(self):
+		while True:
+			conn, addr = self.sock.accept()
+			log.debug('nbd client connected')
+			try:
+				NBDConnection(self.device, conn).serve()
+			except Exception, e:
+				log.warn('nbd connection failed: %s' % str(e))
+			log.debug('nbd client disconnected')
+
+
+### loopback HTTP server, for tests
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, fmt, *args):
+		log.debug('http: ' + fmt % args)
+
+	def send_head(self):
+		size = os.path.getsize(self.server.imagepath)
+		st = os.stat(self.server.imagepath)
+		rng = self.headers.getheader('range')
+		if rng is None:
+			start, end = 0, size - 1
+			self.send_response(200)
+		else:
+			spec = rng.split('=', 1)[1]
+			first, last = spec.split('-')
+			start = int(first)
+			end = min(int(last) if last else size - 1, size - 1)
+			if start > end:
+				self.send_response(416)
+				self.send_header('Content-Range', 'bytes */%d' % size)
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+				return None
+			self.send_response(206)
+			self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+		self.send_header('Accept-Ranges', 'bytes')
+		self.send_header('Content-Length', str(end - start + 1))
+		self.send_header('ETag', '"%x-%x"' % (st.st_size, int(st.st_mtime)))
+		self.end_headers()
+		return start, end
+
+	def do_HEAD(self):
+		self.send_head()
+
+	def do_GET(self):
+		r = self.send_head()
+		if r is None:
+			return
+		if self.server.latency:
+			time.sleep(self.server.latency)
+		start, end = r
+		with open(self.server.imagepath, 'rb') as fh:
+			fh.seek(start)
+			self.wfile.write(fh.read(end - start + 1))
+
+class RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, imagepath, latency=0.0):
+		self.imagepath = imagepath
+		self.latency = latency
+		BaseHTTPServer.HTTPServer.__init__(self, address, RangeHandler)
+
+	@property
+	def url(self):
+		return 'http://%s:%d/%s' % (self.server_address[0], self.server_address[1], os.path.basename(self.imagepath))
+
+def startRangeServer(imagepath, latency=0.0):
+	server = RangeServer(('127.0.0.1', 0), imagepath, latency)
+	t = threading.Thread(target=server.serve_forever, name='rangeserver')
+	t.daemon = True
+	t.start()
+	return server
+
+
+### self test
+def nbdClientRead(sock, handle, offset, length):
+	sock.sendall(struct.pack('>IHHQQI', NBD_REQUEST_MAGIC, 0, NBD_CMD_READ, handle, offset, length))
+	magic, error, rhandle = struct.unpack('>IIQ', recvall(sock, 16))
+	if magic != NBD_REPLY_MAGIC or rhandle != handle or error != 0:
+		raise Exception('bad NBD reply: magic 0x%x error %d handle %d' % (magic, error, rhandle))
+	return recvall(sock, length)
+
+def selftest(size=16 * 1024 * 1024 + 12345, latency=0.005):
+	"""Serve a random image over loopback HTTP, export it over NBD and read it back."""
+	workdir = tempfile.mkdtemp(prefix='all7fever-httpblock')
+	image = os.path.join(workdir, 'image')
+	rng = random.Random(7)
+	data = ''.join(chr(rng.getrandbits(8)) for i in range(4096)) * (size // 4096) + 'x' * (size % 4096)
+	with open(image, 'wb') as fh:
+		fh.write(data)
+
+	http = startRangeServer(image, latency)
+	cache = os.path.join(workdir, 'cache')
+	device = BlockDevice(HTTPSource(http.url), cachepath=cache, fill=False)
+
+	sockpath = os.path.join(workdir, 'nbd.sock')
+	server = NBDServer(device, path=sockpath)
+	t = threading.Thread(target=server.serve_forever)
+	t.daemon = True
+	t.start()
+
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.connect(sockpath)
+	magic, optsmagic, flags = struct.unpack('>QQH', recvall(sock, 18))
+	assert (magic, optsmagic) == (NBD_MAGIC, NBD_OPTS_MAGIC)
+	sock.sendall(struct.pack('>I', NBD_FLAG_C_NO_ZEROES))
+	sock.sendall(struct.pack('>QII', NBD_OPTS_MAGIC, NBD_OPT_EXPORT_NAME, 0))
+	exportsize, tflags = struct.unpack('>QH', recvall(sock, 10))
+	assert exportsize == size, (exportsize, size)
+
+	start = time.time()
+	for i in range(200):
+		offset = rng.randrange(size)
+		length = rng.randrange(1, 256 * 1024)
+		length = min(length, size - offset)
+		assert nbdClientRead(sock, i, offset, length) == data[offset:offset + length], 'mismatch at %d+%d' % (offset, length)
+	random_time = time.time() - start
+
+	start = time.time()
+	for i, offset in enumerate(range(0, size, 128 * 1024)):
+		length = min(128 * 1024, size - offset)
+		assert nbdClientRead(sock, 1000 + i, offset, length) == data[offset:offset + length]
+	sequential_time = time.time() - start
+
+	sock.sendall(struct.pack('>IHHQQI', NBD_REQUEST_MAGIC, 0, NBD_CMD_DISC, 0, 0, 0))
+	sock.close()
+	stats = dict(device.stats)
+	device.close()
+
+	# a second run starts from the saved cache
+	device = BlockDevice(HTTPSource(http.url), cachepath=cache, fill=True)
+	assert device.read(0, size) == data
+	cached = device.stats['fetched_blocks']
+	device.close()
+	http.shutdown()
+
+	for name in os.listdir(workdir):
+		os.unlink(os.path.join(workdir, name))
+	os.rmdir(workdir)
+
+	print 'random reads: %.2fs, sequential: %.2fs' % (random_time, sequential_time)
+	print 'block stats: %s' % ', '.join('%s=%d' % kv for kv in sorted(stats.iteritems()))
+	print 'second run fetched %d blocks' % cached
+	print 'ok'
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO, format='[%(asctime)s][%(levelname)s][%(name)s] %(message)s')
+
+	ap = argparse.ArgumentParser(description='serve an HTTP image as a block device over NBD')
+	sub = ap.add_subparsers(dest='command')
+	nbd = sub.add_parser('nbd', help='export URL over NBD')
+	nbd.add_argument('url', metavar='URL', help='the image, served with Range support')
+	nbd.add_argument('-s','--socket', dest='socket', help='unix socket to listen on')
+	nbd.add_argument('-l','--listen', dest='listen', metavar='HOST:PORT', help='TCP address to listen on')
+	nbd.add_argument('-c','--cache', dest='cache', help='cache file, kept (with CACHE.map) for the next run')
+	nbd.add_argument('--no-fill', dest='fill', action='store_false', help='only fetch blocks when they are read')
+	serve = sub.add_parser('serve', help='serve FILE over HTTP with Range support, for testing')
+	serve.add_argument('file', metavar='FILE')
+	serve.add_argument('-p','--port', dest='port', type=int, default=8080)
+	serve.add_argument('--latency', dest='latency', type=float, default=0.0, help='seconds to wait before each response')
+	sub.add_parser('selftest', help='check HTTP, cache and NBD on loopback')
+	args = ap.parse_args()
+
+	if args.command == 'selftest':
+		selftest()
+	elif args.command == 'serve':
+		server = RangeServer(('0.0.0.0', args.port), args.file, args.latency)
+		log.info('serving \'%s\' at http://%s:%d/' % (args.file, socket.gethostname(), args.port))
+		server.serve_forever()
+	else:
+		if not args.socket and not args.listen:
+			ap.error('one of --socket or --listen is needed')
+		device = BlockDevice(HTTPSource(args.url), cachepath=args.cache, fill=args.fill)
+		if args.socket:
+			server = NBDServer(device, path=args.socket)
+		else:
+			host, port = args.listen.rsplit(':', 1)
+			server = NBDServer(device, address=(host, int(port)))
+		log.info('exporting \'%s\' (%d bytes) over nbd' % (args.url, device.size))
+		try:
+			server.serve_forever()
+		finally:
+			device.close()
@@ -42,12 +42,686 @@ mountroot()
 ::::::;:,.......,........ ;&#@@#MM#XMHHH#: @@@@MA&GGAB@&MHr :;r,.,,,,,,,..,,,.,
 EOF
 
+	parse_telemetry_args
+	tm_value mountroot $(tm_now)
+	parse_verify_args
+
+	tm_begin=$(tm_now)
 	sleep 1
 	configure_networking 
 	sleep 1
+	tm_stage network ${tm_begin}
+
+	parse_block_args
+	if [ -n "${ROOTBLOCK}" ] && mount_block_root; then
+		tm_finish
+		return
+	fi
 
     mount -t tmpfs tmpfs ${rootmnt}
 	echo "extracting to ${rootmnt}"
 	cd ${rootmnt}
-	wget -O- ${ROOT} | gzip -dc | cpio -idmv 1>/dev/null 2>/dev/null
+
+	parse_split_args
+	if [ -n "${ROOTSPLIT}" ] && extract_split; then
+		tm_finish
+		return
+	fi
+
+	parse_layer_args
+	if [ -n "${LAYERS}" ]; then
+		extract_layers
+		tm_finish
+		return
+	fi
+
+	parse_chunk_args
+	if [ -n "${CHUNKSTORE}" ] && fetch_chunks; then
+		assemble_chunks | extract_stream chunks
+		prune_chunks
+	else
+		peer_stop
+		umount ${CHUNKDIR} 2>/dev/null
+		fetch_archive ${ROOT} | extract_stream root
+		if verify_failed ${ROOT}; then
+			panic "could not download ${ROOT}"
+		fi
+	fi
+	tm_finish
+}
+
+# boot telemetry, with telemetry=http://host:port on the kernel line (see
+# collector.py) and imageversion= to group the reports by.  stage begin and
+# end times (seconds since the kernel started) and byte counts go to
+# TM_LOG, which is on /dev and so moves into the new root with it; an
+# rc2.d script posts it to the collector once the node is up.
+TM_LOG=/dev/.all7fever-telemetry
+
+parse_telemetry_args()
+{
+	for x in $(cat /proc/cmdline); do
+		case $x in
+		telemetry=*)
+			TELEMETRY=${x#telemetry=}
+			;;
+		imageversion=*)
+			IMAGEVERSION=${x#imageversion=}
+			;;
+		esac
+	done
+	if [ -n "${TELEMETRY}" ]; then
+		echo "value image ${IMAGEVERSION:-unknown}" > ${TM_LOG}
+	fi
+}
+
+tm_now()
+{
+	cut -d' ' -f1 /proc/uptime
+}
+
+tm_value()
+{
+	[ -n "${TELEMETRY}" ] && echo "value $1 $2" >> ${TM_LOG}
+}
+
+tm_stage()
+{
+	# name, begin
+	[ -n "${TELEMETRY}" ] && echo "stage $1 $2 $(tm_now)" >> ${TM_LOG}
+}
+
+extract_stream()
+{
+	# gzip -dc | cpio -idm of stdin; cpio gets extra flags from $2.  with
+	# telemetry, also when the download, the decompression and the
+	# extraction each finished and how many bytes went through
+	name=$1
+	if [ -z "${TELEMETRY}" ]; then
+		gzip -dc | cpio -idm$2 1>/dev/null 2>/dev/null
+		return
+	fi
+
+	begin=$(tm_now)
+	mkfifo /dev/.tm.$name.in /dev/.tm.$name.out
+	( n=$(wc -c < /dev/.tm.$name.in); tm_stage $name.download $begin; tm_value $name.compressed_bytes $n ) &
+	inpid=$!
+	( n=$(wc -c < /dev/.tm.$name.out); tm_stage $name.decompress $begin; tm_value $name.bytes $n ) &
+	outpid=$!
+	tee /dev/.tm.$name.in | gzip -dc | tee /dev/.tm.$name.out | cpio -idm$2 1>/dev/null 2>/dev/null
+	wait $inpid $outpid
+	tm_stage $name.extract $begin
+	rm -f /dev/.tm.$name.in /dev/.tm.$name.out
+}
+
+tm_finish()
+{
+	# report once runlevel 2 is reached, from the new root
+	[ -n "${TELEMETRY}" ] || return
+	tm_value switchroot $(tm_now)
+	mkdir -p ${rootmnt}/etc/rc2.d
+	cat > ${rootmnt}/etc/rc2.d/S99all7fever-telemetry <<EOT
+#!/bin/sh
+# from the all7fever init script: report how this boot went, once
+echo "stage boot 0 \$(cut -d' ' -f1 /proc/uptime)" >> ${TM_LOG}
+wget -q -O /dev/null --post-file=${TM_LOG} ${TELEMETRY}/boot 2>/dev/null ||
+	curl -s -o /dev/null --data-binary @${TM_LOG} ${TELEMETRY}/boot
+rm -f \$0
+EOT
+	chmod 755 ${rootmnt}/etc/rc2.d/S99all7fever-telemetry
+}
+
+# verified, resumable downloads.  doit.py writes ARCHIVE.sums next to each
+# archive, with the sha1 of every 4M block.  when it's there the archive is
+# fetched a block at a time with Range requests, the next block downloading
+# while the last one is extracted, and a block is only passed on once it
+# matches.  a bad or cut off block is fetched again after a pause, up to
+# verifytries= times (5 by default), and boot stops with an error after
+# that.  without a .sums file, from a server that doesn't do Range
+# requests, or with verify=0, the archive streams as before.
+VERIFY=1
+VERIFYTRIES=5
+
+parse_verify_args()
+{
+	for x in $(cat /proc/cmdline); do
+		case $x in
+		verify=*)
+			VERIFY=${x#verify=}
+			;;
+		verifytries=*)
+			VERIFYTRIES=${x#verifytries=}
+			;;
+		esac
+	done
+}
+
+fetch_archive()
+{
+	# URL: the archive on stdout.  the working directory is relative to the
+	# new root, so this keeps working in the background after the switch
+	dir=.all7fever-verify/$(basename $1)
+	mkdir -p ${dir}
+	if [ "${VERIFY}" != 0 ] && wget -q -O ${dir}/sums $1.sums 2>/dev/null && range_supported $1; then
+		echo "fetching and verifying $1" >&2
+		fetch_verified $1 ${dir}
+		rc=$?
+		[ ${rc} -eq 0 ] || touch .all7fever-failed-$(basename $1)
+	else
+		wget -O- $1
+		rc=$?
+	fi
+	rm -rf ${dir}
+	rmdir .all7fever-verify 2>/dev/null
+	return ${rc}
+}
+
+verify_failed()
+{
+	# URL: whether fetch_archive gave up on it
+	[ -e .all7fever-failed-$(basename $1) ] && rm -f .all7fever-failed-$(basename $1)
+}
+
+fetch_verified()
+{
+	# URL, working directory
+	prevsum=
+	while read sum off len; do
+		case $sum in
+		\#*|"")
+			continue
+			;;
+		esac
+		fetch_block $1 ${off} ${len} $2/${off} &
+		next=$!
+		if [ -n "${prevsum}" ]; then
+			wait ${prevpid}
+			emit_block $1 ${prevsum} ${prevoff} ${prevlen} $2/${prevoff} || {
+				rc=$?
+				kill ${next} 2>/dev/null
+				wait ${next}
+				return ${rc}
+			}
+		fi
+		prevsum=${sum}
+		prevoff=${off}
+		prevlen=${len}
+		prevpid=${next}
+	done < $2/sums
+	if [ -n "${prevsum}" ]; then
+		wait ${prevpid}
+		emit_block $1 ${prevsum} ${prevoff} ${prevlen} $2/${prevoff}
+	fi
+}
+
+fetch_block()
+{
+	# URL, offset, length, file.  only the block is asked for, and head stops
+	# reading once it has the block, so no more than a block is ever fetched
+	wget -q -O- --header "Range: bytes=$2-$(($2 + $3 - 1))" $1 2>/dev/null | head -c $3 > $4
+}
+
+range_supported()
+{
+	# URL: whether the server answers Range requests.  the archives are
+	# gzip, which starts with 1f 8b, so asking for the second byte tells
+	wget -q -O- --header "Range: bytes=1-1" $1 2>/dev/null | head -c 1 | od -An -tx1 | grep -q 8b
+}
+
+emit_block()
+{
+	# URL, sha1, offset, length, file: pass the block on once it matches,
+	# fetching it again if need be
+	tries=1
+	while [ "$(cat $5 2>/dev/null | sha1sum | cut -d' ' -f1)" != "$2" ]; do
+		if [ ${tries} -ge ${VERIFYTRIES} ]; then
+			echo "$1: the block at $3 is still bad after ${tries} tries, giving up" >&2
+			return 1
+		fi
+		echo "$1: the block at $3 is bad or incomplete, fetching it again" >&2
+		sleep ${tries}
+		tries=$((tries + 1))
+		fetch_block $1 $3 $4 $5
+	done
+	cat $5
+	rm -f $5
+}
+
+# boot ordered archives from doit.py --boottrace:
+#   rootsplit=1   extract ${ROOT%.cpio.gz}.boot.cpio.gz, the files boot reads,
+#                 and go on booting while ${ROOT%.cpio.gz}.rest.cpio.gz is
+#                 extracted in the background.  /dev/.all7fever-rest-done
+#                 appears when it's finished.  files the system writes before
+#                 then are newer than the archive's and are kept.
+parse_split_args()
+{
+	for x in $(cat /proc/cmdline); do
+		case $x in
+		rootsplit=*)
+			ROOTSPLIT=${x#rootsplit=}
+			;;
+		esac
+	done
+}
+
+extract_split()
+{
+	fetch_archive ${ROOT%.cpio.gz}.boot.cpio.gz | extract_stream boot
+	if verify_failed ${ROOT%.cpio.gz}.boot.cpio.gz || [ ! -e sbin/init ]; then
+		echo "could not extract the boot segment, extracting everything"
+		return 1
+	fi
+	if ! start_rest; then
+		echo "cannot extract in the new root, extracting everything"
+		return 1
+	fi
+	echo "boot segment extracted, extracting the rest in the background"
+}
+
+# run-init empties the initramfs as soon as mountroot returns, and a process
+# left behind in it can't start any program after that.  so the rest is
+# extracted by copies of our busybox and of this script, chrooted into the
+# new root, where they stay around until the rest is in.
+REST_DIR=.all7fever-rest
+REST_APPLETS="sh basename cat cpio cut grep gzip head mkdir mkfifo od rm rmdir sha1sum sleep tee touch wc wget"
+
+start_rest()
+{
+	mkdir -p ${REST_DIR}
+	cp /bin/busybox ${REST_DIR}/busybox && cp /scripts/stateless ${REST_DIR}/stateless || return 1
+	for applet in ${REST_APPLETS}; do
+		ln -s busybox ${REST_DIR}/${applet}
+	done
+	# it runs on the new root's libraries, make sure they're there
+	if ! chroot . /${REST_DIR}/busybox true 2>/dev/null; then
+		rm -rf ${REST_DIR}
+		return 1
+	fi
+	ROOT=${ROOT} VERIFY=${VERIFY} VERIFYTRIES=${VERIFYTRIES} TELEMETRY=${TELEMETRY} \
+		chroot . /${REST_DIR}/sh -c "PATH=/${REST_DIR}; . /${REST_DIR}/stateless; extract_rest" </dev/null >/dev/null 2>&1 &
+}
+
+extract_rest()
+{
+	# in the new root: once init has moved /dev and /proc over, extract the
+	# rest and say how it went on the console
+	n=0
+	while [ ! -e /proc/uptime ] && [ ${n} -lt 60 ]; do
+		sleep 1
+		n=$((n + 1))
+	done
+	cd /
+	fetch_archive ${ROOT%.cpio.gz}.rest.cpio.gz 2>/dev/null | extract_stream rest
+	if verify_failed ${ROOT%.cpio.gz}.rest.cpio.gz; then
+		touch /dev/.all7fever-rest-failed
+		echo "all7fever: could not extract the rest of the root" > /dev/console
+	else
+		touch /dev/.all7fever-rest-done
+		echo "all7fever: rest of the root extracted" > /dev/console
+	fi
+	rm -rf /${REST_DIR}
+}
+
+# layered images from doit.py --layered:
+#   layers=http://host/base/rootimg.cpio.gz,http://host/role/overlay.cpio.gz
+# each layer is extracted over the ones before it, after removing the paths
+# listed in its .whiteouts file (overlay.whiteouts for overlay.cpio.gz), if
+# it has one.  every role names the same base archive, so the boot server
+# keeps serving that one from its page cache.
+parse_layer_args()
+{
+	for x in $(cat /proc/cmdline); do
+		case $x in
+		layers=*)
+			LAYERS=${x#layers=}
+			;;
+		esac
+	done
+}
+
+extract_layers()
+{
+	n=0
+	for layer in $(echo ${LAYERS} | tr ',' ' '); do
+		echo "extracting layer ${layer}"
+		if wget -q -O /tmp/whiteouts ${layer%.cpio.gz}.whiteouts 2>/dev/null; then
+			while read path; do
+				[ -n "${path}" ] && rm -rf "${rootmnt}/${path}"
+			done < /tmp/whiteouts
+			rm -f /tmp/whiteouts
+		fi
+		# -u, files of later layers replace those of earlier ones whatever their age
+		fetch_archive ${layer} | extract_stream layer$n u
+		if verify_failed ${layer}; then
+			panic "could not download layer ${layer}"
+		fi
+		n=$((n + 1))
+	done
+}
+
+# delta boots from a chunk store published with doit.py --chunkstore:
+#   chunkstore=http://host/store   where the store is served
+#   chunkcache=/dev/sdXN           optional, a filesystem to keep chunks on
+#                                  between boots (LABEL=/UUID= need findfs)
+#   chunkversion=VERSION           optional, defaults to the store's latest
+# without a cache every chunk is downloaded, which costs about as much as root=.
+# root= is still used if the store can't be reached.
+CHUNKDIR=/chunkcache
+
+# peer-assisted fetching, with a tracker (swarm.py tracker) next to the store:
+#   peers=http://host:9092   the tracker
+#   peerport=PORT            optional, where this node serves its chunks to
+#                            others with busybox httpd, 9093 by default
+#   peerseed=SECONDS         optional, how long to go on serving them once
+#                            booted, 600 by default
+# every chunk is fetched before extracting and kept in memory (or on
+# chunkcache=).  each is tried from two peers, then the store, and only kept
+# if it decompresses to its sha1.
+PEERPORT=9093
+PEERSEED=600
+
+parse_chunk_args()
+{
+	for x in $(cat /proc/cmdline); do
+		case $x in
+		chunkstore=*)
+			CHUNKSTORE=${x#chunkstore=}
+			;;
+		chunkcache=*)
+			CHUNKCACHE=${x#chunkcache=}
+			;;
+		chunkversion=*)
+			CHUNKVERSION=${x#chunkversion=}
+			;;
+		peers=*)
+			PEERS=${x#peers=}
+			;;
+		peerport=*)
+			PEERPORT=${x#peerport=}
+			;;
+		peerseed=*)
+			PEERSEED=${x#peerseed=}
+			;;
+		esac
+	done
+}
+
+chunk_path()
+{
+	echo "chunks/$(echo $1 | cut -c1-2)/$1.gz"
+}
+
+fetch_chunks()
+{
+	mkdir -p ${CHUNKDIR}
+	if [ -n "${CHUNKCACHE}" ]; then
+		case ${CHUNKCACHE} in
+		LABEL=*|UUID=*)
+			CHUNKCACHE=$(findfs ${CHUNKCACHE})
+			;;
+		esac
+		if ! mount ${CHUNKCACHE} ${CHUNKDIR}; then
+			echo "could not mount chunk cache ${CHUNKCACHE}, using memory"
+			CHUNKCACHE=
+		fi
+	fi
+	if [ -z "${CHUNKCACHE}" ]; then
+		mount -t tmpfs tmpfs ${CHUNKDIR}
+	fi
+
+	if [ -z "${CHUNKVERSION}" ]; then
+		CHUNKVERSION=$(wget -q -O- ${CHUNKSTORE}/latest) || return 1
+	fi
+	wget -q -O ${CHUNKDIR}/manifest ${CHUNKSTORE}/manifests/${CHUNKVERSION} || return 1
+	echo "fetching chunk store version ${CHUNKVERSION}"
+
+	# only the chunks that aren't cached yet
+	fetched=0
+	cached=0
+	: > ${CHUNKDIR}/missing
+	while read sum size; do
+		case $sum in
+		\#*|"")
+			continue
+			;;
+		esac
+		if [ -f ${CHUNKDIR}/$sum.gz ]; then
+			cached=$((cached + 1))
+			continue
+		fi
+		if [ -z "${CHUNKCACHE}" ] && [ -z "${PEERS}" ]; then
+			# nothing to keep, stream it when assembling
+			continue
+		fi
+		echo $sum >> ${CHUNKDIR}/missing
+	done < ${CHUNKDIR}/manifest
+
+	if [ -n "${PEERS}" ]; then
+		peer_start
+		# every node in its own order, so early ones have different chunks to offer
+		awk "BEGIN { srand(${RANDOM}) } { print rand(), \$0 }" ${CHUNKDIR}/missing | sort -n | cut -d' ' -f2 > ${CHUNKDIR}/missing.order
+		mv ${CHUNKDIR}/missing.order ${CHUNKDIR}/missing
+	fi
+	while read sum; do
+		if [ -n "${PEERS}" ] && [ $((fetched % 16)) -eq 0 ]; then
+			peer_announce 0
+		fi
+		fetch_chunk $sum || return 1
+		fetched=$((fetched + 1))
+	done < ${CHUNKDIR}/missing
+	echo "${cached} chunks cached, ${fetched} fetched"
+	if [ -n "${PEERS}" ]; then
+		peer_announce 1
+		echo "$((storebytes / 1024))k from the store, $((peerbytes / 1024))k from peers"
+	fi
+}
+
+chunk_ok()
+{
+	[ "$(gzip -dc < $2 2>/dev/null | sha1sum | cut -d' ' -f1)" = "$1" ]
+}
+
+fetch_chunk()
+{
+	part=${CHUNKDIR}/$1.gz.part
+	npeers=0
+	if [ -n "${PEERS}" ]; then
+		npeers=$(wc -l < ${CHUNKDIR}/peers)
+	fi
+	tries=0
+	while [ ${tries} -lt 2 ] && [ ${npeers} -gt 0 ]; do
+		tries=$((tries + 1))
+		peer=$(sed -n "$((RANDOM % npeers + 1))p" ${CHUNKDIR}/peers)
+		if wget -q -O ${part} ${peer}/$1.gz 2>/dev/null && chunk_ok $1 ${part}; then
+			peerbytes=$((peerbytes + $(wc -c < ${part})))
+			mv ${part} ${CHUNKDIR}/$1.gz
+			return 0
+		fi
+	done
+	wget -q -O ${part} ${CHUNKSTORE}/$(chunk_path $1) || return 1
+	if ! chunk_ok $1 ${part}; then
+		echo "chunk $1 from the store does not match its hash"
+		rm -f ${part}
+		return 1
+	fi
+	storebytes=$((storebytes + $(wc -c < ${part})))
+	mv ${part} ${CHUNKDIR}/$1.gz
+}
+
+peer_start()
+{
+	storebytes=0
+	peerbytes=0
+	# nodes boot the same initrd with the same pid at the same time, seed from the nics
+	RANDOM=$((0x$(cat /sys/class/net/*/address 2>/dev/null | md5sum | cut -c1-6)))
+	if busybox --list 2>/dev/null | grep -qx httpd; then
+		busybox httpd -f -p ${PEERPORT} -h ${CHUNKDIR} &
+		PEERPID=$!
+	else
+		echo "no httpd in this initrd, fetching from peers without serving them"
+		PEERPORT=0
+	fi
+}
+
+peer_announce()
+{
+	have=$(ls ${CHUNKDIR} | grep -c '\.gz$')
+	wget -q -O ${CHUNKDIR}/peers "${PEERS}/announce?version=${CHUNKVERSION}&port=${PEERPORT}&have=${have}&done=$1&store=${storebytes}&peers=${peerbytes}" 2>/dev/null ||
+		: > ${CHUNKDIR}/peers
+}
+
+peer_stop()
+{
+	if [ -n "${PEERPID}" ]; then
+		kill ${PEERPID} 2>/dev/null
+		PEERPID=
+	fi
+}
+
+peer_seed()
+{
+	# go on serving from the booted system, the chunk directory moves into
+	# the new root along with /dev
+	mkdir -p /dev/.all7fever-chunks
+	if ! mount -o move ${CHUNKDIR} /dev/.all7fever-chunks; then
+		peer_stop
+		umount ${CHUNKDIR}
+		return
+	fi
+	mkdir -p ${rootmnt}/etc/rc2.d
+	cat > ${rootmnt}/etc/rc2.d/S99all7fever-peer <<EOT
+#!/bin/sh
+# from the all7fever init script: stop serving chunks to other nodes after a while
+(sleep ${PEERSEED}; kill ${PEERPID}; umount /dev/.all7fever-chunks; rmdir /dev/.all7fever-chunks) >/dev/null 2>&1 &
+rm -f \$0
+EOT
+	chmod 755 ${rootmnt}/etc/rc2.d/S99all7fever-peer
+}
+
+assemble_chunks()
+{
+	# concatenated gzip members are one gzip stream
+	while read sum size; do
+		case $sum in
+		\#*|"")
+			continue
+			;;
+		esac
+		if [ -f ${CHUNKDIR}/$sum.gz ]; then
+			cat ${CHUNKDIR}/$sum.gz
+		else
+			wget -q -O- ${CHUNKSTORE}/$(chunk_path $sum)
+		fi
+	done < ${CHUNKDIR}/manifest
+}
+
+prune_chunks()
+{
+	# the cache only needs what this version uses
+	if [ -n "${CHUNKCACHE}" ]; then
+		for f in ${CHUNKDIR}/*.gz; do
+			sum=$(basename $f .gz)
+			grep -q "^$sum " ${CHUNKDIR}/manifest || rm -f $f
+		done
+	fi
+	if [ -n "${PEERPID}" ]; then
+		peer_seed
+		return
+	fi
+	umount ${CHUNKDIR}
+}
+
+# on-demand root from a block image written by doit.py --blockimage:
+#   rootblock=http://host/rootimg.ext4   the image, served with Range support
+#   blockcache=/dev/sdXN                 optional, a filesystem to keep fetched
+#                                        blocks on between boots
+# scripts/httpblock.py exports the image over nbd and fetches blocks as they
+# are read, so booting doesn't wait for the whole image.  it is mounted
+# read-only under a tmpfs overlay (overlayfs, or aufs on older kernels).
+# this needs python and nbd-client in the initrd and nbd in the kernel;
+# root= is used when any of it is missing.
+BLOCKDIR=/blockcache
+BLOCKROOT=/blockroot
+
+parse_block_args()
+{
+	for x in $(cat /proc/cmdline); do
+		case $x in
+		rootblock=*)
+			ROOTBLOCK=${x#rootblock=}
+			;;
+		blockcache=*)
+			BLOCKCACHE=${x#blockcache=}
+			;;
+		esac
+	done
+}
+
+mount_block_root()
+{
+	if ! command -v python >/dev/null || ! command -v nbd-client >/dev/null; then
+		echo "no python or nbd-client in the initrd, can't use rootblock="
+		return 1
+	fi
+	modprobe nbd 2>/dev/null
+	if [ ! -b /dev/nbd0 ]; then
+		echo "no nbd device, can't use rootblock="
+		return 1
+	fi
+
+	mkdir -p ${BLOCKDIR}
+	if [ -n "${BLOCKCACHE}" ]; then
+		case ${BLOCKCACHE} in
+		LABEL=*|UUID=*)
+			BLOCKCACHE=$(findfs ${BLOCKCACHE})
+			;;
+		esac
+		if ! mount ${BLOCKCACHE} ${BLOCKDIR}; then
+			echo "could not mount block cache ${BLOCKCACHE}, using memory"
+			BLOCKCACHE=
+		fi
+	fi
+	if [ -z "${BLOCKCACHE}" ]; then
+		mount -t tmpfs tmpfs ${BLOCKDIR}
+	fi
+
+	python /scripts/httpblock.py nbd ${ROOTBLOCK} --socket ${BLOCKDIR}/nbd.sock --cache ${BLOCKDIR}/blocks &
+	BLOCKPID=$!
+	tries=0
+	while [ ! -S ${BLOCKDIR}/nbd.sock ]; do
+		tries=$((tries + 1))
+		if [ $tries -gt 30 ] || ! kill -0 ${BLOCKPID} 2>/dev/null; then
+			echo "block client did not start"
+			umount_block_root
+			return 1
+		fi
+		sleep 1
+	done
+
+	mkdir -p ${BLOCKROOT}/ro ${BLOCKROOT}/rw
+	if ! nbd-client -unix ${BLOCKDIR}/nbd.sock /dev/nbd0 -b 4096 || ! mount -t ext4 -o ro /dev/nbd0 ${BLOCKROOT}/ro; then
+		echo "could not mount ${ROOTBLOCK}"
+		umount_block_root
+		return 1
+	fi
+	mount -t tmpfs tmpfs ${BLOCKROOT}/rw
+	mkdir -p ${BLOCKROOT}/rw/upper ${BLOCKROOT}/rw/work
+	if ! mount -t overlay -o lowerdir=${BLOCKROOT}/ro,upperdir=${BLOCKROOT}/rw/upper,workdir=${BLOCKROOT}/rw/work overlay ${rootmnt} 2>/dev/null &&
+		! mount -t aufs -o dirs=${BLOCKROOT}/rw/upper=rw:${BLOCKROOT}/ro=ro aufs ${rootmnt}; then
+		echo "no overlayfs or aufs, can't make ${ROOTBLOCK} writable"
+		umount_block_root
+		return 1
+	fi
+
+	# the client serves the root from now on, keep it alive through shutdown
+	mkdir -p /run/sendsigs.omit.d 2>/dev/null && echo ${BLOCKPID} > /run/sendsigs.omit.d/httpblock
+	echo "root is ${ROOTBLOCK}, fetched on demand"
+}
+
+umount_block_root()
+{
+	umount ${BLOCKROOT}/rw 2>/dev/null
+	umount ${BLOCKROOT}/ro 2>/dev/null
+	nbd-client -d /dev/nbd0 2>/dev/null
+	kill ${BLOCKPID} 2>/dev/null
+	umount ${BLOCKDIR} 2>/dev/null
 }
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+File-level differences between a role's rootfs and the base rootfs it was
+built from, for layered images.
+
+A client boots a role by extracting the base archive and then the role's
+overlay archive on top of it.  The overlay holds every entry of the role
+tree that the base doesn't have or has differently (contents, type, link
+target, owner or mode).  Entries of the base that the role doesn't have are
+listed in a whiteout file, one path per line, and removed before the
+overlay is extracted; entries whose type changed are listed there too, so
+the overlay can put the new one in place.
+"""
+
+import os
+import stat
+
+from treewalk import TreeWalker
+from treecopy import lstatOrNone, sameTime, fileDigest, getXattrs
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class TreeDiff(object):
+	"""
+	What the role tree adds to the base tree.  After diff(), ``overlay``
+	is the sorted relpaths of role entries to archive and ``whiteouts`` the
+	sorted relpaths to remove from the base first.
+	"""
+
+	def __init__(self, base, role, checksum=False):
+		self.base = base
+		self.role = role
+		self.checksum = checksum
+		self.overlay = []
+		self.whiteouts = []
+		self.overlaybytes = 0
+
+	def differs(self, relpath, st, basest):
+		"""Whether a role entry that exists in the base needs to be in the overlay."""
+		if (st.st_uid, st.st_gid) != (basest.st_uid, basest.st_gid):
+			return True
+		if not stat.S_ISLNK(st.st_mode) and stat.S_IMODE(st.st_mode) != stat.S_IMODE(basest.st_mode):
+			return True
+		rolepath = os.path.join(self.role, relpath)
+		basepath = os.path.join(self.base, relpath)
+		if stat.S_ISDIR(st.st_mode):
+			return False
+		if stat.S_ISLNK(st.st_mode):
+			return os.readlink(rolepath) != os.readlink(basepath)
+		if stat.S_ISREG(st.st_mode):
+			if st.st_size != basest.st_size or not sameTime(st.st_mtime, basest.st_mtime):
+				return True
+			if self.checksum and fileDigest(rolepath) != fileDigest(basepath):
+				return True
+			return dict(getXattrs(rolepath)) != dict(getXattrs(basepath))
+		return st.st_rdev != basest.st_rdev
+
+	def diff(self):
+		overlay = set()
+		whiteouts = set()
+		links = {}	# (st_dev, st_ino) -> [relpath], to keep hardlinks together
+		linked = set()
+		fresh = set()	# role directories the base doesn't have as directories
+
+		for relpath, st in TreeWalker(self.role):
+			if not relpath:
+				continue
+			if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+				links.setdefault((st.st_dev, st.st_ino), []).append(relpath)
+			if os.path.dirname(relpath) in fresh:
+				basest = None
+			else:
+				basest = lstatOrNone(os.path.join(self.base, relpath))
+			if basest is None:
+				overlay.add(relpath)
+				if stat.S_ISDIR(st.st_mode):
+					fresh.add(relpath)
+			elif stat.S_IFMT(basest.st_mode) != stat.S_IFMT(st.st_mode):
+				whiteouts.add(relpath)
+				overlay.add(relpath)
+				if stat.S_ISDIR(st.st_mode):
+					fresh.add(relpath)
+			elif self.differs(relpath, st, basest):
+				overlay.add(relpath)
+			else:
+				continue
+			if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+				linked.add((st.st_dev, st.st_ino))
+
+		# every name of a hardlinked file that changed goes in, or the client ends up with copies
+		for key in linked:
+			overlay.update(links[key])
+
+		# a removed directory takes what's below it along
+		gone = set()
+		for relpath, st in TreeWalker(self.base):
+			if not relpath:
+				continue
+			if os.path.dirname(relpath) in gone or relpath in whiteouts:
+				# inside a removed directory, or replaced by something else
+				if stat.S_ISDIR(st.st_mode):
+					gone.add(relpath)
+				continue
+			if lstatOrNone(os.path.join(self.role, relpath)) is None:
+				whiteouts.add(relpath)
+				if stat.S_ISDIR(st.st_mode):
+					gone.add(relpath)
+
+		self.overlay = sorted(overlay)
+		self.whiteouts = sorted(whiteouts)
+		for relpath in self.overlay:
+			st = os.lstat(os.path.join(self.role, relpath))
+			if stat.S_ISREG(st.st_mode):
+				self.overlaybytes += st.st_size
+		log.info('role differs from base in %d entries (%d bytes of files), %d base entries to remove' % (len(self.overlay), self.overlaybytes, len(self.whiteouts)))
+		return self
+
+	def writeWhiteouts(self, path):
+		with open(path, 'w') as fh:
+			for relpath in self.whiteouts:
+				fh.write(relpath + '\n')
+
+def readWhiteouts(path):
+	with open(path, 'r') as fh:
+		return [line.rstrip('\n') for line in fh if line.strip()]
@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+"""
+SVR4 "newc" cpio archives, the format the kernel's initramfs unpacker and
+``cpio -H newc`` use.
+
+``NewcWriter`` takes stat-like objects (``os.lstat`` results, extfs inodes)
+so any tree source can be archived in-process.  Inode numbers are renumbered
+per archive from (st_dev, st_ino), which keeps hardlinks intact even when the
+entries come from several filesystems; a hardlinked file's data is written
+with its first entry only, which both GNU cpio and the kernel accept.  With
+stableinodes, an inode's number comes from a hash of its first name instead,
+so adding or removing a file leaves every other header as it was.
+
+``NewcReader`` goes the other way, streaming members out of an archive
+(several concatenated ones too, as the kernel takes them), and
+``NewcExtractor`` writes them to a directory with a pool of writer threads,
+in place of ``cpio -idm``.  ``readArchive`` yields the members with their
+data and never touches the disk, so an initrd can be looked at or changed
+in memory and written back with ``NewcWriter``.
+"""
+
+import os
+import sys
+import zlib
+import stat
+import time
+import Queue
+import threading
+import collections
+
+from treecopy import setTimes, lstatOrNone, DEFAULT_WORKERS, READ_CHUNK, PROGRESS_INTERVAL
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+NEWC_MAGIC = '070701'
+NEWC_CRC_MAGIC = '070702'
+TRAILER = 'TRAILER!!!'
+HEADER_FMT = '%s%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x'
+HEADER_SIZE = 110
+BLOCK_SIZE = 512
+MAX_PENDING_BYTES = 64 * 1024 * 1024	# file data read ahead of the writer threads
+
+
+def pad(n):
+	return '\0' * ((4 - n % 4) % 4)
+
+class Stat(object):
+	"""A stat-like record, for entries that don't come from a filesystem as-is."""
+	FIELDS = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid', 'st_size', 'st_atime', 'st_mtime', 'st_ctime', 'st_rdev')
+
+	def __init__(self, st=None, **kwargs):
+		for f in Stat.FIELDS:
+			setattr(self, f, getattr(st, f, 0))
+		for k, v in kwargs.iteritems():
+			setattr(self, k, v)
+
+class NewcWriter(object):
+	"""
+	Write a newc archive to a file object.  With mtimeclamp, no entry is
+	newer than that, so touching a file without changing it leaves the
+	archive the same.  With stableinodes, inode numbers are hashed from
+	names rather than counted, see inodeNumber.
+	"""
+
+	def __init__(self, fh, mtimeclamp=None, stableinodes=False):
+		self.fh = fh
+		self.mtimeclamp = mtimeclamp
+		self.stableinodes = stableinodes
+		self.offset = 0
+		self.inodes = {}	# (st_dev, st_ino) -> archive ino
+		self.used = set()	# archive inos, with stableinodes
+		self.entries = 0
+
+	def write(self, buf):
+		self.fh.write(buf)
+		self.offset += len(buf)
+
+	def header(self, name, ino, mode, uid, gid, nlink, mtime, size, rdev):
+		if self.mtimeclamp is not None:
+			mtime = min(mtime, self.mtimeclamp)
+		self.write(HEADER_FMT % (NEWC_MAGIC, ino, mode, uid, gid, nlink, int(mtime) & 0xffffffff, size,
+			0, 0, os.major(rdev), os.minor(rdev), len(name) + 1, 0))
+		self.write(name + '\0')
+		self.write(pad(HEADER_SIZE + len(name) + 1))
+
+	def inodeNumber(self, name):
+		"""
+		The next inode number, or with stableinodes one hashed from the
+		entry's name.  Hardlinks are only ever matched up by these numbers,
+		and directories too by some extractors, so they have to stay unique:
+		a collision takes the next free number.
+		"""
+		if not self.stableinodes:
+			return len(self.inodes) + 1
+		ino = zlib.crc32(name) & 0xffffffff
+		while ino == 0 or ino in self.used:
+			ino = (ino + 1) & 0xffffffff
+		self.used.add(ino)
+		return ino
+
+	def addEntry(self, name, st, data=None):
+		"""
+		Add an entry.  data is a string or an iterable of strings holding
+		st.st_size bytes for regular files, or the target for symlinks.
+		"""
+		mode = st.st_mode
+		nlink = st.st_nlink if not stat.S_ISDIR(mode) else 2
+		key = (st.st_dev, st.st_ino)
+
+		firstlink = key not in self.inodes
+		if firstlink:
+			self.inodes[key] = self.inodeNumber(name)
+		ino = self.inodes[key]
+
+		if stat.S_ISREG(mode):
+			size = st.st_size if firstlink or nlink < 2 else 0
+		elif stat.S_ISLNK(mode):
+			if isinstance(data, basestring):
+				size = len(data)
+			else:
+				data = ''.join(data)
+				size = len(data)
+		else:
+			size = 0
+
+		self.header(name, ino, mode, st.st_uid, st.st_gid, nlink, st.st_mtime, size, st.st_rdev)
+		self.entries += 1
+
+		if size == 0:
+			return
+
+		if isinstance(data, basestring):
+			data = [data]
+
+		written = 0
+		for buf in data:
+			if written + len(buf) > size:
+				buf = buf[:size - written]
+			self.write(buf)
+			written += len(buf)
+			if written == size:
+				break
+		if written < size:
+			# the file shrank under us, keep the archive consistent
+			log.warn('\'%s\' was %d bytes short, padding with zeros' % (name, size - written))
+			self.write('\0' * (size - written))
+		self.write(pad(size))
+
+	def close(self):
+		"""Write the trailer and pad to a whole block, the file object is left open."""
+		self.header(TRAILER, 0, 0, 0, 0, 1, 0, 0, 0)
+		self.write('\0' * ((BLOCK_SIZE - self.offset % BLOCK_SIZE) % BLOCK_SIZE))
+		log.debug('wrote %d cpio entries, %d bytes' % (self.entries, self.offset))
+
+def archiveName(relpath):
+	"""The name `find .` would have given the entry."""
+	return './' + relpath if relpath else '.'
+
+
+class NewcEntry(object):
+	"""
+	One member of an archive being read.  Its data (a file's contents, a
+	symlink's target) can be read until the reader moves on to the next.
+	``link`` is the same for all names of a hardlinked file, None otherwise.
+	"""
+
+	def __init__(self, reader, name, st, link):
+		self.reader = reader
+		self.name = name
+		self.st = st
+		self.link = link
+		self.left = st.st_size
+
+	def chunks(self, blocksize=READ_CHUNK):
+		while self.left > 0:
+			buf = self.reader.readExact(min(blocksize, self.left))
+			self.left -= len(buf)
+			yield buf
+
+	def read(self):
+		return ''.join(self.chunks())
+
+	def skip(self):
+		for buf in self.chunks():
+			pass
+
+class NewcReader(object):
+	"""
+	Iterate over the members of newc archives read from a file object,
+	which can be a pipe.  A hardlinked file comes out with its data on its
+	first name, the way NewcWriter writes them, whichever name carried it
+	in the archive (GNU cpio puts it on the last).
+	"""
+
+	def __init__(self, fh):
+		self.fh = fh
+		self.offset = 0
+		self.archives = 0
+		self.entries = 0
+
+	def readExact(self, n):
+		buf = self.fh.read(n)
+		while len(buf) < n:
+			more = self.fh.read(n - len(buf))
+			if not more:
+				raise Exception('cpio archive cut off at byte %d' % (self.offset + len(buf)))
+			buf += more
+		self.offset += n
+		return buf
+
+	def readHeader(self):
+		"""(name, st) of the next member, or None at the end of the stream."""
+		# the zeros padding an archive to a block, and maybe another archive after them
+		while True:
+			buf = self.fh.read(4)
+			self.offset += len(buf)
+			if buf.strip('\0'):
+				break
+			if len(buf) < 4:
+				return None
+		buf += self.readExact(HEADER_SIZE - len(buf))
+
+		magic = buf[:6]
+		if magic not in (NEWC_MAGIC, NEWC_CRC_MAGIC):
+			raise Exception('not a newc cpio archive at byte %d (magic %r)' % (self.offset - HEADER_SIZE, magic))
+		try:
+			fields = [int(buf[6 + 8 * i:14 + 8 * i], 16) for i in range(13)]
+		except ValueError:
+			raise Exception('bad cpio header at byte %d' % (self.offset - HEADER_SIZE))
+		ino, mode, uid, gid, nlink, mtime, size, devmajor, devminor, rdevmajor, rdevminor, namesize, check = fields
+
+		name = self.readExact(namesize).split('\0', 1)[0]
+		self.readExact(len(pad(HEADER_SIZE + namesize)))
+		return name, Stat(st_mode=mode, st_ino=ino, st_dev=os.makedev(devmajor, devminor), st_nlink=nlink,
+			st_uid=uid, st_gid=gid, st_size=size, st_atime=mtime, st_mtime=mtime, st_ctime=mtime,
+			st_rdev=os.makedev(rdevmajor, rdevminor))
+
+	def __iter__(self):
+		pending = collections.OrderedDict()	# link -> [entries without data, until the one with it]
+		linked = set()
+		while True:
+			header = self.readHeader()
+			if header is None or header[0] == TRAILER:
+				# names of hardlinked files that never got data are empty files
+				for entries in pending.itervalues():
+					for entry in entries:
+						self.entries += 1
+						yield entry
+				if header is None:
+					break
+				pending.clear()
+				linked.clear()
+				self.archives += 1
+				continue
+
+			name, st = header
+			link = None
+			if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+				# inode numbers are only unique within one archive
+				link = (self.archives, st.st_dev, st.st_ino)
+			entry = NewcEntry(self, name, st, link)
+			if link is not None and st.st_size == 0 and link not in linked:
+				pending.setdefault(link, []).append(entry)
+				continue
+
+			self.entries += 1
+			yield entry
+			entry.skip()
+			self.readExact(len(pad(st.st_size)))
+
+			if link is not None and link not in linked:
+				linked.add(link)
+				for waiting in pending.pop(link, []):
+					self.entries += 1
+					yield waiting
+
+def readArchive(fh):
+	"""
+	(name, st, data) for every member of the archive in fh, data being a
+	file's contents or a symlink's target.  Nothing is written anywhere, the
+	members can go straight to NewcWriter.addEntry.
+	"""
+	for entry in NewcReader(fh):
+		yield entry.name, entry.st, entry.read()
+
+
+class NewcExtractor(object):
+	"""
+	Extract newc archives into dst, which must exist.  File data is written
+	by a pool of worker threads while the archive streams in; hardlinks are
+	made once every file is written and directory metadata is applied last,
+	deepest first.  Names with '..' in them or that would end up outside
+	dst through a symlink are skipped.  Owners are kept when run as root,
+	like cpio.
+	"""
+
+	def __init__(self, dst, workers=DEFAULT_WORKERS, progress=False):
+		self.dst = dst
+		self.top = os.path.realpath(dst)
+		self.workers = max(1, workers)
+		self.progress = progress
+		self.chown = os.geteuid() == 0
+
+		self.lock = threading.Lock()
+		self.room = threading.Condition(self.lock)
+		self.pendingbytes = 0
+		self.stats = dict(files=0, dirs=0, links=0, hardlinks=0, other=0, bytes=0, skipped=0)
+
+		self.links = {}	# NewcEntry.link -> relpath holding the data
+		self.deferredlinks = []	# (target relpath, relpath)
+		self.dirs = []	# (relpath, st) for the final metadata pass
+		self.safedirs = set([''])	# directories known to be inside dst
+		self.queued = set()	# relpaths handed to the workers since the last drain
+
+		self.queue = Queue.Queue(self.workers * 64)
+		self.errors = []
+
+	def count(self, **kwargs):
+		with self.lock:
+			for k, v in kwargs.iteritems():
+				self.stats[k] += v
+
+	def extract(self, fh):
+		log.debug('starting cpio extraction into \'%s\' with %d workers' % (self.dst, self.workers))
+		started = time.time()
+
+		threads = [threading.Thread(target=self.worker, name='newc-%d' % i) for i in range(self.workers)]
+		for t in threads:
+			t.daemon = True
+			t.start()
+
+		try:
+			lastreport = time.time()
+			for entry in NewcReader(fh):
+				if self.errors:
+					break
+				self.place(entry)
+				if self.progress and time.time() - lastreport >= PROGRESS_INTERVAL:
+					self.report(started)
+					lastreport = time.time()
+		finally:
+			for t in threads:
+				self.queue.put(None)
+			for t in threads:
+				t.join()
+
+		if self.errors:
+			exc_type, exc_value, exc_tb = self.errors[0]
+			raise exc_type, exc_value, exc_tb
+
+		self.finish()
+
+		elapsed = max(time.time() - started, 1e-6)
+		log.info('cpio extraction completed: %d files, %d MiB in %.1fs (%.1f MiB/s)' % (self.stats['files'], self.stats['bytes'] >> 20, elapsed, self.stats['bytes'] / elapsed / (1 << 20)))
+		log.debug('cpio extraction stats: %s' % str(self.stats))
+
+		return self.stats
+
+	def finish(self):
+		for target, relpath in self.deferredlinks:
+			path = os.path.join(self.dst, relpath)
+			if lstatOrNone(path) is not None:
+				# a later member took the name
+				continue
+			os.link(os.path.join(self.dst, target), path)
+
+		# deepest first, so setting a child's times doesn't bump its parent
+		for relpath, st in reversed(self.dirs):
+			self.setMetadata(os.path.join(self.dst, relpath) if relpath else self.dst, st)
+
+	def report(self, started):
+		with self.lock:
+			files, nbytes = self.stats['files'], self.stats['bytes']
+		elapsed = max(time.time() - started, 1e-6)
+		log.info('extracted %d files, %d MiB (%.1f MiB/s)' % (files, nbytes >> 20, nbytes / elapsed / (1 << 20)))
+
+	def skip(self, name, why):
+		log.warn('skipping cpio member \'%s\': %s' % (name, why))
+		self.count(skipped=1)
+
+	def makeParent(self, relpath):
+		"""Create the directory relpath goes in if the archive didn't, False if it's outside dst."""
+		parent = os.path.dirname(relpath)
+		if parent in self.safedirs:
+			return True
+		path = os.path.join(self.dst, parent)
+		real = os.path.realpath(path)
+		if real != self.top and not real.startswith(self.top + '/'):
+			return False
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self.safedirs.add(parent)
+		return True
+
+	def place(self, entry):
+		st = entry.st
+		mode = st.st_mode
+		parts = [part for part in entry.name.split('/') if part not in ('', '.')]
+		if '..' in parts:
+			return self.skip(entry.name, 'name contains \'..\'')
+		relpath = '/'.join(parts)
+
+		if not relpath:
+			if stat.S_ISDIR(mode):
+				self.dirs.append(('', st))
+			return
+		if not self.makeParent(relpath):
+			return self.skip(entry.name, 'it would be extracted outside of \'%s\'' % self.dst)
+
+		path = os.path.join(self.dst, relpath)
+		if relpath in self.queued:
+			# a name that comes twice, let the first one be written before replacing it
+			self.drain()
+		existing = lstatOrNone(path)
+		if existing is not None:
+			if stat.S_ISDIR(existing.st_mode) and stat.S_ISDIR(mode):
+				self.dirs.append((relpath, st))
+				return
+			# later members replace earlier ones, as the kernel does
+			if stat.S_ISDIR(existing.st_mode):
+				os.rmdir(path)
+			else:
+				os.unlink(path)
+			self.safedirs.discard(relpath)
+
+		if stat.S_ISDIR(mode):
+			os.mkdir(path, 0700)
+			self.dirs.append((relpath, st))
+			self.safedirs.add(relpath)
+			self.count(dirs=1)
+			return
+
+		if entry.link is not None:
+			if entry.link in self.links:
+				self.deferredlinks.append((self.links[entry.link], relpath))
+				self.count(hardlinks=1)
+				return
+			self.links[entry.link] = relpath
+
+		if stat.S_ISREG(mode):
+			self.queueFile(relpath, entry)
+			return
+
+		if stat.S_ISLNK(mode):
+			os.symlink(entry.read(), path)
+			self.count(links=1)
+		elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode) or stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode):
+			os.mknod(path, stat.S_IFMT(mode) | 0600, st.st_rdev)
+			self.count(other=1)
+		else:
+			return self.skip(entry.name, 'unknown type %o' % stat.S_IFMT(mode))
+
+		self.setMetadata(path, entry.st)
+
+	def queueFile(self, relpath, entry):
+		path = os.path.join(self.dst, relpath)
+		size = entry.st.st_size
+		if size > MAX_PENDING_BYTES:
+			# too big to hold in memory, written here as it streams in
+			self.writeFile(path, entry.chunks(), entry.st)
+			return
+
+		data = entry.read()
+		with self.room:
+			while self.pendingbytes and self.pendingbytes + size > MAX_PENDING_BYTES:
+				self.room.wait()
+			self.pendingbytes += size
+		self.queued.add(relpath)
+		self.queue.put((path, data, entry.st))
+
+	def drain(self):
+		self.queue.join()
+		self.queued.clear()
+
+	def worker(self):
+		while True:
+			item = self.queue.get()
+			try:
+				if item is None:
+					break
+				if self.errors:
+					continue
+				path, data, st = item
+				self.writeFile(path, [data], st)
+			except Exception:
+				self.errors.append(sys.exc_info())
+			finally:
+				if item is not None:
+					with self.room:
+						self.pendingbytes -= len(item[1])
+						self.room.notify()
+				self.queue.task_done()
+
+	def writeFile(self, path, data, st):
+		fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0600)
+		try:
+			written = 0
+			for buf in data:
+				done = 0
+				while done < len(buf):
+					done += os.write(fd, buffer(buf, done))
+				written += done
+			self.setMetadata(fd, st)
+		finally:
+			os.close(fd)
+		self.count(files=1, bytes=written)
+
+	def setMetadata(self, target, st):
+		"""Owner, mode and times on a path (not following symlinks) or an fd."""
+		isfd = isinstance(target, int)
+		if self.chown:
+			if isfd:
+				os.fchown(target, st.st_uid, st.st_gid)
+			else:
+				os.lchown(target, st.st_uid, st.st_gid)
+
+		# after chown, which drops setuid bits
+		if not stat.S_ISLNK(st.st_mode):
+			if isfd:
+				os.fchmod(target, stat.S_IMODE(st.st_mode))
+			else:
+				os.chmod(target, stat.S_IMODE(st.st_mode))
+
+		setTimes(target, st)
+
+def extractArchive(fh, dst, **kwargs):
+	"""Extract the newc archives read from fh into dst, see NewcExtractor."""
+	return NewcExtractor(dst, **kwargs).extract(fh)
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Predict what a conversion will cost before running it (doit.py --plan).
+
+The tree's metadata is walked in full, which is cheap, and its regular
+files are split into strata by size and by whether they look compressed
+already (packages, images, compressed modules).  Each stratum is sampled
+and compressed on its own with the compressor the conversion will use, so a
+few big already-compressed files can't make the whole tree look
+incompressible, nor thousands of small text files make it look better than
+it is.  From that, a Plan predicts:
+
+	rootfs bytes		the copied tree on the build host's disk
+	archive bytes		rootimg.cpio.gz
+	pack seconds		compressing it on this machine
+	client tmpfs bytes	the extracted root in a client's RAM
+
+and checks them against the free space under OUTDIR and a client RAM size.
+"""
+
+import os
+import zlib
+import stat
+import time
+import functools
+
+import autotune
+from treewalk import TreeWalker
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+SAMPLE_BYTES = 32 * 1024 * 1024	# over all strata
+MIN_STRATUM_SAMPLE = 1024 * 1024	# so small strata are still measured
+SIZE_CLASSES = ((4 * 1024, 'tiny'), (64 * 1024, 'small'), (1024 * 1024, 'medium'), (None, 'large'))
+COMPRESSED_SUFFIXES = ('.gz', '.tgz', '.xz', '.txz', '.bz2', '.lzma', '.lz4', '.zst', '.zip', '.jar', '.deb', '.rpm',
+	'.png', '.jpg', '.jpeg', '.gif', '.mp3', '.ogg', '.woff', '.woff2')
+HEADER_RATIO = 4	# newc headers compress about 4:1
+BLOCK_SIZE = 4096	# allocation unit of the build host's filesystem, about
+PAGE_SIZE = 4096
+TMPFS_ENTRY_BYTES = 1024	# kernel inode and dentry per tmpfs entry, about
+TMPFS_SHARE = 0.5	# a tmpfs may only fill half the RAM unless mounted with size=
+BLOCKIMAGE_INODE_SIZE = 256
+BOOT_PREFIXES = ('boot/', 'lib/modules/')
+
+
+def roundUp(n, unit):
+	return (n + unit - 1) / unit * unit
+
+def humanBytes(n):
+	for unit in ('', 'k', 'M', 'G'):
+		if abs(n) < 1024:
+			return '%.1f%s' % (n, unit) if unit else '%d' % n
+		n /= 1024.0
+	return '%.1fT' % n
+
+def stratumName(relpath, size):
+	kind = 'compressed' if relpath.lower().endswith(COMPRESSED_SUFFIXES) else 'plain'
+	for limit, name in SIZE_CLASSES:
+		if limit is None or size <= limit:
+			return '%s-%s' % (kind, name)
+
+def dirEntries(top):
+	"""Plan entries, (relpath, st, read), for a directory tree."""
+	for relpath, st in TreeWalker(top):
+		yield relpath, st, functools.partial(autotune.readHead, os.path.join(top, relpath))
+
+def freeBytes(path):
+	"""Free space for an unprivileged user on the filesystem path is or would be created on."""
+	path = os.path.abspath(path)
+	while not os.path.exists(path):
+		path = os.path.dirname(path)
+	st = os.statvfs(path)
+	return st.f_bavail * st.f_frsize
+
+
+class Stratum(object):
+	def __init__(self, name):
+		self.name = name
+		self.files = []	# (size, read)
+		self.filebytes = 0
+		self.others = 0	# directories, links and devices, archived with the smallest files
+		self.archivebytes = 0
+		self.packtime = 0.0
+		self.samplebytes = 0
+
+	def estimate(self, compressor, target):
+		"""
+		Compress a sample of the stratum and scale up to all of it.  Each
+		sampled file's ratio counts by the file's size, not by how much of it
+		was sampled, or a big file that compresses to nothing would count
+		as little as a small one that doesn't compress at all.
+		"""
+		pieces = autotune.samplePieces(self.files, target)
+		headers = (len(self.files) + self.others) * autotune.HEADER_BYTES / HEADER_RATIO
+		if not pieces:
+			# only empty files and metadata
+			self.archivebytes = headers
+			return
+
+		weighted = sum(size * len(zlib.compress(piece, 9)) / float(len(piece)) for size, piece in pieces)
+		ratio = weighted / sum(size for size, piece in pieces)
+		self.archivebytes = self.filebytes * ratio + headers
+
+		data = ''.join(piece for size, piece in pieces)
+		self.samplebytes = len(data)
+		packtime, compressed = autotune.timeRun(compressor, data)
+		self.packtime = packtime * self.filebytes / len(data)
+		log.debug('plan stratum %s: %d files, %d bytes, sampled %d, ratio %.2f' % (self.name, len(self.files), self.filebytes, self.samplebytes, ratio))
+
+	def todict(self):
+		return {'files': len(self.files), 'bytes': self.filebytes, 'sample_bytes': self.samplebytes,
+			'archive_bytes': int(self.archivebytes), 'pack_seconds': round(self.packtime, 3)}
+
+
+class Plan(object):
+	"""
+	Predictions for one tree.  entries yields (relpath, st, read) for every
+	entry, read(n) returning the first n bytes of a regular file.
+	"""
+
+	def __init__(self, entries, compressor=None, samplebytes=SAMPLE_BYTES):
+		self.compressor = compressor or ['pigz', '-9', '-c']
+		self.entries = 0
+		self.files = 0
+		self.rootfsbytes = 0	# apparent, hardlinks once
+		self.diskbytes = 0	# allocated on the build host
+		self.tmpfsbytes = 0	# on a client
+		self.bootbytes = 0	# boot/ and lib/modules/
+		self.strata = {}
+		self.layout = []	# (mountpoint, device, fstype)
+
+		start = time.time()
+		seen = set()
+		for relpath, st, read in entries:
+			self.entries += 1
+			mode = st.st_mode
+			size = st.st_size
+			if stat.S_ISDIR(mode):
+				self.diskbytes += BLOCK_SIZE
+			if not stat.S_ISREG(mode):
+				self.tmpfsbytes += TMPFS_ENTRY_BYTES
+				self.strata.setdefault('plain-tiny', Stratum('plain-tiny')).others += 1
+				continue
+
+			if st.st_nlink > 1:
+				key = (st.st_dev, st.st_ino)
+				if key in seen:
+					# just another dentry
+					self.tmpfsbytes += TMPFS_ENTRY_BYTES / 4
+					continue
+				seen.add(key)
+
+			self.files += 1
+			self.rootfsbytes += size
+			self.diskbytes += roundUp(size, BLOCK_SIZE)
+			self.tmpfsbytes += roundUp(size, PAGE_SIZE) + TMPFS_ENTRY_BYTES
+			if relpath.startswith(BOOT_PREFIXES):
+				self.bootbytes += size
+			name = stratumName(relpath, size)
+			stratum = self.strata.setdefault(name, Stratum(name))
+			stratum.files.append((size, read))
+			stratum.filebytes += size
+		self.walkseconds = time.time() - start
+
+		# every stratum gets its share of the sample by bytes, and at least a little
+		start = time.time()
+		total = max(1, sum(s.filebytes for s in self.strata.itervalues()))
+		for stratum in self.strata.itervalues():
+			stratum.estimate(self.compressor, max(MIN_STRATUM_SAMPLE, samplebytes * stratum.filebytes / total))
+		self.sampleseconds = time.time() - start
+
+		log.info('planned %d entries in %.1fs walking and %.1fs sampling' % (self.entries, self.walkseconds, self.sampleseconds))
+
+	@property
+	def archivebytes(self):
+		return int(sum(s.archivebytes for s in self.strata.itervalues()))
+
+	@property
+	def packseconds(self):
+		return sum(s.packtime for s in self.strata.itervalues())
+
+	def outputBytes(self, rootfs=True, blockimage=False, chunkstore=False):
+		"""What a conversion writes under OUTDIR (and the chunk store)."""
+		need = self.archivebytes + self.bootbytes * 2
+		if rootfs:
+			need += self.diskbytes
+		if blockimage:
+			need += self.diskbytes + self.entries * BLOCKIMAGE_INODE_SIZE
+		if chunkstore:
+			# a first publish stores every chunk, later ones only what changed
+			need += self.archivebytes
+		return need
+
+	def clientBytes(self, chunkstore=False):
+		"""RAM a client needs: the root tmpfs may only fill part of it, and chunks are cached in RAM too."""
+		need = self.tmpfsbytes / TMPFS_SHARE
+		if chunkstore:
+			need += self.archivebytes
+		return int(need)
+
+	def check(self, outdir, clientram=None, **kwargs):
+		"""[problem] for every budget the conversion would exceed."""
+		problems = []
+		chunkstore = kwargs.get('chunkstore', False)
+		need = self.outputBytes(**kwargs)
+		free = freeBytes(outdir)
+		if need > free:
+			problems.append('the output needs about %s but only %s is free under \'%s\'' % (humanBytes(need), humanBytes(free), outdir))
+		if clientram is not None and self.clientBytes(chunkstore) > clientram:
+			problems.append('clients need about %s of RAM for a %s root (a tmpfs fills at most %d%% of RAM), they have %s' % (
+				humanBytes(self.clientBytes(chunkstore)), humanBytes(self.tmpfsbytes), TMPFS_SHARE * 100, humanBytes(clientram)))
+		return problems
+
+	def todict(self, **kwargs):
+		return {
+			'layout': [{'mountpoint': m, 'device': d, 'type': t} for m, d, t in self.layout],
+			'entries': self.entries,
+			'files': self.files,
+			'rootfs_bytes': self.rootfsbytes,
+			'rootfs_disk_bytes': self.diskbytes,
+			'archive_bytes': self.archivebytes,
+			'pack_seconds': round(self.packseconds, 3),
+			'client_tmpfs_bytes': self.tmpfsbytes,
+			'client_ram_bytes': self.clientBytes(kwargs.get('chunkstore', False)),
+			'output_bytes': self.outputBytes(**kwargs),
+			'compressor': self.compressor,
+			'strata': dict((name, s.todict()) for name, s in self.strata.iteritems()),
+		}
+
+def formatPlan(plan, fh, problems=(), **kwargs):
+	for mountpoint, device, fstype in plan.layout:
+		fh.write('%-24s %s (%s)\n' % (mountpoint, device, fstype))
+	if plan.layout:
+		fh.write('\n')
+	fh.write('%-24s %d (%d regular files)\n' % ('entries', plan.entries, plan.files))
+	fh.write('%-24s %s (%s on disk)\n' % ('rootfs', humanBytes(plan.rootfsbytes), humanBytes(plan.diskbytes)))
+	fh.write('%-24s %s with %s\n' % ('archive', humanBytes(plan.archivebytes), ' '.join(plan.compressor)))
+	fh.write('%-24s %.1fs on this machine\n' % ('pack time', plan.packseconds))
+	fh.write('%-24s %s\n' % ('output', humanBytes(plan.outputBytes(**kwargs))))
+	fh.write('%-24s %s tmpfs, %s RAM\n' % ('client', humanBytes(plan.tmpfsbytes), humanBytes(plan.clientBytes(kwargs.get('chunkstore', False)))))
+	fh.write('\n   %-20s %8s %10s %10s %10s %8s\n' % ('stratum', 'files', 'bytes', 'sampled', 'archive', 'pack'))
+	for name, s in sorted(plan.strata.iteritems()):
+		fh.write('   %-20s %8d %10s %10s %10s %7.1fs\n' % (name, len(s.files), humanBytes(s.filebytes), humanBytes(s.samplebytes),
+			humanBytes(s.archivebytes), s.packtime))
+	fh.write('\n')
+	for problem in problems:
+		fh.write('will not fit: %s\n' % problem)
+	if not problems:
+		fh.write('fits\n')
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Where a conversion spends its time, for doit.py --profile.
+
+The driver's main thread runs under cProfile.  A sampler thread reads
+/proc/<pid>/stat and /proc/<pid>/io for every descendant process (cpio,
+pigz, vdfuse, find, file, ...) and for our own threads, and charges the
+CPU time, time blocked on I/O and bytes moved since its last look to the
+phase that is running.  Blocked time comes from the kernel's delay
+accounting when it is enabled, and is otherwise estimated from how often
+the process was seen in uninterruptible sleep.
+"""
+
+import os
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+
+from StringIO import StringIO
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+SAMPLE_INTERVAL = 0.1
+CLK_TCK = float(os.sysconf('SC_CLK_TCK'))
+TOP_FUNCTIONS = 25
+
+MAIN_THREAD = 'python (main thread)'
+WORKER_THREADS = 'python (other threads)'
+
+
+def readStat(path):
+	"""(comm, state, ppid, starttime, cpu seconds, blkio seconds) from a /proc stat file, None if it's gone."""
+	try:
+		with open(path, 'r') as fh:
+			line = fh.read()
+	except IOError:
+		return None
+	comm = line[line.index('(') + 1:line.rindex(')')]
+	rest = line[line.rindex(')') + 2:].split()
+	cpu = (int(rest[11]) + int(rest[12])) / CLK_TCK
+	blkio = int(rest[39]) / CLK_TCK if len(rest) > 39 else 0.0
+	return comm, rest[0], int(rest[1]), rest[19], cpu, blkio
+
+def readIO(path):
+	"""(read_bytes, write_bytes) from a /proc io file, (0, 0) if unreadable."""
+	try:
+		with open(path, 'r') as fh:
+			fields = dict(line.split(': ') for line in fh.read().splitlines() if ': ' in line)
+		return int(fields.get('read_bytes', 0)), int(fields.get('write_bytes', 0))
+	except (IOError, ValueError):
+		return 0, 0
+
+def formatBytes(n):
+	for unit in ('', 'k', 'M', 'G'):
+		if abs(n) < 1024 or unit == 'G':
+			return '%.1f%s' % (n, unit) if unit else '%d' % n
+		n /= 1024.0
+
+
+class Usage(object):
+	"""Accumulated usage of one kind of process within one phase."""
+	__slots__ = ('cpu', 'blkio', 'dsamples', 'samples', 'readbytes', 'writebytes', 'pids')
+
+	def __init__(self):
+		self.cpu = 0.0
+		self.blkio = 0.0
+		self.dsamples = 0
+		self.samples = 0
+		self.readbytes = 0
+		self.writebytes = 0
+		self.pids = set()
+
+	def iowait(self, interval):
+		"""Delay accounting if it counted anything, else the D-state estimate."""
+		return self.blkio or self.dsamples * interval
+
+
+class Phase(object):
+	def __init__(self, name):
+		self.name = name
+		self.wall = 0.0
+		self.childcpu = 0.0	# from os.times, includes processes the sampler missed
+		self.usage = {}		# name -> Usage
+
+	def get(self, name):
+		if name not in self.usage:
+			self.usage[name] = Usage()
+		return self.usage[name]
+
+
+class Profiler(object):
+	"""Profile the calling thread and sample everything below this process until stop()."""
+
+	def __init__(self, interval=SAMPLE_INTERVAL):
+		self.interval = interval
+		self.pid = os.getpid()
+		self.profile = cProfile.Profile()
+		self.phases = []
+		self.current = None
+		self.last = {}		# (kind, id) -> (cpu, blkio, readbytes, writebytes)
+		self.lock = threading.Lock()
+		self.stopping = threading.Event()
+		self.sampler = threading.Thread(target=self.sampleLoop, name='profiler')
+		self.sampler.daemon = True
+
+	def start(self):
+		self.begin('startup')
+		self.sampler.start()
+		self.profile.enable()
+
+	def stop(self):
+		self.profile.disable()
+		self.stopping.set()
+		self.sampler.join()
+		self.sample()
+		self.end()
+
+	def begin(self, name):
+		with self.lock:
+			self.current = Phase(name)
+			self.phases.append(self.current)
+			self.phasestart = (time.time(), os.times())
+
+	def end(self):
+		with self.lock:
+			if self.current is None:
+				return
+			wall, times = self.phasestart
+			now = os.times()
+			self.current.wall += time.time() - wall
+			self.current.childcpu += (now[2] - times[2]) + (now[3] - times[3])
+			self.current = None
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		"""Charge everything until the block exits to a named phase."""
+		self.sample()
+		self.end()
+		self.begin(name)
+		try:
+			yield
+		finally:
+			self.sample()
+			self.end()
+			self.begin('between phases')
+
+	def sampleLoop(self):
+		# an untimed wait would never wake, and python 2's timed wait polls anyway
+		while not self.stopping.is_set():
+			time.sleep(self.interval)
+			try:
+				self.sample()
+			except Exception, e:
+				log.debug('profiler sample failed: %s' % str(e))
+
+	def descendants(self):
+		"""pids of every process below ours."""
+		children = {}
+		for name in os.listdir('/proc'):
+			if not name.isdigit():
+				continue
+			st = readStat('/proc/%s/stat' % name)
+			if st is not None:
+				children.setdefault(st[2], []).append(int(name))
+
+		out = []
+		stack = list(children.get(self.pid, ()))
+		while stack:
+			pid = stack.pop()
+			out.append(pid)
+			stack.extend(children.get(pid, ()))
+		return out
+
+	def sample(self):
+		seen = []
+		for tid in os.listdir('/proc/%d/task' % self.pid):
+			st = readStat('/proc/%d/task/%s/stat' % (self.pid, tid))
+			if st is None:
+				continue
+			name = MAIN_THREAD if int(tid) == self.pid else WORKER_THREADS
+			seen.append((name, ('task', tid, st[3]), st, None))
+		for pid in self.descendants():
+			st = readStat('/proc/%d/stat' % pid)
+			if st is None:
+				continue
+			seen.append((st[0], ('proc', pid, st[3]), st, readIO('/proc/%d/io' % pid)))
+		ownio = readIO('/proc/%d/io' % self.pid)
+
+		with self.lock:
+			if self.current is None:
+				return
+			for name, key, st, io in seen:
+				comm, state, ppid, starttime, cpu, blkio = st
+				readbytes, writebytes = io or (0, 0)
+				last = self.last.get(key, (0.0, 0.0, 0, 0))
+				self.last[key] = (cpu, blkio, readbytes, writebytes)
+
+				usage = self.current.get(name)
+				usage.cpu += cpu - last[0]
+				usage.blkio += blkio - last[1]
+				usage.readbytes += readbytes - last[2]
+				usage.writebytes += writebytes - last[3]
+				usage.samples += 1
+				if state == 'D':
+					usage.dsamples += 1
+				usage.pids.add(key[1])
+
+			# our own i/o is per process, not per thread
+			last = self.last.get('self', (0, 0))
+			self.last['self'] = ownio
+			usage = self.current.get(MAIN_THREAD)
+			usage.readbytes += ownio[0] - last[0]
+			usage.writebytes += ownio[1] - last[1]
+
+	def report(self, fh):
+		fh.write('all7fever profile, sampled every %.2fs\n' % self.interval)
+		fh.write('i/o wait is delay accounting if the kernel has it on, otherwise samples in D state x interval\n\n')
+
+		fh.write('%-16s %9s %9s %9s %9s %9s\n' % ('phase', 'wall', 'python', 'children', 'i/o wait', 'other'))
+		for phase in self.phases:
+			if phase.wall < 0.01 and not phase.usage:
+				continue
+			python = sum(u.cpu for n, u in phase.usage.iteritems() if n in (MAIN_THREAD, WORKER_THREADS))
+			children = max(phase.childcpu, sum(u.cpu for n, u in phase.usage.iteritems() if n not in (MAIN_THREAD, WORKER_THREADS)))
+			iowait = sum(u.iowait(self.interval) for u in phase.usage.itervalues())
+			fh.write('%-16s %8.2fs %8.2fs %8.2fs %8.2fs %8.2fs\n' % (phase.name, phase.wall, python, children, iowait, max(0.0, phase.wall - python - iowait)))
+		fh.write('\n"other" is wall time our main thread spent neither on cpu nor blocked on disk: mostly waiting for children\n\n')
+
+		for phase in self.phases:
+			if not phase.usage:
+				continue
+			fh.write('== %s (%.2fs wall)\n' % (phase.name, phase.wall))
+			fh.write('   %-24s %6s %9s %9s %9s %9s\n' % ('process', 'procs', 'cpu', 'i/o wait', 'read', 'written'))
+			sampled = 0.0
+			for name, u in sorted(phase.usage.iteritems(), key=lambda item: -(item[1].cpu + item[1].iowait(self.interval))):
+				fh.write('   %-24s %6d %8.2fs %8.2fs %9s %9s\n' % (name, len(u.pids), u.cpu, u.iowait(self.interval), formatBytes(u.readbytes), formatBytes(u.writebytes)))
+				if name not in (MAIN_THREAD, WORKER_THREADS):
+					sampled += u.cpu
+			if phase.childcpu - sampled > 0.05:
+				fh.write('   %-24s %6s %8.2fs   (children that exited between samples)\n' % ('unattributed', '', phase.childcpu - sampled))
+			fh.write('\n')
+
+		stream = StringIO()
+		stats = pstats.Stats(self.profile, stream=stream)
+		stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+		stats.sort_stats('time').print_stats(TOP_FUNCTIONS)
+		fh.write('== python hot paths (main thread only)\n')
+		fh.write(stream.getvalue())
+
+	def save(self, reportpath, statspath=None):
+		with open(reportpath, 'w') as fh:
+			self.report(fh)
+		if statspath is not None:
+			self.profile.dump_stats(statspath)
+
+
+class NullProfiler(object):
+	"""Stands in for Profiler when not profiling."""
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		yield
@@ -0,0 +1,402 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+Peer-assisted distribution of chunk store versions (doit.py --chunkstore),
+so booting nodes fetch chunks from each other and not all from the boot
+server.
+
+The tracker runs next to the store.  Clients booted with
+``peers=http://host:9092`` announce themselves for the version they boot,
+serve the chunks they already have over http (busybox httpd in the
+initrd, on ``peerport=``, 9093 by default) and get back a list of other
+peers, the ones with the most chunks first.  Each chunk is tried from a
+couple of peers before falling back to the store, and is only kept if it
+decompresses to its sha1, so a bad or stale peer costs a retry and never a
+broken root.  Announces are repeated every few chunks with progress, which
+the tracker sums up at /stats.
+
+Everything here also runs on loopback:
+
+	swarm.py tracker -p 9092
+	swarm.py client -s http://boot:9090/store -t http://boot:9092 -d /tmp/chunks -o root.cpio.gz
+	swarm.py simulate STORE -n 30 --uplink 10
+
+simulate serves STORE with its uplink capped, starts a tracker and the
+given number of client processes, each capped the same, and reports how
+many bytes came from the store and how many from peers.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import urllib2
+import urlparse
+import argparse
+import tempfile
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+
+import chunkstore
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+PEER_TTL = 300		# seconds a peer stays listed after its last announce
+MAX_PEERS = 8		# peers handed out per announce
+ANNOUNCE_EVERY = 16	# chunks fetched between announces
+PEER_TRIES = 2		# peers asked for a chunk before the store
+HTTP_TIMEOUT = 10
+COPY_BLOCK = 64 * 1024
+
+
+class RateLimiter(object):
+	"""A shared uplink: callers sleep so that together they send at most rate bytes per second."""
+
+	def __init__(self, rate):
+		self.rate = float(rate)
+		self.lock = threading.Lock()
+		self.next = 0
+
+	def take(self, n):
+		with self.lock:
+			self.next = max(time.time(), self.next) + n / self.rate
+			wake = self.next
+		delay = wake - time.time()
+		if delay > 0:
+			time.sleep(delay)
+
+
+class StaticHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""GET of the files under server.root, nothing else."""
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, fmt, *args):
+		log.debug('http: ' + fmt % args)
+
+	def do_GET(self):
+		relpath = urlparse.urlparse(self.path).path.lstrip('/')
+		path = os.path.normpath(os.path.join(self.server.root, relpath))
+		if not path.startswith(self.server.root + os.sep) or not os.path.isfile(path):
+			body = 'not found\n'
+			self.send_response(404)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+			return
+		with open(path, 'rb') as fh:
+			size = os.fstat(fh.fileno()).st_size
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/octet-stream')
+			self.send_header('Content-Length', str(size))
+			self.end_headers()
+			while True:
+				buf = fh.read(COPY_BLOCK)
+				if not buf:
+					break
+				if self.server.limiter is not None:
+					self.server.limiter.take(len(buf))
+				self.wfile.write(buf)
+				self.server.sent += len(buf)
+
+class StaticServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 128
+
+	def __init__(self, address, root, rate=None):
+		self.root = os.path.abspath(root)
+		self.limiter = RateLimiter(rate) if rate else None
+		self.sent = 0
+		BaseHTTPServer.HTTPServer.__init__(self, address, StaticHandler)
+
+def serveInBackground(server):
+	t = threading.Thread(target=server.serve_forever)
+	t.daemon = True
+	t.start()
+	return t
+
+
+class TrackerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def log_message(self, fmt, *args):
+		log.debug('http: ' + fmt % args)
+
+	def reply(self, code, body, ctype='text/plain'):
+		self.send_response(code)
+		self.send_header('Content-Type', ctype)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		url = urlparse.urlparse(self.path)
+		query = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).iteritems())
+		if url.path == '/announce':
+			try:
+				peers = self.server.announce(query['version'], self.client_address[0], int(query.get('port', 0)),
+					int(query.get('have', 0)), query.get('done') == '1',
+					int(query.get('store', 0)), int(query.get('peers', 0)))
+			except (KeyError, ValueError):
+				return self.reply(400, 'bad announce\n')
+			self.reply(200, ''.join(peer + '\n' for peer in peers))
+		elif url.path == '/stats':
+			self.reply(200, json.dumps(self.server.stats(), indent=1, sort_keys=True), 'application/json')
+		else:
+			self.reply(404, 'not found\n')
+
+class Tracker(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 128
+
+	def __init__(self, address, ttl=PEER_TTL):
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		self.swarms = {}	# version -> {peer url: {'seen', 'have', 'done', 'store', 'peers'}}
+		BaseHTTPServer.HTTPServer.__init__(self, address, TrackerHandler)
+
+	def expire(self, now):
+		for version, peers in self.swarms.items():
+			for url, peer in peers.items():
+				if peer['seen'] < now - self.ttl:
+					del peers[url]
+			if not peers:
+				del self.swarms[version]
+
+	def announce(self, version, address, port, have, done, store, peers):
+		"""Record a peer, returns up to MAX_PEERS others for the version, the best stocked first."""
+		now = time.time()
+		me = 'http://%s:%d' % (address, port)
+		with self.lock:
+			self.expire(now)
+			swarm = self.swarms.setdefault(version, {})
+			if port:
+				swarm[me] = {'seen': now, 'have': have, 'done': done, 'store': store, 'peers': peers}
+			others = [(peer['have'], url) for url, peer in swarm.iteritems() if url != me and peer['have']]
+		# the best stocked, shuffled a bit so they don't all get asked first by everyone
+		others.sort(reverse=True)
+		best = [url for have, url in others[:MAX_PEERS * 2]]
+		random.shuffle(best)
+		return best[:MAX_PEERS]
+
+	def stats(self):
+		with self.lock:
+			self.expire(time.time())
+			out = {}
+			for version, swarm in self.swarms.iteritems():
+				out[version] = {
+					'peers': len(swarm),
+					'done': sum(1 for peer in swarm.itervalues() if peer['done']),
+					'store_bytes': sum(peer['store'] for peer in swarm.itervalues()),
+					'peer_bytes': sum(peer['peers'] for peer in swarm.itervalues()),
+				}
+			return out
+
+
+def httpGet(url):
+	fh = urllib2.urlopen(url, timeout=HTTP_TIMEOUT)
+	try:
+		return fh.read()
+	finally:
+		fh.close()
+
+class PeerClient(object):
+	"""
+	Fetches a store version with help from peers and serves what it has to
+	them, what the init script does with peers=.  Chunks are kept in chunkdir
+	as SHA.gz, which is also what peers ask for.
+	"""
+
+	def __init__(self, store, tracker, chunkdir, port=0, version=None, rate=None, host=''):
+		self.store = store.rstrip('/')
+		self.tracker = tracker.rstrip('/') if tracker else None
+		self.chunkdir = chunkdir
+		self.version = version
+		self.manifest = []
+		self.fromstore = 0
+		self.frompeers = 0
+		self.peers = []
+		if not os.path.isdir(chunkdir):
+			os.makedirs(chunkdir)
+		self.server = StaticServer((host, port), chunkdir, rate)
+		self.port = self.server.server_address[1]
+		serveInBackground(self.server)
+
+	def chunkPath(self, sha):
+		return os.path.join(self.chunkdir, sha + '.gz')
+
+	def have(self):
+		return sum(1 for sha, size in self.manifest if os.path.exists(self.chunkPath(sha)))
+
+	def announce(self, done=False):
+		if self.tracker is None:
+			return
+		url = '%s/announce?version=%s&port=%d&have=%d&done=%d&store=%d&peers=%d' % (self.tracker, self.version,
+			self.port, self.have(), int(done), self.fromstore, self.frompeers)
+		try:
+			self.peers = httpGet(url).split()
+		except (IOError, socket.error), e:
+			log.warn('could not announce to the tracker at \'%s\': %s' % (self.tracker, e))
+			self.peers = []
+
+	def fetchChunk(self, sha):
+		for peer in random.sample(self.peers, min(PEER_TRIES, len(self.peers))):
+			try:
+				gz = httpGet('%s/%s.gz' % (peer, sha))
+			except (IOError, socket.error):
+				continue
+			if chunkstore.verifyChunk(sha, gz):
+				self.frompeers += len(gz)
+				return gz
+			log.warn('chunk %s from peer \'%s\' does not match its hash' % (sha, peer))
+
+		gz = httpGet('%s/chunks/%s/%s.gz' % (self.store, sha[:2], sha))
+		if not chunkstore.verifyChunk(sha, gz):
+			raise Exception('chunk %s from the store does not match its hash' % sha)
+		self.fromstore += len(gz)
+		return gz
+
+	def fetch(self):
+		"""Get every chunk of the version that isn't in chunkdir yet."""
+		if self.version is None:
+			self.version = httpGet(self.store + '/latest').strip()
+		self.manifest = chunkstore.parseManifest(httpGet('%s/manifests/%s' % (self.store, self.version)).splitlines())
+
+		# each client goes through the chunks in its own order, so early peers have different ones to offer
+		missing = [sha for sha, size in set(self.manifest) if not os.path.exists(self.chunkPath(sha))]
+		random.shuffle(missing)
+		for n, sha in enumerate(missing):
+			if n % ANNOUNCE_EVERY == 0:
+				self.announce()
+			gz = self.fetchChunk(sha)
+			tmp = self.chunkPath(sha) + '.part'
+			with open(tmp, 'wb') as fh:
+				fh.write(gz)
+			os.rename(tmp, self.chunkPath(sha))
+		self.announce(done=True)
+		log.info('version %s: %d chunks, %d bytes from the store and %d from peers' % (self.version, len(self.manifest),
+			self.fromstore, self.frompeers))
+
+	def assemble(self, out):
+		"""Write the compressed archive, concatenated gzip members being one gzip stream."""
+		for sha, size in self.manifest:
+			with open(self.chunkPath(sha), 'rb') as fh:
+				shutil.copyfileobj(fh, out, COPY_BLOCK)
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+def simulate(storedir, nodes, uplink, stagger=0.1, peers=True, linger=None):
+	"""
+	Boot nodes client processes on loopback against storedir served at uplink
+	bytes per second, each client serving at the same rate.  Returns a summary.
+	"""
+	store = StaticServer(('127.0.0.1', 0), storedir, uplink)
+	serveInBackground(store)
+	tracker = None
+	if peers:
+		tracker = Tracker(('127.0.0.1', 0))
+		serveInBackground(tracker)
+
+	workdir = tempfile.mkdtemp(prefix='all7fever-swarm-')
+	procs = []
+	start = time.time()
+	try:
+		for n in range(nodes):
+			cmd = [sys.executable, os.path.abspath(__file__), 'client',
+				'-s', 'http://127.0.0.1:%d' % store.server_address[1],
+				'-d', os.path.join(workdir, 'node%d' % n), '--uplink', str(uplink), '--summary',
+				'--linger', str(linger if linger is not None else 3600)]
+			if tracker is not None:
+				cmd += ['-t', 'http://127.0.0.1:%d' % tracker.server_address[1]]
+			procs.append(subprocess.Popen(cmd, stdout=subprocess.PIPE, close_fds=True))
+			time.sleep(stagger)
+
+		# each client prints its summary once it has everything, then keeps serving
+		results = []
+		for p in procs:
+			line = p.stdout.readline()
+			if not line:
+				raise Exception('a simulated client exited without finishing, rc=%s' % p.wait())
+			results.append(json.loads(line))
+		elapsed = time.time() - start
+	finally:
+		for p in procs:
+			if p.poll() is None:
+				p.terminate()
+			p.wait()
+		store.shutdown()
+		store.server_close()
+		if tracker is not None:
+			tracker.shutdown()
+			tracker.server_close()
+		shutil.rmtree(workdir)
+
+	times = sorted(r['seconds'] for r in results)
+	return {
+		'nodes': nodes,
+		'peers': peers,
+		'seconds': round(elapsed, 2),
+		'slowest_node': times[-1],
+		'median_node': times[len(times) // 2],
+		'store_bytes': store.sent,
+		'peer_bytes': sum(r['peer_bytes'] for r in results),
+		'bytes_per_second': int(sum(r['store_bytes'] + r['peer_bytes'] for r in results) / elapsed),
+	}
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO, format='[%(asctime)s][%(levelname)s][%(name)s] %(message)s')
+
+	ap = argparse.ArgumentParser(description='peer-assisted distribution of chunk store versions')
+	sub = ap.add_subparsers(dest='command')
+	tracker = sub.add_parser('tracker', help='keep track of which nodes have which version')
+	tracker.add_argument('-p','--port', dest='port', type=int, default=9092)
+	tracker.add_argument('--ttl', dest='ttl', type=int, default=PEER_TTL, help='seconds a peer stays listed without announcing (default %d)' % PEER_TTL)
+	client = sub.add_parser('client', help='fetch a version the way a booting node does')
+	client.add_argument('-s','--store', dest='store', required=True, help='url of the chunk store')
+	client.add_argument('-t','--tracker', dest='tracker', help='url of the tracker, without one only the store is used')
+	client.add_argument('-d','--chunkdir', dest='chunkdir', required=True, help='where chunks are kept and served from')
+	client.add_argument('-p','--port', dest='port', type=int, default=0, help='port to serve chunks on (default any)')
+	client.add_argument('-V','--version', dest='version', help='store version (default the latest)')
+	client.add_argument('-o','--output', dest='output', help='write the assembled archive here')
+	client.add_argument('--uplink', dest='uplink', type=float, help='cap on bytes per second served to peers')
+	client.add_argument('--linger', dest='linger', type=float, default=0, help='seconds to keep serving once done')
+	client.add_argument('--summary', dest='summary', action='store_true', help='print a json summary line when done')
+	sim = sub.add_parser('simulate', help='boot many clients on loopback against a local store')
+	sim.add_argument('store', help='chunk store directory')
+	sim.add_argument('-n','--nodes', dest='nodes', type=int, default=20)
+	sim.add_argument('--uplink', dest='uplink', type=float, default=10, help='MB/s for the store and each node (default 10)')
+	sim.add_argument('--stagger', dest='stagger', type=float, default=0.1, help='seconds between node starts')
+	sim.add_argument('--no-peers', dest='peers', action='store_false', help='every node fetches from the store only')
+	args = ap.parse_args()
+
+	if args.command == 'tracker':
+		server = Tracker(('0.0.0.0', args.port), args.ttl)
+		log.info('tracking peers on port %d' % args.port)
+		server.serve_forever()
+	elif args.command == 'client':
+		start = time.time()
+		pc = PeerClient(args.store, args.tracker, args.chunkdir, args.port, args.version, args.uplink)
+		pc.fetch()
+		if args.output:
+			with open(args.output, 'wb') as out:
+				pc.assemble(out)
+		if args.summary:
+			sys.stdout.write(json.dumps({'seconds': round(time.time() - start, 2), 'store_bytes': pc.fromstore, 'peer_bytes': pc.frompeers}) + '\n')
+			sys.stdout.flush()
+		time.sleep(args.linger)
+		pc.close()
+	else:
+		logging.getLogger().setLevel(logging.WARN)
+		result = simulate(args.store, args.nodes, args.uplink * 1024 * 1024, args.stagger, args.peers)
+		json.dump(result, sys.stdout, indent=1, sort_keys=True)
+		sys.stdout.write('\n')
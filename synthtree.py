@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic root trees and initrds for benchmarking, no VDI needed.
+
+Every tree is generated from a seed, so the same shape, scale and seed give
+byte-identical trees on any host and the timings of different commits can
+be compared.  Shapes:
+
+	tiny		tens of thousands of small files in a shallow tree
+	large		a few large, partly compressible binaries
+	deep		long directory chains with a few files per level
+	sparse		large files that are mostly holes
+	hardlinks	files with many hardlinks, symlinks to them and a few
+			hardlinked symlinks and fifos
+	rootfs		a bit of everything laid out like a debian install, with a
+			kernel, modules and an initrd that createBootPackage accepts
+
+Nothing here needs root.
+"""
+
+import os
+import gzip
+import random
+import hashlib
+import struct
+import binascii
+
+from newc import NewcWriter, Stat, archiveName
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+KERNEL_VERSION = '3.2.0-4'
+KERNEL_FLAVOUR = 'amd64'
+MTIME = 1325376000	# 2012-01-01, so trees don't differ by when they were made
+
+WORDS = ('lib', 'usr', 'share', 'bin', 'conf', 'data', 'cache', 'module', 'kernel', 'net', 'driver', 'locale',
+	'doc', 'man', 'python', 'perl', 'font', 'icon', 'theme', 'zone', 'info', 'header', 'include', 'src')
+
+
+def randomBytes(rng, n):
+	"""n incompressible bytes."""
+	if n <= 0:
+		return ''
+	return binascii.unhexlify('%0*x' % (n * 2, rng.getrandbits(n * 8)))
+
+def mixedBytes(rng, n, ratio=0.5):
+	"""n bytes of which about ratio is random and the rest repetitive text, so it compresses like binaries do."""
+	out = []
+	size = 0
+	while size < n:
+		block = min(4096, n - size)
+		if rng.random() < ratio:
+			out.append(randomBytes(rng, block))
+		else:
+			line = ' '.join(rng.choice(WORDS) for i in range(12)) + '\n'
+			out.append((line * (block // len(line) + 1))[:block])
+		size += block
+	return ''.join(out)
+
+def writeFile(path, data, mtime=MTIME):
+	with open(path, 'wb') as fh:
+		fh.write(data)
+	os.utime(path, (mtime, mtime))
+
+def makeDirs(path):
+	if not os.path.isdir(path):
+		os.makedirs(path)
+
+
+def shapeTiny(root, rng, scale):
+	count = int(20000 * scale)
+	for i in range(count):
+		d = os.path.join(root, 'd%02d' % (i % 64), 'e%03d' % (i // 64 % 256))
+		makeDirs(d)
+		writeFile(os.path.join(d, 'f%06d' % i), mixedBytes(rng, rng.randint(0, 512), 0.3))
+
+def shapeLarge(root, rng, scale):
+	makeDirs(root)
+	for i in range(8):
+		writeFile(os.path.join(root, 'blob%d.bin' % i), mixedBytes(rng, int(16 * 1024 * 1024 * scale), 0.6))
+
+def shapeDeep(root, rng, scale):
+	for chain in range(max(1, int(20 * scale))):
+		d = root
+		for depth in range(40):
+			d = os.path.join(d, '%s%d' % (rng.choice(WORDS), depth))
+			makeDirs(d)
+			for i in range(3):
+				writeFile(os.path.join(d, 'f%d' % i), mixedBytes(rng, rng.randint(0, 2048), 0.3))
+
+def shapeSparse(root, rng, scale):
+	makeDirs(root)
+	for i in range(8):
+		path = os.path.join(root, 'sparse%d.img' % i)
+		size = int(256 * 1024 * 1024 * scale)
+		with open(path, 'wb') as fh:
+			# a few data extents in a mostly empty file, like a preallocated image
+			for j in range(4):
+				fh.seek(rng.randrange(0, max(1, size - 65536)) & ~4095)
+				fh.write(randomBytes(rng, 65536))
+			fh.truncate(size)
+		os.utime(path, (MTIME, MTIME))
+
+def shapeHardlinks(root, rng, scale):
+	makeDirs(os.path.join(root, 'store'))
+	for i in range(int(500 * scale)):
+		src = os.path.join(root, 'store', 'obj%05d' % i)
+		writeFile(src, mixedBytes(rng, rng.randint(0, 16384), 0.5))
+		for j in range(rng.randint(1, 6)):
+			d = os.path.join(root, 'links%d' % j)
+			makeDirs(d)
+			os.link(src, os.path.join(d, 'obj%05d' % i))
+		if i % 4 == 0:
+			os.symlink(os.path.join('..', 'store', 'obj%05d' % i), os.path.join(root, 'links0', 'sym%05d' % i))
+		if i % 100 == 0:
+			# hardlinked symlinks and fifos, which copiers easily get wrong
+			os.link(os.path.join(root, 'links0', 'sym%05d' % i), os.path.join(root, 'links0', 'symlink%05d' % i))
+			fifo = os.path.join(root, 'store', 'fifo%05d' % i)
+			os.mkfifo(fifo)
+			os.link(fifo, os.path.join(root, 'links0', 'fifo%05d' % i))
+
+def shapeRootfs(root, rng, scale):
+	kver = '%s-%s' % (KERNEL_VERSION, KERNEL_FLAVOUR)
+
+	for d in ('bin', 'sbin', 'etc', 'dev', 'proc', 'sys', 'tmp', 'var/log', 'var/lib', 'usr/bin', 'usr/share/doc', 'boot'):
+		makeDirs(os.path.join(root, d))
+
+	writeFile(os.path.join(root, 'etc/fstab'), 'UUID=11111111-2222-3333-4444-555555555555 / ext4 errors=remount-ro 0 1\n')
+	writeFile(os.path.join(root, 'etc/hostname'), 'synthetic\n')
+
+	for d, count, size, ratio in (('bin', 80, 65536, 0.6), ('sbin', 60, 65536, 0.6), ('usr/bin', int(600 * scale), 32768, 0.6),
+			('usr/share/doc', int(3000 * scale), 2048, 0.1)):
+		for i in range(count):
+			writeFile(os.path.join(root, d, 'prog%04d' % i), mixedBytes(rng, rng.randint(0, size), ratio))
+
+	shapeHardlinks(os.path.join(root, 'usr/lib/links'), rng, scale / 4)
+
+	moddir = os.path.join(root, 'lib/modules', kver, 'kernel')
+	for sub, count in (('net', int(150 * scale)), ('drivers/block', int(100 * scale)), ('fs', int(60 * scale))):
+		makeDirs(os.path.join(moddir, sub))
+		for i in range(count):
+			writeFile(os.path.join(moddir, sub, 'mod%03d.ko' % i), mixedBytes(rng, rng.randint(4096, 131072), 0.5))
+
+	makeKernel(os.path.join(root, 'boot', 'vmlinuz-%s' % kver), rng, kver)
+	makeInitrd(os.path.join(root, 'boot', 'initrd.img-%s' % kver), rng, scale, kver)
+
+SHAPES = {
+	'tiny': shapeTiny,
+	'large': shapeLarge,
+	'deep': shapeDeep,
+	'sparse': shapeSparse,
+	'hardlinks': shapeHardlinks,
+	'rootfs': shapeRootfs,
+}
+
+
+def makeKernel(path, rng, kver):
+	"""A file that `file` reports as a bzImage of kernel version kver, with a random payload."""
+	hdr = bytearray(4096)
+	hdr[0x1fe:0x200] = '\x55\xaa'
+	hdr[0x202:0x206] = 'HdrS'
+	struct.pack_into('<H', hdr, 0x206, 0x020a)	# boot protocol 2.10
+	version = '%s (debian-kernel@lists.debian.org) #1 SMP Debian' % kver
+	hdr[0x400:0x400 + len(version)] = version
+	struct.pack_into('<H', hdr, 0x20e, 0x400 - 0x200)
+	writeFile(path, str(hdr) + randomBytes(rng, 2 * 1024 * 1024))
+
+def makeInitrd(path, rng, scale=1.0, kver='%s-%s' % (KERNEL_VERSION, KERNEL_FLAVOUR)):
+	"""A gzipped newc initramfs laid out like initramfs-tools makes them."""
+	entries = []
+	def add(name, mode, data=''):
+		entries.append((name, mode, data))
+
+	for d in ('bin', 'conf', 'etc', 'lib', 'sbin', 'scripts', 'scripts/local-top', 'lib/modules', 'lib/modules/' + kver,
+			'lib/modules/%s/kernel' % kver, 'lib/modules/%s/kernel/net' % kver, 'lib/modules/%s/kernel/drivers' % kver):
+		add(d, 040755)
+	add('init', 0100755, '#!/bin/sh\necho synthetic init\n')
+	add('bin/busybox', 0100755, mixedBytes(rng, 512 * 1024, 0.6))
+	add('conf/initramfs.conf', 0100644, 'MODULES=most\nBOOT=local\n')
+	for i in range(int(200 * scale)):
+		add('lib/modules/%s/kernel/drivers/drv%03d.ko' % (kver, i), 0100644, mixedBytes(rng, rng.randint(4096, 65536), 0.5))
+
+	with open(path, 'wb') as raw:
+		gz = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6, mtime=MTIME)
+		writer = NewcWriter(gz)
+		writer.addEntry(archiveName(''), Stat(st_mode=040755, st_ino=1, st_nlink=2, st_mtime=MTIME))
+		for i, (name, mode, data) in enumerate(entries):
+			writer.addEntry(archiveName(name), Stat(st_mode=mode, st_ino=i + 2, st_nlink=1, st_size=len(data), st_mtime=MTIME), data)
+		writer.close()
+		gz.close()
+	os.utime(path, (MTIME, MTIME))
+
+def makeTree(root, shape, scale=1.0, seed=0):
+	"""Generate a tree of the given shape under root (which must not exist yet)."""
+	if shape not in SHAPES:
+		raise Exception('unknown tree shape \'%s\', known shapes are %s' % (shape, ', '.join(sorted(SHAPES))))
+	os.makedirs(root)
+	rng = random.Random(int(hashlib.sha1('%s-%s-%d' % (shape, scale, seed)).hexdigest(), 16))
+	SHAPES[shape](root, rng, scale)
+	os.utime(root, (MTIME, MTIME))
+	log.debug('generated \'%s\' tree at \'%s\'' % (shape, root))
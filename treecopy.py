@@ -0,0 +1,673 @@
+# -*- coding: utf-8 -*-
+"""
+In-process tree copy for the rootfs copy phase.
+
+Regular file contents are cloned with FICLONE when the source and destination
+share a filesystem that supports reflinks.  Otherwise each data extent found
+with SEEK_DATA/SEEK_HOLE is moved with copy_file_range(2), falling back to a
+plain read/write loop when the kernel refuses.  Holes are never written, so
+sparse files stay sparse.
+
+Files are copied by a pool of worker threads while the tree is walked.
+Owners, modes, timestamps, xattrs and hardlinks are preserved, and directory
+metadata is applied last, deepest first, so the copy itself does not disturb
+it.
+
+``TreeSyncer`` reuses the same machinery to update an existing copy in
+place, rsync style, and reports what it changed.
+"""
+
+import os
+import sys
+import stat
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import Queue
+import ctypes
+import ctypes.util
+import platform
+import threading
+
+from treewalk import TreeWalker
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+DEFAULT_WORKERS = 8
+COPY_CHUNK = 64 * 1024 * 1024	# per copy_file_range call
+READ_CHUNK = 1024 * 1024	# per read() in the userspace fallback
+PROGRESS_INTERVAL = 5.0
+
+SEEK_DATA = 3
+SEEK_HOLE = 4
+FICLONE = 0x40049409
+AT_FDCWD = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+
+# copy_file_range syscall numbers, for a libc too old to wrap it
+SYS_COPY_FILE_RANGE = {
+	'x86_64': 326,
+	'aarch64': 285,
+	'ppc64le': 379,
+	's390x': 375,
+}
+
+# errnos meaning "this kernel/filesystem pair can't do that", not a real failure
+UNSUPPORTED_ERRNOS = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM])
+XATTR_UNSUPPORTED_ERRNOS = set([errno.EOPNOTSUPP, errno.ENOTSUP, errno.EPERM, errno.ENOSYS])
+
+
+### libc glue
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+class timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _errcheck(rc, func, args):
+	if rc < 0:
+		e = ctypes.get_errno()
+		raise OSError(e, os.strerror(e))
+	return rc
+
+def _bind(name, restype, argtypes):
+	try:
+		f = getattr(_libc, name)
+	except AttributeError:
+		return None
+	f.restype = restype
+	f.argtypes = argtypes
+	f.errcheck = _errcheck
+	return f
+
+_loff_p = ctypes.POINTER(ctypes.c_longlong)
+
+_copy_file_range = _bind('copy_file_range', ctypes.c_ssize_t, [ctypes.c_int, _loff_p, ctypes.c_int, _loff_p, ctypes.c_size_t, ctypes.c_uint])
+
+if _copy_file_range is None and platform.machine() in SYS_COPY_FILE_RANGE:
+	# typed like the wrapper, so the offsets go in as loff_t * and not by value
+	_syscall = _bind('syscall', ctypes.c_long, [ctypes.c_long, ctypes.c_int, _loff_p, ctypes.c_int, _loff_p, ctypes.c_size_t, ctypes.c_uint])
+	_sysno = SYS_COPY_FILE_RANGE[platform.machine()]
+
+	def _copy_file_range(fdin, offin, fdout, offout, length, flags):
+		return _syscall(_sysno, fdin, offin, fdout, offout, length, flags)
+
+_utimensat = _bind('utimensat', ctypes.c_int, [ctypes.c_int, ctypes.c_char_p, ctypes.POINTER(timespec), ctypes.c_int])
+_futimens = _bind('futimens', ctypes.c_int, [ctypes.c_int, ctypes.POINTER(timespec)])
+
+_llistxattr = _bind('llistxattr', ctypes.c_ssize_t, [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t])
+_flistxattr = _bind('flistxattr', ctypes.c_ssize_t, [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t])
+_lgetxattr = _bind('lgetxattr', ctypes.c_ssize_t, [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t])
+_fgetxattr = _bind('fgetxattr', ctypes.c_ssize_t, [ctypes.c_int, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t])
+_lsetxattr = _bind('lsetxattr', ctypes.c_int, [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int])
+_lremovexattr = _bind('lremovexattr', ctypes.c_int, [ctypes.c_char_p, ctypes.c_char_p])
+_fsetxattr = _bind('fsetxattr', ctypes.c_int, [ctypes.c_int, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int])
+
+
+def _timespecs(st):
+	def ts(t):
+		sec = int(t)
+		return timespec(sec, min(int((t - sec) * 1e9), 999999999))
+	return (timespec * 2)(ts(st.st_atime), ts(st.st_mtime))
+
+def setTimes(target, st):
+	"""Set atime/mtime from a stat result on a path (not following symlinks) or an fd."""
+	if isinstance(target, int):
+		_futimens(target, _timespecs(st))
+	else:
+		_utimensat(AT_FDCWD, target, _timespecs(st), AT_SYMLINK_NOFOLLOW)
+
+def _readXattrBuf(call, target, *args):
+	size = call(target, *(args + (None, 0)))
+	while True:
+		buf = ctypes.create_string_buffer(size or 1)
+		try:
+			n = call(target, *(args + (buf, size)))
+		except OSError, e:
+			if e.errno == errno.ERANGE:
+				# grew between the two calls
+				size = call(target, *(args + (None, 0)))
+				continue
+			raise
+		return buf.raw[:n]
+
+def getXattrs(target):
+	"""Return a list of (name, value) for a path (not following symlinks) or an fd."""
+	if isinstance(target, int):
+		listf, getf = _flistxattr, _fgetxattr
+	else:
+		listf, getf = _llistxattr, _lgetxattr
+
+	try:
+		names = _readXattrBuf(listf, target)
+	except OSError, e:
+		if e.errno in XATTR_UNSUPPORTED_ERRNOS:
+			return []
+		raise
+
+	xattrs = []
+	for name in names.split('\0'):
+		if not name:
+			continue
+		try:
+			xattrs.append((name, _readXattrBuf(getf, target, name)))
+		except OSError, e:
+			if e.errno not in (errno.ENODATA,) and e.errno not in XATTR_UNSUPPORTED_ERRNOS:
+				raise
+	return xattrs
+
+def setXattr(target, name, value):
+	if isinstance(target, int):
+		_fsetxattr(target, name, value, len(value), 0)
+	else:
+		_lsetxattr(target, name, value, len(value), 0)
+
+def removeXattr(path, name):
+	_lremovexattr(path, name)
+
+
+### data copy
+def reflink(srcfd, dstfd):
+	"""Clone the whole file, returns False if the filesystem can't."""
+	try:
+		fcntl.ioctl(dstfd, FICLONE, srcfd)
+	except IOError, e:
+		if e.errno in UNSUPPORTED_ERRNOS:
+			return False
+		raise
+	return True
+
+def dataExtents(fd, size):
+	"""Yield (offset, length) for each data region of an open file, skipping holes."""
+	offset = 0
+	while offset < size:
+		try:
+			start = os.lseek(fd, offset, SEEK_DATA)
+		except OSError, e:
+			if e.errno == errno.ENXIO:
+				# only a hole left
+				return
+			if e.errno == errno.EINVAL:
+				# no hole support, the rest is data
+				yield (offset, size - offset)
+				return
+			raise
+		end = min(os.lseek(fd, start, SEEK_HOLE), size)
+		if end > start:
+			yield (start, end - start)
+		offset = end
+
+def copyRangeUserspace(srcfd, dstfd, offset, length):
+	os.lseek(srcfd, offset, os.SEEK_SET)
+	os.lseek(dstfd, offset, os.SEEK_SET)
+	while length > 0:
+		buf = os.read(srcfd, min(READ_CHUNK, length))
+		if not buf:
+			break
+		while buf:
+			n = os.write(dstfd, buf)
+			buf = buf[n:]
+			length -= n
+
+class TreeCopier(object):
+	"""Copy a tree from src to dst (which must not exist)."""
+
+	def __init__(self, src, dst, workers=DEFAULT_WORKERS, progress=False):
+		self.src = src
+		self.dst = dst
+		self.workers = max(1, workers)
+		self.progress = progress
+
+		self.lock = threading.Lock()
+		self.stats = dict(files=0, dirs=0, links=0, hardlinks=0, other=0, bytes=0, sparsebytes=0, reflinked=0, offloaded=0, userspace=0)
+
+		self.hardlinks = {}	# (dev, ino) -> first copied relpath
+		self.deferredlinks = []	# (target relpath, relpath)
+		self.dirs = []	# (relpath, lstat) for the final metadata pass
+		self.xattrwarned = False
+
+		# (src dev, dst dev) pairs where copy_file_range gave up
+		self.nooffload = set()
+		if _copy_file_range is None:
+			log.debug('no copy_file_range in this libc/arch, using read/write copies')
+
+		self.queue = Queue.Queue(self.workers * 64)
+		self.errors = []
+
+	def count(self, **kwargs):
+		with self.lock:
+			for k, v in kwargs.iteritems():
+				self.stats[k] += v
+
+	def copy(self):
+		log.debug('starting tree copy \'%s\' -> \'%s\' with %d workers' % (self.src, self.dst, self.workers))
+		started = time.time()
+
+		threads = [threading.Thread(target=self.worker, name='treecopy-%d' % i) for i in range(self.workers)]
+		for t in threads:
+			t.daemon = True
+			t.start()
+
+		try:
+			lastreport = time.time()
+			for relpath, st in TreeWalker(self.src):
+				if self.errors:
+					break
+				self.place(relpath, st)
+				if self.progress and time.time() - lastreport >= PROGRESS_INTERVAL:
+					self.report(started)
+					lastreport = time.time()
+		finally:
+			for t in threads:
+				self.queue.put(None)
+			for t in threads:
+				while t.is_alive():
+					t.join(PROGRESS_INTERVAL)
+					if self.progress and t.is_alive():
+						self.report(started)
+
+		if self.errors:
+			exc_type, exc_value, exc_tb = self.errors[0]
+			raise exc_type, exc_value, exc_tb
+
+		self.finish()
+
+		elapsed = max(time.time() - started, 1e-6)
+		log.info('tree copy completed: %d files, %d MiB in %.1fs (%.1f MiB/s)' % (self.stats['files'], self.stats['bytes'] >> 20, elapsed, self.stats['bytes'] / elapsed / (1 << 20)))
+		log.debug('tree copy stats: %s' % str(self.stats))
+
+		return self.stats
+
+	def finish(self):
+		"""Runs once every file is copied: hardlinks, then directory metadata."""
+		for target, relpath in self.deferredlinks:
+			os.link(os.path.join(self.dst, target), os.path.join(self.dst, relpath))
+
+		# deepest first, so setting a child's times doesn't bump its parent
+		for relpath, st in reversed(self.dirs):
+			self.setMetadata(os.path.join(self.src, relpath), os.path.join(self.dst, relpath), st)
+
+	def report(self, started):
+		with self.lock:
+			files, nbytes = self.stats['files'], self.stats['bytes']
+		elapsed = max(time.time() - started, 1e-6)
+		log.info('copied %d files, %d MiB (%.1f MiB/s)' % (files, nbytes >> 20, nbytes / elapsed / (1 << 20)))
+
+	def place(self, relpath, st):
+		srcpath = os.path.join(self.src, relpath)
+		dstpath = os.path.join(self.dst, relpath) if relpath else self.dst
+		mode = st.st_mode
+
+		if stat.S_ISDIR(mode):
+			os.mkdir(dstpath, 0700)
+			self.dirs.append((relpath, st))
+			self.count(dirs=1)
+			return
+
+		if st.st_nlink > 1:
+			key = (st.st_dev, st.st_ino)
+			if key in self.hardlinks:
+				self.deferredlinks.append((self.hardlinks[key], relpath))
+				self.count(hardlinks=1)
+				return
+			self.hardlinks[key] = relpath
+
+		if stat.S_ISREG(mode):
+			self.queue.put((self.copyFile, (srcpath, dstpath, st)))
+			return
+
+		self.makeNode(srcpath, dstpath, st)
+
+	def makeNode(self, srcpath, dstpath, st):
+		"""Create a symlink, device, fifo or socket, False if it's of a type we don't know."""
+		mode = st.st_mode
+		if stat.S_ISLNK(mode):
+			os.symlink(os.readlink(srcpath), dstpath)
+			self.count(links=1)
+		elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode) or stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode):
+			os.mknod(dstpath, stat.S_IFMT(mode) | 0600, st.st_rdev)
+			self.count(other=1)
+		else:
+			log.warn('skipping \'%s\' of unknown type %o' % (srcpath, stat.S_IFMT(mode)))
+			return False
+
+		self.setMetadata(srcpath, dstpath, st)
+		return True
+
+	def worker(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				break
+			if self.errors:
+				continue
+			func, args = item
+			try:
+				func(*args)
+			except Exception:
+				self.errors.append(sys.exc_info())
+
+	def copyFile(self, srcpath, dstpath, st, finalpath=None):
+		"""Copy one regular file; with finalpath, dstpath is a temporary name renamed over it afterwards."""
+		srcfd = os.open(srcpath, os.O_RDONLY | os.O_NOFOLLOW)
+		try:
+			dstfd = os.open(dstpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0600)
+			try:
+				self.copyData(srcfd, dstfd, st)
+				self.setMetadata(srcfd, dstfd, st)
+			finally:
+				os.close(dstfd)
+		finally:
+			os.close(srcfd)
+
+		if finalpath is not None:
+			os.rename(dstpath, finalpath)
+
+		self.count(files=1)
+
+	def copyData(self, srcfd, dstfd, st):
+		size = st.st_size
+		if size == 0:
+			return
+
+		if reflink(srcfd, dstfd):
+			self.count(bytes=size, reflinked=1)
+			return
+
+		devpair = (st.st_dev, os.fstat(dstfd).st_dev)
+		copied = 0
+		for offset, length in dataExtents(srcfd, size):
+			if devpair not in self.nooffload and _copy_file_range is not None:
+				done = self.offloadRange(srcfd, dstfd, offset, length)
+				if done is None:
+					self.nooffload.add(devpair)
+					log.debug('copy_file_range not usable between devices %s, falling back to read/write' % str(devpair))
+				else:
+					offset += done
+					length -= done
+					copied += done
+			if length > 0:
+				copyRangeUserspace(srcfd, dstfd, offset, length)
+				copied += length
+
+		# keep the trailing hole, if any
+		os.ftruncate(dstfd, size)
+
+		if devpair in self.nooffload or _copy_file_range is None:
+			self.count(bytes=size, sparsebytes=size - copied, userspace=1)
+		else:
+			self.count(bytes=size, sparsebytes=size - copied, offloaded=1)
+
+	def offloadRange(self, srcfd, dstfd, offset, length):
+		"""copy_file_range an extent, returns bytes done or None if unsupported."""
+		offin = ctypes.c_longlong(offset)
+		offout = ctypes.c_longlong(offset)
+		done = 0
+		while done < length:
+			try:
+				n = _copy_file_range(srcfd, offin, dstfd, offout, min(COPY_CHUNK, length - done), 0)
+			except OSError, e:
+				if done == 0 and e.errno in UNSUPPORTED_ERRNOS:
+					return None
+				raise
+			if n == 0:
+				# short source, stat raced with a writer
+				break
+			done += n
+		return done
+
+	def setMetadata(self, src, dst, st):
+		"""Copy owner, xattrs, mode and times; src/dst are both paths or both fds."""
+		isfd = isinstance(dst, int)
+
+		if isfd:
+			os.fchown(dst, st.st_uid, st.st_gid)
+		else:
+			os.lchown(dst, st.st_uid, st.st_gid)
+
+		# after chown, which drops security.capability
+		for name, value in getXattrs(src):
+			try:
+				setXattr(dst, name, value)
+			except OSError, e:
+				if e.errno not in XATTR_UNSUPPORTED_ERRNOS:
+					raise
+				if not self.xattrwarned:
+					self.xattrwarned = True
+					log.warn('destination refused xattr \'%s\' (%s), xattrs may be incomplete' % (name, os.strerror(e.errno)))
+
+		if not stat.S_ISLNK(st.st_mode):
+			if isfd:
+				os.fchmod(dst, stat.S_IMODE(st.st_mode))
+			else:
+				os.chmod(dst, stat.S_IMODE(st.st_mode))
+
+		setTimes(dst, st)
+
+def copyTree(src, dst, **kwargs):
+	"""Copy src to a new directory dst, see TreeCopier."""
+	return TreeCopier(src, dst, **kwargs).copy()
+
+
+### incremental sync
+CHANGE_ADDED = 'A'
+CHANGE_MODIFIED = 'M'
+CHANGE_METADATA = 'm'
+CHANGE_DELETED = 'D'
+
+def lstatOrNone(path):
+	try:
+		return os.lstat(path)
+	except OSError, e:
+		if e.errno == errno.ENOENT:
+			return None
+		raise
+
+def sameTime(a, b):
+	# float stat times only carry about a microsecond at current epochs
+	return abs(a - b) < 2e-6
+
+def fileDigest(path):
+	h = hashlib.sha1()
+	with open(path, 'rb') as fh:
+		while True:
+			buf = fh.read(READ_CHUNK)
+			if not buf:
+				break
+			h.update(buf)
+	return h.digest()
+
+def removePath(path, st):
+	if stat.S_ISDIR(st.st_mode):
+		shutil.rmtree(path)
+	else:
+		os.unlink(path)
+
+class TreeSyncer(TreeCopier):
+	"""
+	Bring an existing copy at dst up to date with src, like rsync -aHAX
+	--delete.  Regular files with the same size and mtime (and, with
+	checksum, the same contents) are left alone; everything else is
+	rewritten, relinked or has its metadata fixed, and entries that are gone
+	from src are deleted.  Paths in exclude (and below them) are not touched
+	on either side.
+
+	``changes`` collects (op, relpath) with op one of A, M, m (metadata
+	only) or D.
+	"""
+
+	def __init__(self, src, dst, checksum=False, exclude=(), **kwargs):
+		TreeCopier.__init__(self, src, dst, **kwargs)
+		self.checksum = checksum
+		self.exclude = set(p.strip('/') for p in exclude)
+		self.seen = set()
+		self.newdirs = set()
+		self.changes = []
+		self.stats['unchanged'] = 0
+
+	def excluded(self, relpath):
+		for p in self.exclude:
+			if relpath == p or relpath.startswith(p + '/'):
+				return True
+		return False
+
+	def change(self, op, relpath):
+		with self.lock:
+			self.changes.append((op, relpath))
+
+	def place(self, relpath, st):
+		self.seen.add(relpath)
+		if self.excluded(relpath):
+			return
+
+		srcpath = os.path.join(self.src, relpath)
+		dstpath = os.path.join(self.dst, relpath) if relpath else self.dst
+		dstst = lstatOrNone(dstpath)
+
+		# a different kind of file is replaced outright
+		if dstst is not None and stat.S_IFMT(dstst.st_mode) != stat.S_IFMT(st.st_mode):
+			removePath(dstpath, dstst)
+			dstst = None
+			op = CHANGE_MODIFIED
+		else:
+			op = CHANGE_ADDED if dstst is None else CHANGE_MODIFIED
+
+		mode = st.st_mode
+
+		if stat.S_ISDIR(mode):
+			if dstst is None:
+				os.mkdir(dstpath, 0700)
+				self.change(op, relpath)
+				self.newdirs.add(relpath)
+			self.dirs.append((relpath, st))
+			self.count(dirs=1)
+			return
+
+		if st.st_nlink > 1:
+			key = (st.st_dev, st.st_ino)
+			if key in self.hardlinks:
+				self.deferredlinks.append((self.hardlinks[key], relpath))
+				self.count(hardlinks=1)
+				return
+			self.hardlinks[key] = relpath
+
+		if stat.S_ISREG(mode):
+			if dstst is not None and dstst.st_size == st.st_size and sameTime(dstst.st_mtime, st.st_mtime):
+				if self.checksum:
+					self.queue.put((self.checkFile, (relpath, srcpath, dstpath, st, dstst)))
+				else:
+					self.syncMetadata(relpath, srcpath, dstpath, st, dstst)
+				return
+			self.queue.put((self.replaceFile, (relpath, srcpath, dstpath, st, op)))
+			return
+
+		if dstst is not None:
+			if stat.S_ISLNK(mode):
+				same = os.readlink(srcpath) == os.readlink(dstpath)
+			else:
+				same = st.st_rdev == dstst.st_rdev
+			if same:
+				self.syncMetadata(relpath, srcpath, dstpath, st, dstst)
+				return
+			os.unlink(dstpath)
+
+		# not TreeCopier.place, the first name of a hardlinked node is registered above already
+		if self.makeNode(srcpath, dstpath, st):
+			self.change(op, relpath)
+
+	def replaceFile(self, relpath, srcpath, dstpath, st, op):
+		tmppath = os.path.join(os.path.dirname(dstpath), '.%s.all7fever~' % os.path.basename(dstpath))
+		if lstatOrNone(tmppath) is not None:
+			os.unlink(tmppath)
+		self.copyFile(srcpath, tmppath, st, finalpath=dstpath)
+		self.change(op, relpath)
+
+	def checkFile(self, relpath, srcpath, dstpath, st, dstst):
+		if fileDigest(srcpath) != fileDigest(dstpath):
+			self.replaceFile(relpath, srcpath, dstpath, st, CHANGE_MODIFIED)
+		else:
+			self.syncMetadata(relpath, srcpath, dstpath, st, dstst)
+
+	def syncMetadata(self, relpath, srcpath, dstpath, st, dstst):
+		"""Fix owner, mode, times and xattrs if they differ, dst is known to have the right contents."""
+		srcx = dict(getXattrs(srcpath))
+		dstx = dict(getXattrs(dstpath))
+
+		same = (st.st_uid, st.st_gid) == (dstst.st_uid, dstst.st_gid) and srcx == dstx and \
+			(stat.S_ISLNK(st.st_mode) or stat.S_IMODE(st.st_mode) == stat.S_IMODE(dstst.st_mode)) and \
+			(stat.S_ISLNK(st.st_mode) or stat.S_ISDIR(st.st_mode) or sameTime(st.st_mtime, dstst.st_mtime))
+
+		if same:
+			self.count(unchanged=1)
+			return
+
+		for name in set(dstx) - set(srcx):
+			removeXattr(dstpath, name)
+		self.setMetadata(srcpath, dstpath, st)
+		self.change(CHANGE_METADATA, relpath)
+
+	def finish(self):
+		for target, relpath in self.deferredlinks:
+			targetpath = os.path.join(self.dst, target)
+			linkpath = os.path.join(self.dst, relpath)
+			linkst = lstatOrNone(linkpath)
+			if linkst is not None:
+				if linkst.st_ino == os.lstat(targetpath).st_ino:
+					continue
+				removePath(linkpath, linkst)
+			os.link(targetpath, linkpath)
+			self.change(CHANGE_ADDED if linkst is None else CHANGE_MODIFIED, relpath)
+
+		self.deleteExtraneous()
+
+		for relpath, st in reversed(self.dirs):
+			dstpath = os.path.join(self.dst, relpath)
+			dstst = os.lstat(dstpath)
+			if relpath not in self.newdirs and (st.st_uid, st.st_gid, stat.S_IMODE(st.st_mode)) != (dstst.st_uid, dstst.st_gid, stat.S_IMODE(dstst.st_mode)):
+				self.change(CHANGE_METADATA, relpath)
+			# times always, our own changes inside it bumped them
+			self.setMetadata(os.path.join(self.src, relpath), dstpath, st)
+
+	def deleteExtraneous(self):
+		doomed = []
+		doomeddirs = set()
+		for relpath, st in TreeWalker(self.dst):
+			if relpath in self.seen or self.excluded(relpath):
+				continue
+			if os.path.dirname(relpath) in doomeddirs:
+				# inside a directory that goes anyway
+				if stat.S_ISDIR(st.st_mode):
+					doomeddirs.add(relpath)
+				continue
+			doomed.append((relpath, st))
+			if stat.S_ISDIR(st.st_mode):
+				doomeddirs.add(relpath)
+
+		for relpath, st in doomed:
+			removePath(os.path.join(self.dst, relpath), st)
+			self.change(CHANGE_DELETED, relpath)
+
+	def sync(self):
+		log.debug('starting tree sync \'%s\' -> \'%s\'' % (self.src, self.dst))
+		TreeCopier.copy(self)
+		ops = [op for op, relpath in self.changes]
+		log.info('tree sync completed: %d added, %d modified, %d metadata only, %d deleted, %d unchanged' % (
+			ops.count(CHANGE_ADDED), ops.count(CHANGE_MODIFIED), ops.count(CHANGE_METADATA), ops.count(CHANGE_DELETED), self.stats['unchanged']))
+		return sorted(self.changes, key=lambda change: change[1])
+
+def syncTree(src, dst, **kwargs):
+	"""Update dst in place to match src, returns the change list, see TreeSyncer."""
+	return TreeSyncer(src, dst, **kwargs).sync()
+
+def writeChangeList(path, changes):
+	"""One 'op<TAB>relpath' line per change."""
+	with open(path, 'w') as fh:
+		for op, relpath in changes:
+			fh.write('%s\t%s\n' % (op, relpath))
+
+def readChangeList(path):
+	with open(path, 'r') as fh:
+		return [tuple(line.rstrip('\n').split('\t', 1)) for line in fh if line.strip()]
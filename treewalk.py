@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel directory walker.
+
+On the vdfuse-backed mount every getdents() and lstat() is a FUSE round-trip,
+so a single-threaded walk spends most of its time waiting.  ``TreeWalker``
+keeps a bounded thread pool busy listing the directories it is about to
+visit and lstat'ing their entries in batches, while still yielding entries
+in a fixed order: parents before children, names sorted bytewise, depth
+first (like ``find .`` with sorted directories).
+"""
+
+import os
+import stat
+import functools
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+import logging
+log = logging.getLogger(__name__)
+
+### constants
+DEFAULT_THREADS = 16
+STAT_BATCH = 128	# lstats per task, so one huge directory is spread over the pool
+
+
+class DirScan(object):
+	"""
+	The listing of one directory, filled in by the pool.  Callbacks all run
+	in the pool's single result thread, so they need no locking among
+	themselves.
+	"""
+
+	def __init__(self, walker, relpath):
+		self.walker = walker
+		self.relpath = relpath
+		self.done = threading.Event()
+		self.batches = None
+		self.pending = 0
+		self.result = None
+		self.error = None
+
+		walker.pool.apply_async(scanDir, (walker.top, relpath), callback=self.scanned)
+
+	def scanned(self, result):
+		names, first, error = result
+		if error is not None:
+			self.error = error
+			self.done.set()
+			return
+
+		rest = range(STAT_BATCH, len(names), STAT_BATCH)
+		self.batches = [first] + [None] * len(rest)
+		self.pending = len(rest)
+		if not rest:
+			self.complete()
+			return
+
+		for n, i in enumerate(rest):
+			self.walker.pool.apply_async(lstatBatch, (self.walker.top, self.relpath, names[i:i + STAT_BATCH]),
+					callback=functools.partial(self.batchDone, n + 1))
+
+	def batchDone(self, n, entries):
+		self.batches[n] = entries
+		self.pending -= 1
+		if self.pending == 0:
+			self.complete()
+
+	def complete(self):
+		self.result = [entry for batch in self.batches for entry in batch]
+		self.batches = None
+		self.done.set()
+		self.walker.prefetch(os.path.join(self.relpath, name) for name, st in self.result if stat.S_ISDIR(st.st_mode))
+
+	def entries(self):
+		"""Block until scanned, returns [(name, lstat)] sorted by name."""
+		# no timeout: python 2 implements timed waits by polling with sleeps of up to 50ms
+		self.done.wait()
+		if self.error is not None:
+			raise self.error
+		return self.result
+
+def scanDir(top, relpath):
+	"""List a directory and lstat the first batch of it, errors are handed back rather than raised in the pool."""
+	try:
+		names = sorted(os.listdir(os.path.join(top, relpath)))
+	except OSError, e:
+		return (None, None, e)
+	return (names, lstatBatch(top, relpath, names[:STAT_BATCH]), None)
+
+def lstatBatch(top, relpath, names):
+	out = []
+	base = os.path.join(top, relpath)
+	for name in names:
+		try:
+			out.append((name, os.lstat(os.path.join(base, name))))
+		except OSError, e:
+			# gone since the listing, like find we just skip it
+			log.debug('could not lstat \'%s\': %s' % (os.path.join(base, name), str(e)))
+	return out
+
+
+class TreeWalker(object):
+	"""
+	Iterate over (relpath, lstat) for top and everything below it.  top
+	itself comes first as ''.  Unreadable directories raise OSError unless
+	onerror is given, in which case it is called with the exception and the
+	directory is skipped.
+	"""
+
+	def __init__(self, top, threads=DEFAULT_THREADS, prefetch=None, onerror=None):
+		self.top = top
+		self.threads = max(1, threads)
+		self.window = prefetch or self.threads * 8
+		self.onerror = onerror
+		self.pool = None
+		self.lock = threading.Lock()
+		self.scans = {}	# relpath -> DirScan, started but not yet visited
+
+	def __iter__(self):
+		self.pool = ThreadPool(self.threads)
+		finished = False
+		try:
+			for entry in self.walk():
+				yield entry
+			finished = True
+		finally:
+			if finished:
+				# nothing is queued any more; the workers are daemon threads and
+				# exit on their own, while join() would sit out the pool's 0.1s
+				# housekeeping sleep on every walk
+				self.pool.close()
+			else:
+				self.pool.terminate()
+				self.pool.join()
+			self.pool = None
+			self.scans = {}
+
+	def prefetch(self, relpaths):
+		"""Start scanning directories, in order, while the window has room."""
+		with self.lock:
+			for relpath in relpaths:
+				if len(self.scans) >= self.window:
+					break
+				if relpath not in self.scans:
+					self.scans[relpath] = DirScan(self, relpath)
+
+	def scan(self, relpath):
+		with self.lock:
+			scan = self.scans.pop(relpath, None)
+			if scan is None:
+				scan = DirScan(self, relpath)
+		return scan
+
+	def walk(self):
+		# entries still to yield, the next one last
+		stack = [('', os.lstat(self.top))]
+
+		while stack:
+			reldir, st = stack.pop()
+			yield (reldir, st)
+			if not stat.S_ISDIR(st.st_mode):
+				continue
+
+			scan = self.scan(reldir)
+
+			# whatever finished scanning queued its own subdirectories; make sure
+			# the ones we reach next are started too
+			self.prefetch(relpath for relpath, st in reversed(stack[-self.threads * 2:]) if stat.S_ISDIR(st.st_mode))
+
+			try:
+				entries = scan.entries()
+			except OSError, e:
+				if self.onerror is None:
+					raise
+				self.onerror(e)
+				continue
+
+			stack.extend((os.path.join(reldir, name), st) for name, st in reversed(entries))
+
+
+def treeSize(top, **kwargs):
+	"""Apparent size of a tree in bytes, counting hardlinked files once (like du -b)."""
+	total = 0
+	seen = set()
+	for relpath, st in TreeWalker(top, **kwargs):
+		if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+			key = (st.st_dev, st.st_ino)
+			if key in seen:
+				continue
+			seen.add(key)
+		total += st.st_size
+	return total